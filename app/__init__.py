@@ -2,6 +2,7 @@
 
 from flask import Flask
 from app.data_ingestor import DataIngestor
+from app.data_reloader import DataReloader
 from app.task_runner import ThreadPool
 from app.config.logger_config import setup_logger
 import os
@@ -9,7 +10,26 @@ import os
 webserver = Flask(__name__)
 webserver.tasks_runner = ThreadPool()
 
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+def load_data(csv_path):
+    """Function ingesting a CSV file.
+    The parsed columns are saved in DATA_SNAPSHOT_DIR (empty to disable) for faster restarts;
+    with DATA_CHUNK_ROWS the CSV is streamed in chunks into the aggregates, without keeping rows"""
+    return DataIngestor(csv_path, snapshot_dir=os.getenv('DATA_SNAPSHOT_DIR', 'snapshots'),\
+        chunk_rows=int(os.getenv('DATA_CHUNK_ROWS', '0')))
+
+def swap_data(ingestor):
+    """Function replacing the ingested data used by the new requests"""
+    # with TP_BACKEND=process the jobs run in worker processes sharing the ingested data
+    webserver.tasks_runner.share(ingestor, replaces=webserver.data_ingestor)
+    webserver.data_ingestor = ingestor
+    # the cache keys carry the version of the data, the old results are only dropped
+    webserver.tasks_runner.cache.clear()
+
+CSV_PATH = "./nutrition_activity_obesity_usa_subset.csv"
+webserver.data_ingestor = None
+swap_data(load_data(CSV_PATH))
+# new versions of the dataset are loaded in the background (/api/admin/reload)
+webserver.data_reloader = DataReloader(CSV_PATH, load_data, swap_data)
 
 if not os.path.exists('results'):
     os.makedirs('results')
@@ -0,0 +1,227 @@
+"""This module contains the Aggregates class which keeps the
+sum/count tables of Data_Value used to answer the API requests."""
+
+import numpy as np
+import pandas as pd
+from app.ranking import Ranking
+
+# YearStart/YearEnd of the rows without a valid year
+NO_YEAR = -1
+
+class Aggregates:
+    """Class used to store precomputed sums and counts of Data_Value for:
+    - question
+    - question x state
+    - question x state x stratification category x stratification
+    The same tables are also kept for each (YearStart, YearEnd) partition of the rows,
+    so that a year range is answered by merging the partitions it contains"""
+
+    def __init__(self, by_years=True, materialize=True):
+        # question -> [sum, count]
+        self.questions = {}
+        # question -> {state: [sum, count]}, states in the order they first appear
+        self.states = {}
+        # question -> {state: {(category, stratification): [sum, count]}}, sorted by keys
+        self.categories = {}
+        # question -> (result keys, means) of /api/mean_by_category, ready to be zipped
+        self.category_results = {}
+        # question -> {state: (result keys, means)} of /api/state_mean_by_category
+        self.state_category_results = {}
+        # question -> Ranking of the states by mean, rebuilt when the question changes
+        self.rankings = {}
+        # (YearStart, YearEnd) -> Aggregates of the rows of these years (None if not kept)
+        self.years = {} if by_years else None
+        # whether the *_by_category results and the rankings are precomputed
+        # (not needed for the partitions)
+        self.materialize = materialize
+
+    def fold(self, columns: dict, dictionaries: dict):
+        """Method to add a batch of rows (columns of codes and values) to the tables,
+        in time proportional to the batch and the groups of its questions.
+        Returns the set of questions that were touched."""
+        values = columns['Data_Value']
+        # NaN values do not contribute to sums and counts (same as pandas' mean)
+        valid = ~np.isnan(values)
+        questions = columns['Question']
+        locations = columns['LocationDesc']
+        categories = columns['StratificationCategory1']
+        stratifications = columns['Stratification1']
+
+        question_names = dictionaries['Question']
+        state_names = dictionaries['LocationDesc']
+        category_names = dictionaries['StratificationCategory1']
+        stratification_names = dictionaries['Stratification1']
+
+        # the tables of a question are copied, updated and then swapped in (copy-on-write),
+        # so requests being answered meanwhile never see half of an update
+
+        # question table
+        for (question,), group_sum, group_count in _group_sums((questions,), values, valid):
+            if group_count == 0:
+                continue
+            question = question_names[question]
+            total, count = self.questions.get(question, (0.0, 0))
+            self.questions[question] = [total + group_sum, count + group_count]
+
+        # question x state table
+        states = {}
+        for (question, state), group_sum, group_count in _group_sums(
+                (questions, locations), values, valid):
+            if group_count == 0:
+                continue
+            question = question_names[question]
+            if question not in states:
+                states[question] = _copy(self.states.get(question, {}))
+            _add(states[question], state_names[state], group_sum, group_count)
+        self.states.update(states)
+        if self.materialize:
+            for question, table in states.items():
+                self.rankings[question] = Ranking(table)
+
+        # question x state x category x stratification table, summed by pandas so the
+        # means are exactly the ones of a pandas groupby mean (compensated summation)
+        grouped = pd.DataFrame({'question': questions, 'state': locations,
+                                'category': categories, 'stratification': stratifications,
+                                'value': values})\
+            .groupby(['question', 'state', 'category', 'stratification'], sort=False)['value']\
+            .agg(['sum', 'count'])
+        tables = {}
+        for (question, state, category, stratification), group_sum, group_count in zip(
+                grouped.index, grouped['sum'].tolist(), grouped['count'].tolist()):
+            question = question_names[question]
+            if question not in tables:
+                tables[question] = {state: _copy(table) for state, table in
+                                    self.categories.get(question, {}).items()}
+            _add(tables[question].setdefault(state_names[state], {}),
+                 (category_names[category], stratification_names[stratification]),
+                 group_sum, group_count)
+
+        for question, table in tables.items():
+            self._set_categories(question, table)
+
+        if self.years is not None and 'YearStart' in columns:
+            self._fold_years(columns, dictionaries)
+
+        return set(tables)
+
+    def _fold_years(self, columns, dictionaries):
+        """Method adding the rows to the partitions of their (YearStart, YearEnd)"""
+        years = np.stack((columns['YearStart'], columns['YearEnd']), axis=1)
+        if len(years) == 0:
+            return
+        uniques, first_rows, inverse = np.unique(years, axis=0, return_index=True,
+                                                 return_inverse=True)
+        # the rows of each partition, in row order
+        order = np.argsort(inverse.reshape(-1), kind='stable')
+        bounds = np.cumsum(np.bincount(inverse.reshape(-1), minlength=len(uniques)))
+        partitions = None
+        for group in np.argsort(first_rows, kind='stable'):
+            key = tuple(uniques[group].tolist())
+            rows = order[bounds[group - 1] if group else 0:bounds[group]]
+            partition = self.years.get(key)
+            if partition is None:
+                if partitions is None:
+                    # copied before adding partitions, requests may be iterating over them
+                    partitions = dict(self.years)
+                partition = partitions[key] = Aggregates(by_years=False, materialize=False)
+            partition.fold({name: column[rows] for name, column in columns.items()},
+                           dictionaries)
+        if partitions is not None:
+            self.years = partitions
+
+    def for_years(self, question, year_start=None, year_end=None):
+        """Method returning the tables of a question for the rows of the years between
+        year_start and year_end (a bound is ignored when None), merged from the partitions
+        contained in the range; the cost depends on the number of partitions merged"""
+        merged = Aggregates(by_years=False)
+        categories = {}
+        for (start, end), partition in self.years.items():
+            if start == NO_YEAR or end == NO_YEAR:
+                continue
+            if (year_start is not None and start < year_start) or\
+                    (year_end is not None and end > year_end):
+                continue
+            values = partition.questions.get(question)
+            if values is not None:
+                _add(merged.questions, question, values[0], values[1])
+            states = merged.states.setdefault(question, {})
+            for state, (total, count) in partition.states.get(question, {}).items():
+                _add(states, state, total, count)
+            for state, table in partition.categories.get(question, {}).items():
+                state_table = categories.setdefault(state, {})
+                for key, (total, count) in table.items():
+                    _add(state_table, key, total, count)
+        if categories:
+            merged._set_categories(question, categories)
+        return merged
+
+    def ranking(self, question) -> Ranking:
+        """Method returning the states of a question sorted by mean (built on the fly
+        for the tables that do not keep them, such as the merged year partitions)"""
+        ranking = self.rankings.get(question)
+        if ranking is None:
+            ranking = Ranking(self.states.get(question, {}))
+        return ranking
+
+    def _set_categories(self, question, table):
+        # keeping the category table sorted, the same order as a pandas groupby
+        self.categories[question] = {state: dict(sorted(table[state].items()))
+                                     for state in sorted(table)}
+        if self.materialize:
+            self._materialize(question)
+
+    def _materialize(self, question):
+        """Method precomputing the keys and means of the *_by_category results of a question,
+        so that a request only has to zip two lists"""
+        keys, sums, counts = [], [], []
+        state_category_results = {}
+        for state, table in self.categories[question].items():
+            # rows with an empty state, category or stratification are not part of the results
+            entries = [(key, values) for key, values in table.items()
+                       if state != '' and key[0] != '' and key[1] != '']
+            state_sums = [values[0] for _, values in entries]
+            state_counts = [values[1] for _, values in entries]
+            state_category_results[state] = \
+                ([str(key) for key, _ in entries], _means(state_sums, state_counts))
+            keys.extend(str((state,) + key) for key, _ in entries)
+            sums.extend(state_sums)
+            counts.extend(state_counts)
+        self.state_category_results[question] = state_category_results
+        self.category_results[question] = (keys, _means(sums, counts))
+
+def _means(sums, counts):
+    """Vectorized sum / count, groups having only missing values have no mean (NaN)"""
+    sums = np.asarray(sums, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64)
+    means = np.full(len(sums), np.nan)
+    np.divide(sums, counts, out=means, where=counts > 0)
+    return means.tolist()
+
+def _copy(table):
+    """Copy of a table whose [sum, count] entries can be updated without changing table"""
+    return {key: list(entry) for key, entry in table.items()}
+
+def _add(table, key, group_sum, group_count):
+    """Adds a partial sum and count to the entry of a table."""
+    entry = table.get(key)
+    if entry is None:
+        table[key] = [group_sum, group_count]
+    else:
+        entry[0] += group_sum
+        entry[1] += group_count
+
+def _group_sums(key_columns, values, valid):
+    """Generator of (key codes, sum, count) for every group of rows having the same codes.
+    Groups are produced in the order in which they first appear in the rows, and the
+    values of a group are added in row order."""
+    if len(values) == 0:
+        return
+    keys = np.stack(key_columns, axis=1)
+    uniques, first_rows, inverse = np.unique(keys, axis=0, return_index=True,
+                                             return_inverse=True)
+    inverse = inverse.reshape(-1)
+    # bincount adds the weights sequentially, the same as a running sum over the rows
+    sums = np.bincount(inverse[valid], weights=values[valid], minlength=len(uniques))
+    counts = np.bincount(inverse[valid], minlength=len(uniques))
+    for group in np.argsort(first_rows, kind='stable'):
+        yield tuple(uniques[group].tolist()), float(sums[group]), int(counts[group])
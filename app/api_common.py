@@ -0,0 +1,104 @@
+"""This module contains what the Flask routes (routes.py) and the ASGI application (asgi.py)
+share: the checks of the requests submitting a job and the encoding of the JSON responses."""
+
+import os
+import zlib
+from app.query_engine import Query
+from app.ranking import rank_options
+from app.result_cache import cache_tags
+from app.utilities.utils import check_years
+
+# results of at least this size (bytes) are sent with gzip to the clients accepting it
+GZIP_MIN_BYTES = int(os.getenv('TP_GZIP_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.getenv('TP_GZIP_LEVEL', '1'))
+# results of at least this size are streamed (chunked transfer) in chunks of STREAM_CHUNK_BYTES
+STREAM_MIN_BYTES = int(os.getenv('TP_STREAM_MIN_BYTES', str(256 * 1024)))
+STREAM_CHUNK_BYTES = 64 * 1024
+
+class RequestError(Exception):
+    """Exception raised for a request that is refused, answered with its status
+    and {"status": "error", "reason": ...}"""
+    def __init__(self, status: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+def job_tags(path: str, data, data_ingestor) -> frozenset:
+    """Function checking the payload of a job endpoint before the job is submitted,
+    returns the cache tags of its result (the questions it depends on).
+    Raises RequestError (400, or 501 for a query in streaming mode)"""
+    try:
+        if path == '/api/query':
+            query = Query(data)
+            if not data_ingestor.columns:
+                # with DATA_CHUNK_ROWS only the aggregate tables are kept, not the rows
+                raise RequestError(501, "Queries are not available in streaming mode")
+            return query.cache_tags()
+        if path == '/api/rank':
+            rank_options(data)
+        elif path == '/api/batch':
+            sub_requests = data.get('requests') if isinstance(data, dict) else data
+            if not isinstance(sub_requests, list) or\
+                    not all(isinstance(sub_request, dict) for sub_request in sub_requests):
+                raise ValueError("Expected a list of requests")
+        elif not isinstance(data, dict):
+            raise ValueError("Expected a JSON object")
+        check_years(data)
+    except ValueError as error:
+        raise RequestError(400, str(error)) from error
+    return cache_tags(data)
+
+def job_parts(job_id: str, status: str, payload: bytes) -> list:
+    """Function returning the encoded parts of the response of a job computed by the
+    request ({"status": ..., "job_id": ..., "data" or "reason": payload}),
+    payload being its serialized result or error message"""
+    key = b'"data": ' if status == "done" else b'"reason": '
+    return [b'{"status": "' + status.encode('utf-8') + b'", "job_id": "' +
+            job_id.encode('utf-8') + b'", ' + key, payload, b'}']
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Function returning whether an Accept-Encoding header accepts gzip, i.e. gzip
+    (or else *) is listed with a q-value above 0 (gzip;q=0 refuses it)"""
+    qvalues = {}
+    for coding in accept_encoding.split(','):
+        name, *params = coding.split(';')
+        qvalue = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name.strip().lower()] = qvalue
+    return qvalues.get('gzip', qvalues.get('*', 0.0)) > 0
+
+def encode_json(parts: list, accept_encoding: str) -> tuple:
+    """Function returning the headers and the body of a response made of JSON parts that
+    are already encoded (the stored result and the envelope around it), so the result is
+    never parsed or copied again. Large bodies are compressed when the client accepts gzip,
+    and returned as a generator of chunks (sent with chunked transfer) instead of bytes."""
+    size = sum(len(part) for part in parts)
+    use_gzip = GZIP_MIN_BYTES > 0 and size >= GZIP_MIN_BYTES and accepts_gzip(accept_encoding)
+    headers = {'Vary': 'Accept-Encoding'}
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+
+    if size < STREAM_MIN_BYTES:
+        body = b''.join(parts)
+        if use_gzip:
+            body = zlib.compress(body, GZIP_LEVEL, wbits=31)
+        return headers, body
+    return headers, _chunks(parts, use_gzip)
+
+def _chunks(parts, use_gzip):
+    compressor = zlib.compressobj(GZIP_LEVEL, wbits=31) if use_gzip else None
+    for part in parts:
+        view = memoryview(part)
+        for start in range(0, len(view), STREAM_CHUNK_BYTES):
+            chunk = view[start:start + STREAM_CHUNK_BYTES]
+            chunk = compressor.compress(chunk) if compressor else bytes(chunk)
+            if chunk:
+                yield chunk
+    if compressor:
+        yield compressor.flush()
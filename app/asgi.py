@@ -0,0 +1,284 @@
+"""This module contains the ASGI application of the webserver (asgi_server.py).
+The endpoints submitting jobs and /api/get_results/<job_id> are async handlers: a job is
+handed to the ThreadPool and its completion is awaited on the event loop (the worker
+finishing it wakes the request up through loop.call_soon_threadsafe), so a waiting request
+holds no thread. The other routes (admin, stats, metrics) run the Flask app in a thread."""
+
+import asyncio
+import functools
+import io
+import json
+import sys
+import time
+from urllib.parse import parse_qsl
+
+from app import webserver, logger, metrics
+from app.api_common import RequestError, job_tags, job_parts, encode_json
+from app.query_engine import run_query
+from app.result_cache import make_cache_key
+from app.routes import MAX_WAIT
+from app.scheduler import cost_class
+from app.task_runner import QueueFullError, JobError
+from app.utilities.utils import CALCULATIONS, calculate_batch, calculate_rank
+
+# endpoints answered by a job: path -> task
+JOB_ENDPOINTS = {f'/api/{endpoint}': task for endpoint, task in CALCULATIONS.items()}
+JOB_ENDPOINTS.update({
+    '/api/batch': calculate_batch,
+    '/api/query': run_query,
+    '/api/rank': calculate_rank,
+})
+
+class HTTPError(RequestError):
+    """Exception answered with a JSON error ({"status": "error", "reason": ...})"""
+    def __init__(self, status, reason, headers=()):
+        super().__init__(status, reason)
+        self.headers = list(headers)
+
+class Request:
+    """Class used for the parts of an ASGI request the handlers need"""
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.path = scope['path']
+        self.method = scope['method']
+        self.body = body
+        self.headers = {}
+        for name, value in scope['headers']:
+            self.headers[name.decode('latin-1')] = value.decode('latin-1')
+        self.args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+
+    def json(self):
+        """Method returning the JSON body, raises HTTPError (400) when it is not valid"""
+        try:
+            return json.loads(self.body)
+        except ValueError as error:
+            raise HTTPError(400, "Invalid JSON body") from error
+
+    def wait_seconds(self):
+        """Method returning the ?wait= seconds, at most MAX_WAIT"""
+        try:
+            return min(float(self.args.get('wait', 0)), MAX_WAIT)
+        except ValueError as error:
+            raise HTTPError(400, "Invalid wait") from error
+
+async def wait_for_job(job_id, timeout):
+    """Coroutine returning when the job is done or after timeout seconds"""
+    tasks_runner = webserver.tasks_runner
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def wake_up():
+        # called by the worker thread finishing the job
+        try:
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+        except RuntimeError:
+            # the event loop was closed meanwhile
+            pass
+
+    if not tasks_runner.add_done_callback(job_id, wake_up):
+        return
+    try:
+        await asyncio.wait_for(done, timeout)
+    except asyncio.TimeoutError:
+        tasks_runner.remove_done_callback(job_id, wake_up)
+
+def _result_parts(job_id, with_job_id=False, timings=False):
+    """Status and encoded parts of the response of a job (like routes.get_response)"""
+    tasks_runner = webserver.tasks_runner
+    # the job is read once, it can be forgotten (expired) at any time
+    job = tasks_runner.get_job(job_id)
+    if job is None:
+        raise HTTPError(404, "Invalid job_id")
+    prefix = b'{"job_id": "' + job_id.encode('utf-8') + b'", ' if with_job_id else b'{'
+    if job["status"] == "running":
+        return 200, [prefix + b'"status": "running"}']
+    payload = tasks_runner.results.load(job_id)
+    if payload is None:
+        if tasks_runner.get_job(job_id) is None:
+            raise HTTPError(404, "Invalid job_id")
+        raise HTTPError(500, "Error while reading result")
+    if job["status"] == "error":
+        return 500, [prefix + b'"status": "error", "reason": ', payload, b'}']
+    suffix = b'}'
+    if timings:
+        suffix = b', "timings": ' + json.dumps(job.get('timings')).encode('utf-8') + b'}'
+    return 200, [prefix + b'"status": "done", "data": ', payload, suffix]
+
+def _overloaded(error):
+    """HTTPError of a job refused by admission control (see routes.overloaded)"""
+    logger.warning("Job refused: %s", error)
+    return HTTPError(429 if error.per_client else 503, str(error),
+                     [(b'retry-after', str(error.retry_after).encode())])
+
+async def submit_job(request, task):
+    """Handler of the job endpoints, with ?sync=1 (computed in a thread of the event loop's
+    executor) or ?wait=<seconds> (the response carries the result if the job is done in
+    time), otherwise answering with the job_id as routes.submit_job does"""
+    logger.info("Received request for %s", request.path[len('/api/'):])
+    data = request.json()
+    wait = request.wait_seconds()
+    data_ingestor = webserver.data_ingestor
+    try:
+        tags = job_tags(request.path, data, data_ingestor)
+    except RequestError as error:
+        raise HTTPError(error.status, error.reason) from error
+    cache_key = make_cache_key(request.path, data, data_ingestor.version)
+    tasks_runner = webserver.tasks_runner
+    client = request.headers.get('x-api-key') or (request.scope.get('client') or ('',))[0]
+
+    if request.args.get('sync') == '1' or request.headers.get('x-sync') == '1':
+        try:
+            job_id, payload = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(tasks_runner.run_task, task, data_ingestor, data,
+                                        cache_key=cache_key, cache_tags=tags, client=client))
+        except QueueFullError as error:
+            raise _overloaded(error) from error
+        except JobError as error:
+            logger.error("Job %s failed: %s", error.job_id, error)
+            return 500, job_parts(error.job_id, "error", error.payload)
+        logger.info("Job %s computed synchronously", job_id)
+        return 200, job_parts(job_id, "done", payload)
+
+    try:
+        job_id = tasks_runner.add_task(task, data_ingestor, data, cache_key=cache_key,
+                                       cache_tags=tags, lane=cost_class(request.path),
+                                       client=client)
+    except QueueFullError as error:
+        raise _overloaded(error) from error
+    logger.info("Job %s added to the queue", job_id)
+
+    if wait > 0:
+        await wait_for_job(job_id, wait)
+        # a job that is not done in time is answered like a job that was only queued
+        if (tasks_runner.get_job(job_id) or {}).get("status") != "running":
+            return _result_parts(job_id, with_job_id=True)
+    return 200, [b'{"status": "done", "job_id": "' + job_id.encode('utf-8') + b'"}']
+
+async def get_results(request, job_id):
+    """Handler of /api/get_results/<job_id>, ?wait=<seconds> awaits the job"""
+    logger.info("Getting results for job_id: %s", job_id)
+    wait = request.wait_seconds()
+    if wait > 0:
+        await wait_for_job(job_id, wait)
+    return _result_parts(job_id, timings=request.args.get('timings') == '1')
+
+def _call_wsgi(scope, body):
+    """Runs the Flask app for a request (in a thread), returns its status, headers and body"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('',))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ and\
+            name.startswith('HTTP_') else value
+    response = {}
+
+    def start_response(status, headers, exc_info=None): # pylint: disable=unused-argument
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                               for name, value in headers]
+
+    iterable = webserver.wsgi_app(environ, start_response)
+    try:
+        body = b''.join(iterable)
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+    return response['status'], response['headers'], body
+
+async def send_json(request, send, status, parts, headers=()):
+    """Sends encoded JSON parts, compressed and streamed like routes.json_response"""
+    encoding_headers, body = encode_json(parts, request.headers.get('accept-encoding', ''))
+    headers = [(b'content-type', b'application/json')] +\
+        [(name.lower().encode('latin-1'), value.encode('latin-1'))
+         for name, value in encoding_headers.items()] + list(headers)
+
+    if isinstance(body, bytes):
+        headers.append((b'content-length', str(len(body)).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+        return
+
+    # without a content-length the server sends the body with chunked transfer encoding
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    for chunk in body:
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # the same as /api/graceful_shutdown, in a thread (it waits for the workers)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, webserver.data_reloader.close)
+            await loop.run_in_executor(None, webserver.tasks_runner.graceful_shutdown)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    """The ASGI application"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    start = time.monotonic()
+    body = await _read_body(receive)
+    request = Request(scope, body)
+    path = request.path
+    if request.method == 'POST' and path in JOB_ENDPOINTS:
+        endpoint, handler = path, functools.partial(submit_job, request, JOB_ENDPOINTS[path])
+    elif request.method == 'GET' and path.startswith('/api/get_results/'):
+        endpoint = '/api/get_results/<job_id>'
+        handler = functools.partial(get_results, request, path[len('/api/get_results/'):])
+    else:
+        # every other route is served by the Flask app (which records its own metrics)
+        status, headers, response_body = await asyncio.get_running_loop().run_in_executor(
+            None, _call_wsgi, scope, body)
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': response_body})
+        return
+
+    headers = []
+    try:
+        status, parts = await handler()
+    except HTTPError as error:
+        status, headers = error.status, error.headers
+        parts = [json.dumps({"status": "error", "reason": error.reason}).encode('utf-8')]
+    await send_json(request, send, status, parts, headers)
+    metrics.HTTP_LATENCY.observe(time.monotonic() - start, endpoint)
+    metrics.HTTP_REQUESTS.inc(endpoint, str(status))
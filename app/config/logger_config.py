@@ -1,9 +1,31 @@
 """This module contains the configuration for the logger."""
 
+import atexit
+import itertools
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from queue import SimpleQueue
+import os
 import time
 
+# high-volume messages, only one in LOG_SAMPLE_EVERY of them is logged
+SAMPLED_MESSAGES = ("Received request", "Getting results")
+
+# listener writing the records queued by the request and worker threads
+_listener = None
+
+def _stop_listener():
+    """Function writing the records still queued, stopping the listener
+    and closing its handlers (the log file)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+atexit.register(_stop_listener)
+
 class UTCFormatter(logging.Formatter):
     """This class is used to format the time in UTC."""
 
@@ -31,16 +53,56 @@ class UTCFormatter(logging.Formatter):
                 s = "0000-00-00 00:00:00,000"
         return s
 
-def setup_logger():
-    """Function to setup the logger."""
+class SamplingFilter(logging.Filter):
+    """This class is used to keep only one in every n of the high-volume messages."""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        # next() on itertools.count is atomic, no lock is needed
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        if isinstance(record.msg, str) and record.msg.startswith(SAMPLED_MESSAGES):
+            return next(self.counter) % self.every == 0
+        return True
+
+class DeferredQueueHandler(QueueHandler):
+    """This class is used to queue the records as they are, so that the message is
+    formatted by the listener thread instead of the thread logging it."""
+
+    def prepare(self, record):
+        return record
+
+def setup_logger(filename='webserver.log', mode=None, max_bytes=None, sample_every=None):
+    """Function to setup the logger.
+    mode (LOG_MODE): 'queue' formats and writes the records on a background thread,
+    'sync' does it in the thread logging them. max_bytes (LOG_MAX_BYTES) is the size at
+    which the file is rotated and sample_every (LOG_SAMPLE_EVERY) the sampling rate of
+    the SAMPLED_MESSAGES."""
+    global _listener
+    if mode is None:
+        mode = os.getenv('LOG_MODE', 'queue')
+    if max_bytes is None:
+        max_bytes = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+    if sample_every is None:
+        sample_every = int(os.getenv('LOG_SAMPLE_EVERY', '1'))
+
     logger = logging.getLogger(__name__)
     # can now accept only info, warning, error, and critical messages
     logger.setLevel(logging.INFO)
 
-    # file handler: maximum size of 1000 bytes and maximum of 5 log files
-    handler = RotatingFileHandler('webserver.log',
-                                  maxBytes=1000,
-                                  backupCount=5
+    # setting the logger up again replaces its handlers
+    _stop_listener()
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+        old_handler.close()
+    logger.filters.clear()
+
+    # file handler: rotated at max_bytes, maximum of 5 log files
+    handler = RotatingFileHandler(filename,
+                                  maxBytes=max_bytes,
+                                  backupCount=int(os.getenv('LOG_BACKUP_COUNT', '5'))
                                   )
     # formatter: date and time, log level, and the message
     formatter = UTCFormatter(fmt='%(asctime)s - %(levelname)s - %(message)s',
@@ -48,6 +110,16 @@ def setup_logger():
 
     handler.setFormatter(formatter)
 
-    logger.addHandler(handler)
+    if sample_every > 1:
+        # filtering on the logger drops the records before they are queued
+        logger.addFilter(SamplingFilter(sample_every))
+
+    if mode == 'queue':
+        records = SimpleQueue()
+        logger.addHandler(DeferredQueueHandler(records))
+        _listener = QueueListener(records, handler)
+        _listener.start()
+    else:
+        logger.addHandler(handler)
 
     return logger
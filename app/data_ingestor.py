@@ -1,29 +1,243 @@
 """This module contains the DataIngestor class which is
 used to ingest data from a CSV file."""
 
-import csv
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from threading import Lock
+import numpy as np
+import pandas as pd
+from app.aggregates import Aggregates, NO_YEAR
+
+# columns stored as dictionary-encoded integer codes
+STRING_COLUMNS = ('Question', 'LocationDesc', 'StratificationCategory1', 'Stratification1',
+                  'LocationAbbr')
+# columns stored as float64 arrays
+NUMERIC_COLUMNS = ('Data_Value',)
+# columns stored as int32 arrays (NO_YEAR when missing), used for partitioning the aggregates
+YEAR_COLUMNS = ('YearStart', 'YearEnd')
+# columns that may be missing from the CSV and from the appended rows
+# (empty strings or NO_YEAR), they are only used by /api/query and the year ranges
+OPTIONAL_COLUMNS = ('LocationAbbr',) + YEAR_COLUMNS
 
 class DataIngestor:
-    """Class used to ingest data from a CSV file."""
+    """Class used to ingest data from a CSV file into a columnar, typed store."""
+
+    def __init__(self, csv_path: str, snapshot_dir: str = None, chunk_rows: int = None):
+        # column name -> numpy array (codes for string columns, values for numeric ones)
+        self.columns = {}
+        # column name -> list of distinct strings, indexed by their code
+        self.dictionaries = {name: [] for name in STRING_COLUMNS}
+        # column name -> {string: code}, used to translate request parameters
+        self.codes = {name: {} for name in STRING_COLUMNS}
+        # version of the dataset, increased by every reload (see DataReloader)
+        self.version = 0
+        # appended batches of columns, concatenated to self.columns when they are read
+        self.pending = []
+        self.append_lock = Lock() # appends are applied one at a time
+
+        self.aggregates = Aggregates()
 
-    def __init__(self, csv_path: str):
-        self.data = []
-        with open(file=csv_path, newline='', encoding="utf-8") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                self.data.append(row)
+        start = time.monotonic()
+        if chunk_rows:
+            # streaming mode: the CSV is read in chunks of chunk_rows rows that are folded
+            # into the aggregate tables and dropped, memory depends only on the number of
+            # groups; the rows are not kept, self.columns stays empty
+            self.num_rows = 0
+            for columns in self._read_csv(csv_path, chunk_rows):
+                self.num_rows += len(columns['Data_Value'])
+                self.aggregates.fold(columns, self.dictionaries)
+        else:
+            # with a snapshot directory, the columns parsed from the CSV are saved as .npy
+            # files and later startups memory-map them instead of parsing the CSV again
+            snapshot_path = None
+            if snapshot_dir:
+                snapshot_path = os.path.join(snapshot_dir, _snapshot_name(csv_path))
+            if snapshot_path and os.path.exists(os.path.join(snapshot_path,
+                                                             'dictionaries.json')):
+                self._load_snapshot(snapshot_path)
+            else:
+                self.columns = next(self._read_csv(csv_path))
+                if snapshot_path:
+                    self._save_snapshot(snapshot_path)
+            self.num_rows = len(self.columns['Data_Value'])
 
-        self.questions_best_is_min = [
+            # the data does not change after startup, so the sums and counts
+            # needed by the API are computed only once
+            self.aggregates.fold(self.columns, self.dictionaries)
+        # time spent parsing (or mapping) the data and building the aggregates
+        self.ingest_seconds = time.monotonic() - start
+
+        # sets, the direction of a question is found in O(1)
+        self.questions_best_is_min = frozenset([
             'Percent of adults aged 18 years and older who have an overweight classification',
             'Percent of adults aged 18 years and older who have obesity',
             'Percent of adults who engage in no leisure-time physical activity',
             'Percent of adults who report consuming fruit less than one time daily',
             'Percent of adults who report consuming vegetables less than one time daily'
-        ]
+        ])
 
-        self.questions_best_is_max = [
+        self.questions_best_is_max = frozenset([
             'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
             'Percent of adults who achieve at least 150 minutes a week of moderate-intensity aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic physical activity and engage in muscle-strengthening activities on 2 or more days a week',
             'Percent of adults who achieve at least 300 minutes a week of moderate-intensity aerobic physical activity or 150 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)',
             'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
-        ]
+        ])
+
+    def _read_csv(self, csv_path, chunk_rows=None):
+        """Generator of the typed columns of the CSV (all rows or chunks of chunk_rows rows)"""
+        frames = _parse_csv(csv_path, chunk_rows)
+        for frame in (frames if chunk_rows else [frames]):
+            yield self._encode_frame(frame)
+
+    def _encode_frame(self, frame):
+        columns = {}
+        for name in STRING_COLUMNS:
+            columns[name] = self.encode(name, frame[name] if name in frame
+                                        else np.full(len(frame), ''))
+        for name in NUMERIC_COLUMNS:
+            # values that are not numbers become NaN
+            columns[name] = pd.to_numeric(frame[name], errors='coerce')\
+                .to_numpy(dtype=np.float64)
+        for name in YEAR_COLUMNS:
+            if name in frame:
+                years = pd.to_numeric(frame[name], errors='coerce')
+                columns[name] = years.fillna(NO_YEAR).to_numpy(dtype=np.int32)
+            else:
+                columns[name] = np.full(len(frame), NO_YEAR, dtype=np.int32)
+        return columns
+
+    def append(self, frame: pd.DataFrame) -> set:
+        """Method to add new rows (a DataFrame having the columns of the CSV) to the data.
+        Only the sums and counts of the rows' groups are updated, the cost depends on the
+        size of the batch and not on the size of the data.
+        Returns the set of questions whose results changed."""
+        # rows without years are only in the results without a year range
+        missing = [name for name in STRING_COLUMNS + NUMERIC_COLUMNS
+                   if name not in frame and name not in OPTIONAL_COLUMNS]
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(missing)}")
+        frame = frame.copy()
+        for name in STRING_COLUMNS:
+            if name not in frame:
+                continue
+            # same as the CSV parser: missing strings are empty, the others are kept as text
+            frame[name] = frame[name].fillna('').astype(str)
+        with self.append_lock:
+            columns = self._encode_frame(frame)
+            if self.columns:
+                self.pending.append(columns)
+            self.num_rows += len(frame)
+            return self.aggregates.fold(columns, self.dictionaries)
+
+    def append_csv(self, csv_file) -> set:
+        """Method to add the rows of a CSV file (path or file object) to the data"""
+        return self.append(_parse_csv(csv_file))
+
+    def get_columns(self) -> dict:
+        """Method returning the columns of all the rows, appended ones included"""
+        with self.append_lock:
+            if self.pending:
+                self.columns = {name: np.concatenate([self.columns[name]] +
+                                                     [batch[name] for batch in self.pending])
+                                for name in self.columns}
+                self.pending = []
+            return self.columns
+
+    def after_fork(self):
+        """Method called in a forked worker process (see ThreadPool.share), the append lock
+        may have been held by another thread of the parent when it was copied"""
+        self.append_lock = Lock()
+
+    def _load_snapshot(self, snapshot_path):
+        for name in STRING_COLUMNS + NUMERIC_COLUMNS + YEAR_COLUMNS:
+            # the pages are shared (page cache) by all the processes mapping the snapshot
+            self.columns[name] = np.load(os.path.join(snapshot_path, name + '.npy'),
+                                         mmap_mode='r')
+        with open(os.path.join(snapshot_path, 'dictionaries.json'), encoding="utf-8") as file:
+            self.dictionaries = json.load(file)
+        self.codes = {name: {value: code for code, value in enumerate(dictionary)}
+                      for name, dictionary in self.dictionaries.items()}
+
+    def _save_snapshot(self, snapshot_path):
+        # writing in a temporary directory first, other processes never see half a snapshot
+        temporary_path = f"{snapshot_path}.tmp-{os.getpid()}"
+        os.makedirs(temporary_path, exist_ok=True)
+        for name, column in self.columns.items():
+            np.save(os.path.join(temporary_path, name + '.npy'), column)
+        # the dictionaries are written last, their presence marks a complete snapshot
+        with open(os.path.join(temporary_path, 'dictionaries.json'), 'w',
+                  encoding="utf-8") as file:
+            json.dump(self.dictionaries, file)
+        try:
+            os.rename(temporary_path, snapshot_path)
+        except OSError:
+            # another process saved the same snapshot in the meantime
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            return
+        _remove_old_snapshots(snapshot_path)
+
+    def __len__(self):
+        return self.num_rows
+
+    def encode(self, column: str, values) -> np.ndarray:
+        """Method to translate string values of a column into integer codes.
+        New strings are added to the column's dictionary."""
+        local_codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        # mapping the codes of this batch to the codes of the whole store
+        mapping = np.array([self._add_string(column, value) for value in uniques],
+                           dtype=np.int32)
+        if len(mapping) == 0:
+            return np.empty(0, dtype=np.int32)
+        return mapping[local_codes]
+
+    def code_of(self, column: str, value: str) -> int:
+        """Method to get the code of a string value (-1 if the value is not in the data)."""
+        return self.codes[column].get(value, -1)
+
+    def decode(self, column: str, codes) -> list:
+        """Method to translate integer codes of a column back into strings."""
+        dictionary = self.dictionaries[column]
+        return [dictionary[code] for code in codes]
+
+    def _add_string(self, column, value):
+        code = self.codes[column].get(value)
+        if code is None:
+            code = len(self.dictionaries[column])
+            self.codes[column][value] = code
+            self.dictionaries[column].append(value)
+        return code
+
+def _parse_csv(csv_file, chunk_rows=None):
+    # reading only the columns the API uses (the optional ones may be missing);
+    # strings are kept as they are ('' included)
+    used = set(STRING_COLUMNS + NUMERIC_COLUMNS + YEAR_COLUMNS)
+    return pd.read_csv(csv_file, usecols=lambda name: name in used,
+                       dtype={name: str for name in STRING_COLUMNS},
+                       keep_default_na=False,
+                       na_values={name: [''] for name in NUMERIC_COLUMNS + YEAR_COLUMNS},
+                       float_precision='round_trip', encoding="utf-8",
+                       chunksize=chunk_rows)
+
+def _snapshot_name(csv_path):
+    """Name of the snapshot of a CSV file, derived from its content hash and mtime
+    (and from the columns kept, so snapshots of an older layout are not used)"""
+    digest = hashlib.sha256(str(os.stat(csv_path).st_mtime_ns).encode())
+    digest.update(json.dumps(STRING_COLUMNS + NUMERIC_COLUMNS + YEAR_COLUMNS).encode())
+    with open(csv_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return f"{name}-{digest.hexdigest()[:16]}"
+
+def _remove_old_snapshots(snapshot_path):
+    """Deletes the other snapshots of the same CSV file (older versions of its content).
+    Processes still mapping their files keep reading them until they unmap them"""
+    snapshot_dir, snapshot_name = os.path.split(snapshot_path)
+    pattern = re.compile(re.escape(snapshot_name.rsplit('-', 1)[0]) + r'-[0-9a-f]{16}')
+    for entry in os.listdir(snapshot_dir or '.'):
+        if entry != snapshot_name and pattern.fullmatch(entry):
+            shutil.rmtree(os.path.join(snapshot_dir, entry), ignore_errors=True)
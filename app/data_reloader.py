@@ -0,0 +1,111 @@
+"""This module contains the DataReloader class which is used to
+ingest a new version of the dataset without restarting the webserver."""
+
+from threading import Thread, Lock, Event
+import os
+import time
+
+class DataReloader:
+    """Class used for loading a dataset in a background thread and swapping it in
+    once it is ready. The requests keep using the current data while the new one loads."""
+    def __init__(self, csv_path: str, load_callback, swap_callback, interval=None,
+                 data_dir=None):
+        self.csv_path = csv_path
+        # the only directory a reload can read a new CSV file from
+        # (DATA_DIR, by default the directory of the current CSV)
+        self.data_dir = os.path.realpath(data_dir or os.getenv('DATA_DIR') or
+                                         os.path.dirname(csv_path) or '.')
+        self.load = load_callback # csv path -> DataIngestor, with its aggregates built
+        self.swap = swap_callback # installs the loaded DataIngestor
+        self.lock = Lock() # used for controlling access to the status
+        self.loader = None # thread loading a dataset, None when idle
+        self.status = {"status": "idle", "version": 0, "csv_path": csv_path,
+                       "loaded_at": time.time(), "error": None}
+
+        # with DATA_RELOAD_INTERVAL, the CSV file is checked every that many seconds
+        # and reloaded when it changes
+        if interval is None:
+            interval = float(os.getenv('DATA_RELOAD_INTERVAL', '0'))
+        self.interval = interval
+        self.stop_event = Event()
+        self.watcher = None
+        if interval > 0:
+            self.watcher = Thread(target=self._watch, daemon=True)
+            self.watcher.start()
+
+    def reload(self, csv_path=None) -> bool:
+        """Method starting to load a dataset (the current CSV path by default).
+        Returns False if a dataset is already being loaded, raises ValueError
+        when csv_path is not a CSV file of the data directory"""
+        if csv_path is not None:
+            csv_path = self._check_path(csv_path)
+        with self.lock:
+            if self.loader is not None:
+                return False
+            csv_path = csv_path or self.csv_path
+            self.status.update({"status": "loading", "error": None})
+            self.loader = Thread(target=self._load, args=(csv_path,), daemon=True)
+            self.loader.start()
+            return True
+
+    def _check_path(self, csv_path):
+        """Method returning the real path of a CSV file given by a client, which must be
+        a regular .csv file of the data directory (not a device or a file elsewhere)"""
+        if not isinstance(csv_path, str):
+            raise ValueError("csv_path must be a string")
+        path = os.path.realpath(os.path.join(self.data_dir, csv_path))
+        if os.path.commonpath([path, self.data_dir]) != self.data_dir or\
+                not os.path.isfile(path) or not path.lower().endswith('.csv'):
+            raise ValueError("csv_path must be a CSV file of the data directory")
+        return path
+
+    def wait(self, timeout=None):
+        """Method blocking until the dataset being loaded is swapped in (or fails)"""
+        with self.lock:
+            loader = self.loader
+        if loader is not None:
+            loader.join(timeout)
+
+    def get_status(self):
+        """Method returning the status of the loader and the version being served"""
+        with self.lock:
+            return dict(self.status)
+
+    def close(self):
+        """Method stopping the file watcher"""
+        self.stop_event.set()
+
+    def _load(self, csv_path):
+        try:
+            # parsing and folding the aggregates happen here, off the request path
+            ingestor = self.load(csv_path)
+        except Exception as error:
+            with self.lock:
+                self.status.update({"status": "failed", "error": str(error)})
+                self.loader = None
+            return
+        with self.lock:
+            ingestor.version = self.status["version"] + 1
+            # jobs already queued hold the previous ingestor and finish on it
+            self.swap(ingestor)
+            self.csv_path = csv_path
+            self.status.update({"status": "idle", "version": ingestor.version,
+                                "csv_path": csv_path, "loaded_at": time.time()})
+            self.loader = None
+
+    def _watch(self):
+        last_path, last_mtime = self.csv_path, _mtime(self.csv_path)
+        while not self.stop_event.wait(self.interval):
+            path = self.csv_path
+            mtime = _mtime(path)
+            if path != last_path:
+                # a different file was loaded through reload(csv_path)
+                last_path, last_mtime = path, mtime
+            elif mtime is not None and mtime != last_mtime and self.reload():
+                last_mtime = mtime
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
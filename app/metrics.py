@@ -0,0 +1,152 @@
+"""This module contains the metrics of the webserver (counters, gauges and histograms)
+and their rendering in the Prometheus text format, served at /metrics."""
+
+from bisect import bisect_left
+from threading import Lock
+
+# upper bounds (seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base class of the metrics: a value (or a set of values) for each combination
+    of label values. Updates take a short lock, so they cost little on the hot path"""
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {} # label values -> value
+        self.lock = Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        """Method returning the lines of the metric in the Prometheus text format"""
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} '
+                         f'{_format_value(value)}')
+        return lines
+
+class Counter(Metric):
+    """Class used for values that only increase (number of jobs, seconds spent...)"""
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        """Method adding amount to the value of the labels"""
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def set(self, value, *label_values):
+        """Method used for counters kept by another object (copied when /metrics is read)"""
+        with self.lock:
+            self.values[label_values] = value
+
+class Gauge(Metric):
+    """Class used for values that go up and down (queue depth, busy workers...)"""
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        """Method replacing the value of the labels"""
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        """Method adding amount to the value of the labels"""
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        """Method subtracting amount from the value of the labels"""
+        self.inc(*label_values, amount=-amount)
+
+class Histogram(Metric):
+    """Class used for distributions of durations, counted in cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        """Method counting a value (seconds) in its bucket"""
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                # [count of each bucket (the last one is +Inf), sum]
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bucket] += 1
+            entry[1] += value
+
+    def render(self):
+        """Method returning the cumulative buckets, the sum and the count of each label set"""
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = [(label_values, list(counts), total)
+                      for label_values, (counts, total) in self.values.items()]
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+# every metric created, in order
+REGISTRY = []
+
+def render_metrics() -> str:
+    """Function returning every metric in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# requests
+HTTP_REQUESTS = Counter('http_requests_total', 'Requests answered, by endpoint and status code',
+                        ('endpoint', 'code'))
+HTTP_LATENCY = Histogram('http_request_duration_seconds', 'Time spent answering a request',
+                         ('endpoint',))
+
+# jobs (label task: name of the function computing the job)
+JOBS_SUBMITTED = Counter('tp_jobs_submitted_total', 'Jobs queued', ('task',))
+JOBS_FINISHED = Counter('tp_jobs_finished_total', 'Jobs finished, by status', ('task', 'status'))
+QUEUE_WAIT = Histogram('tp_queue_wait_seconds', 'Time a job waits in the queue', ('task',))
+COMPUTE_TIME = Histogram('tp_compute_seconds', 'Time spent computing a job', ('task',))
+SERIALIZATION_TIME = Histogram('tp_serialization_seconds',
+                               'Time spent serializing the result of a job', ('task',))
+
+# thread pool (set when /metrics is read, except for the busy workers)
+QUEUE_DEPTH = Gauge('tp_queue_depth', 'Jobs waiting in the queue, by lane', ('lane',))
+WORKERS = Gauge('tp_workers', 'Worker threads')
+BUSY_WORKERS = Gauge('tp_busy_workers', 'Worker threads running a job')
+BUSY_TIME = Counter('tp_worker_busy_seconds_total', 'Time the worker threads spent running jobs')
+JOBS = Gauge('tp_jobs', 'Jobs in the job table, by status', ('status',))
+
+# result cache (copied from its counters when /metrics is read)
+CACHE_EVENTS = Counter('cache_events_total', 'Result cache counters (hits, misses, ...)',
+                       ('event',))
+CACHE_SIZE = Gauge('cache_size', 'Result cache size and limits (entries, bytes)', ('kind',))
+
+# ingestion
+INGEST_DURATION = Gauge('data_ingest_seconds', 'Time spent ingesting the current dataset')
+DATA_ROWS = Gauge('data_rows', 'Rows of the current dataset')
@@ -0,0 +1,243 @@
+"""This module contains the query engine of /api/query: a declarative spec (filters,
+group by, aggregates, order, limit) is compiled into a Query, whose plan is run as
+vectorized numpy operations over the typed columns of the DataIngestor."""
+
+import math
+import numpy as np
+from app.aggregates import NO_YEAR
+from app.data_ingestor import DataIngestor, STRING_COLUMNS, NUMERIC_COLUMNS, YEAR_COLUMNS
+from app.result_cache import ALL_QUESTIONS
+
+FILTER_OPS = ('==', '!=', '<', '<=', '>', '>=', 'in', 'not in')
+# operators of the string columns, compared by code (the order of the codes is meaningless)
+STRING_OPS = ('==', '!=', 'in', 'not in')
+AGGREGATE_FUNCTIONS = ('mean', 'min', 'max', 'count', 'sum')
+
+class QueryError(ValueError):
+    """Exception raised for an invalid query spec (answered with 400)"""
+
+def _check(condition, message):
+    if not condition:
+        raise QueryError(message)
+
+class Query:
+    """Class used for a compiled query spec:
+    {"filters": [{"column": ..., "op": "==", "value": ...}, ...],
+     "group_by": [column, ...],
+     "aggregates": [{"fn": "mean", "column": "Data_Value", "as": "mean"}, ...],
+     "order_by": [{"column": group by column or aggregate name, "desc": false}, ...],
+     "limit": n, "offset": n}
+    Every key is optional; by default the mean of Data_Value is computed and the groups
+    are sorted by their values. Rows whose filtered or aggregated value is missing
+    (empty Data_Value, no year) never match a filter and are not aggregated."""
+
+    def __init__(self, spec: dict):
+        _check(isinstance(spec, dict), "Expected a query object")
+        unknown = set(spec) - {'filters', 'group_by', 'aggregates', 'order_by', 'limit',
+                               'offset'}
+        _check(not unknown, f"Unknown query keys: {', '.join(sorted(unknown))}")
+
+        # [(column, op, value)], string values are translated to codes when run
+        self.filters = []
+        filters = spec.get('filters', [])
+        _check(isinstance(filters, list), "filters must be a list")
+        for entry in filters:
+            _check(isinstance(entry, dict) and 'column' in entry and 'value' in entry,
+                   "A filter needs a column and a value")
+            column, op, value = entry['column'], entry.get('op', '=='), entry['value']
+            _check(column in STRING_COLUMNS + NUMERIC_COLUMNS + YEAR_COLUMNS,
+                   f"Unknown column: {column}")
+            _check(op in FILTER_OPS, f"Unknown filter operator: {op}")
+            if column in STRING_COLUMNS:
+                _check(op in STRING_OPS, f"Operator {op} is not supported for {column}")
+            values = value if op in ('in', 'not in') else [value]
+            _check(op not in ('in', 'not in') or isinstance(value, list),
+                   f"The value of {op} must be a list")
+            kind = str if column in STRING_COLUMNS else (int, float)
+            _check(all(isinstance(item, kind) and not isinstance(item, bool)
+                       for item in values), f"Invalid value for {column}")
+            self.filters.append((column, op, value))
+
+        self.group_by = spec.get('group_by', [])
+        _check(isinstance(self.group_by, list), "group_by must be a list")
+        for column in self.group_by:
+            _check(column in STRING_COLUMNS + YEAR_COLUMNS,
+                   f"Cannot group by: {column}")
+        _check(len(set(self.group_by)) == len(self.group_by), "Duplicate group_by columns")
+
+        # [(function, column, output name)]
+        self.aggregates = []
+        aggregates = spec.get('aggregates', ['mean'])
+        _check(isinstance(aggregates, list), "aggregates must be a list")
+        for entry in aggregates:
+            if isinstance(entry, str):
+                entry = {'fn': entry}
+            _check(isinstance(entry, dict), "An aggregate is a name or an object")
+            function = entry.get('fn')
+            column = entry.get('column', 'Data_Value')
+            _check(function in AGGREGATE_FUNCTIONS, f"Unknown aggregate: {function}")
+            _check(column in NUMERIC_COLUMNS + YEAR_COLUMNS, f"Cannot aggregate: {column}")
+            name = entry.get('as', function if column == 'Data_Value' else
+                             f"{function}_{column}")
+            _check(isinstance(name, str), f"The name of an aggregate must be a string: {name}")
+            self.aggregates.append((function, column, name))
+        names = self.group_by + [name for _, _, name in self.aggregates]
+        _check(len(self.aggregates) > 0, "At least one aggregate is needed")
+        _check(len(set(names)) == len(names), "Duplicate output columns")
+        self.names = names
+
+        # [(output column, descending)], by default the group by columns in order
+        self.order_by = []
+        order_by = spec.get('order_by', self.group_by)
+        _check(isinstance(order_by, list), "order_by must be a list")
+        for entry in order_by:
+            if isinstance(entry, str):
+                entry = {'column': entry}
+            _check(isinstance(entry, dict) and entry.get('column') in names,
+                   f"Cannot order by: {entry}")
+            self.order_by.append((entry['column'], bool(entry.get('desc', False))))
+
+        self.limit = spec.get('limit')
+        self.offset = spec.get('offset', 0)
+        for name, value in (('limit', self.limit), ('offset', self.offset)):
+            _check(value is None or (isinstance(value, int) and not isinstance(value, bool)
+                                     and value >= 0), f"{name} must be a non-negative integer")
+
+    def cache_tags(self) -> frozenset:
+        """Method returning the questions the result depends on (see ResultCache)"""
+        for column, op, value in self.filters:
+            if column == 'Question' and op in ('==', 'in'):
+                return frozenset(value if op == 'in' else [value])
+        return frozenset([ALL_QUESTIONS])
+
+    def run(self, ingestor: DataIngestor) -> dict:
+        """Method running the plan on the rows of the ingestor:
+        filter mask -> group ids -> aggregates per group -> order -> limit"""
+        columns = ingestor.get_columns()
+        _check(bool(columns), "Queries are not available in streaming mode")
+
+        mask = self._filter(ingestor, columns)
+        group_ids, group_values = self._group(columns, mask)
+        # without group by, all the selected rows are a single group (even when empty)
+        num_groups = len(group_values[0]) if self.group_by else 1
+
+        results = [group_values[index] for index in range(len(self.group_by))]
+        for function, column, _ in self.aggregates:
+            results.append(_aggregate(function, columns[column][mask], group_ids, num_groups,
+                                      column in YEAR_COLUMNS))
+
+        order = self._order(ingestor, results, num_groups)
+        order = order[self.offset:None if self.limit is None else self.offset + self.limit]
+
+        # counts and years are integers (except the mean of the years)
+        integers = {name for function, column, name in self.aggregates
+                    if function == 'count' or (column in YEAR_COLUMNS and function != 'mean')}
+        output = []
+        for name, values in zip(self.names, results):
+            values = values[order]
+            if name in self.group_by and name in STRING_COLUMNS:
+                output.append(ingestor.decode(name, values.tolist()))
+            elif name in self.group_by:
+                output.append([None if year == NO_YEAR else year for year in values.tolist()])
+            else:
+                # groups without values have a NaN mean/min/max, sent as null
+                output.append([None if math.isnan(value) else
+                               int(value) if name in integers else value
+                               for value in values.astype(np.float64).tolist()])
+        return {"columns": self.names, "rows": [list(row) for row in zip(*output)]}
+
+    def _filter(self, ingestor, columns):
+        """Boolean mask of the rows matching every filter"""
+        mask = np.ones(len(columns['Data_Value']), dtype=bool)
+        for column, op, value in self.filters:
+            values = columns[column]
+            if column in STRING_COLUMNS:
+                # strings that are not in the data have no code and match no row
+                if op in ('in', 'not in'):
+                    codes = [ingestor.code_of(column, item) for item in value]
+                    matched = np.isin(values, [code for code in codes if code >= 0])
+                else:
+                    matched = values == ingestor.code_of(column, value)
+                mask &= ~matched if op in ('!=', 'not in') else matched
+                continue
+            if op in ('in', 'not in'):
+                matched = np.isin(values, value)
+                matched = ~matched if op == 'not in' else matched
+            else:
+                matched = _COMPARISONS[op](values, value)
+            # missing values never match (like NULL in SQL)
+            mask &= matched & (values != NO_YEAR if column in YEAR_COLUMNS
+                               else ~np.isnan(values))
+        return mask
+
+    def _group(self, columns, mask):
+        """Group id of each selected row and the values of the group by columns
+        of each group (groups in the order of their codes)"""
+        selected = [np.asarray(columns[column])[mask] for column in self.group_by]
+        if not selected:
+            return np.zeros(int(mask.sum()), dtype=np.intp), []
+        # the columns are combined into a single integer key, so that grouping is one
+        # np.unique over integers instead of a sort of tuples
+        uniques, codes = [], []
+        for values in selected:
+            column_uniques, column_codes = np.unique(values, return_inverse=True)
+            uniques.append(column_uniques)
+            codes.append(column_codes.reshape(-1))
+        keys = np.ravel_multi_index(codes, [len(values) for values in uniques])\
+            if codes[0].size else np.zeros(0, dtype=np.intp)
+        group_keys, group_ids = np.unique(keys, return_inverse=True)
+        group_codes = np.unravel_index(group_keys, [len(values) for values in uniques])
+        return group_ids.reshape(-1), [column_uniques[indexes] for column_uniques, indexes
+                                       in zip(uniques, group_codes)]
+
+    def _order(self, ingestor, results, num_groups):
+        """Indexes of the groups in the order of order_by"""
+        if not self.order_by:
+            return np.arange(num_groups)
+        sort_keys = []
+        for name, descending in self.order_by:
+            values = results[self.names.index(name)]
+            if name in self.group_by and name in STRING_COLUMNS:
+                # codes are sorted by their strings through the rank of each code
+                dictionary = ingestor.dictionaries[name]
+                ranks = np.empty(len(dictionary), dtype=np.int64)
+                ranks[np.argsort(np.array(dictionary, dtype=object), kind='stable')] =\
+                    np.arange(len(dictionary))
+                values = ranks[values]
+            values = values.astype(np.float64)
+            sort_keys.append(-values if descending else values)
+        # np.lexsort sorts by the last key first (NaN last in both directions)
+        return np.lexsort(sort_keys[::-1])
+
+_COMPARISONS = {
+    '==': np.equal, '!=': np.not_equal, '<': np.less, '<=': np.less_equal,
+    '>': np.greater, '>=': np.greater_equal,
+}
+
+def _aggregate(function, values, group_ids, num_groups, is_year):
+    """Aggregate of the values of each group, vectorized with np.bincount (sums, counts)
+    and ufunc.reduceat over the values sorted by group (min, max)"""
+    valid = values != NO_YEAR if is_year else ~np.isnan(values)
+    values = values[valid].astype(np.float64)
+    group_ids = group_ids[valid]
+    counts = np.bincount(group_ids, minlength=num_groups)
+    if function == 'count':
+        return counts
+    if function in ('sum', 'mean'):
+        sums = np.bincount(group_ids, weights=values, minlength=num_groups)
+        if function == 'sum':
+            return sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+    result = np.full(num_groups, np.nan)
+    order = np.argsort(group_ids, kind='stable')
+    non_empty = np.flatnonzero(counts)
+    if len(non_empty):
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty]
+        ufunc = np.minimum if function == 'min' else np.maximum
+        result[non_empty] = ufunc.reduceat(values[order], starts)
+    return result
+
+def run_query(ingestor: DataIngestor, spec: dict) -> dict:
+    """Helper function running a query spec (/api/query)"""
+    return Query(spec).run(ingestor)
@@ -0,0 +1,91 @@
+"""This module contains the Ranking class: the states of a question sorted by their mean,
+kept by Aggregates and rebuilt only when the question's rows change, so that the top or
+bottom k states and the rank of a state are read without sorting (/api/rank, best5, worst5)."""
+
+import heapq
+from itertools import islice
+
+# directions of a ranking: "best" and "worst" depend on the question (see DataIngestor)
+ORDERS = ('best', 'worst', 'asc', 'desc')
+# number of states returned when the request has no k
+DEFAULT_K = 5
+
+def rank_options(data) -> tuple:
+    """Function returning the (k, offset, order) of a ranking request,
+    raises ValueError when they are not valid"""
+    if not isinstance(data, dict) or not isinstance(data.get('question'), str):
+        raise ValueError("Missing question")
+    k, offset = data.get('k', DEFAULT_K), data.get('offset', 0)
+    for name, value in (('k', k), ('offset', offset)):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ValueError(f"{name} must be a non-negative integer")
+    order = data.get('order', 'best')
+    if order not in ORDERS:
+        raise ValueError(f"order must be one of {', '.join(ORDERS)}")
+    return k, offset, order
+
+class Ranking:
+    """Class used for the means of the states of a question in ascending order
+    (states having the same mean in the order they first appear in the data)"""
+
+    def __init__(self, states: dict):
+        # states: {state: [sum, count]}
+        ordered = sorted(((state, total / count) for state, (total, count) in states.items()),
+                         key=lambda item: item[1])
+        self.states = [state for state, _ in ordered]
+        self.means = [mean for _, mean in ordered]
+        # state -> index in the ascending order
+        self.positions = {state: index for index, state in enumerate(self.states)}
+
+    def __len__(self):
+        return len(self.states)
+
+    def items(self, descending=False):
+        """Iterator of the (state, mean) pairs in the given direction"""
+        if descending:
+            return zip(reversed(self.states), reversed(self.means))
+        return zip(self.states, self.means)
+
+    def top(self, k: int, offset: int = 0, descending=False) -> list:
+        """Method returning the k (state, mean) pairs after the first offset ones, O(k)"""
+        if descending:
+            end = max(len(self.states) - offset, 0)
+            start = max(end - k, 0)
+            return list(zip(self.states[start:end][::-1], self.means[start:end][::-1]))
+        return list(zip(self.states[offset:offset + k], self.means[offset:offset + k]))
+
+    def rank_of(self, state: str, descending=False):
+        """Method returning the rank (from 1) of a state, None if it has no mean, O(1)"""
+        position = self.positions.get(state)
+        if position is None:
+            return None
+        return len(self.states) - position if descending else position + 1
+
+def select(means: dict, k: int, offset: int = 0, descending=False) -> list:
+    """Function returning the k (state, mean) pairs after the first offset ones of means
+    computed for a single request (no presorted ranking), by partial selection in
+    O(n log(offset + k)) instead of a full sort; ties are in the same order as Ranking"""
+    if descending:
+        selected = heapq.nsmallest(offset + k, reversed(means.items()),
+                                   key=lambda item: -item[1])
+    else:
+        selected = heapq.nsmallest(offset + k, means.items(), key=lambda item: item[1])
+    return list(islice(selected, offset, None))
+
+def rank_in(means: dict, state: str, descending=False):
+    """Function returning the rank (from 1) of a state among means, in O(n)"""
+    if state not in means:
+        return None
+    target = means[state]
+    rank = 1
+    seen = False
+    for other, mean in means.items():
+        better = mean > target if descending else mean < target
+        if other == state:
+            seen = True
+        elif better:
+            rank += 1
+        elif mean == target and (seen if descending else not seen):
+            # ties keep the order of the data (reversed when descending)
+            rank += 1
+    return rank
@@ -0,0 +1,111 @@
+"""This module contains the ResultCache class which is used to
+reuse the results of identical requests."""
+
+from collections import OrderedDict
+from threading import Lock
+import json
+import os
+
+# tag of the results depending on the rows of every question (queries without a question
+# filter), dropped whenever rows are appended
+ALL_QUESTIONS = '*'
+
+def make_cache_key(endpoint: str, data, version: int = 0) -> tuple:
+    """Function building the cache key of a request: the endpoint, the canonical payload
+    and the version of the dataset it is computed on"""
+    return (endpoint, version, json.dumps(data, sort_keys=True, separators=(',', ':')))
+
+def cache_tags(data) -> frozenset:
+    """Function returning the questions a request depends on (also for batches),
+    used for invalidating its cached result when the question's data changes"""
+    requests = data.get('requests', [data]) if isinstance(data, dict) else data
+    if not isinstance(requests, list):
+        return frozenset()
+    return frozenset(request['question'] for request in requests
+                     if isinstance(request, dict) and isinstance(request.get('question'), str))
+
+class ResultCache:
+    """Class used for caching serialized results, evicting the least recently used
+    ones when the number of entries or their total size goes over the limits"""
+    def __init__(self, max_entries=None, max_bytes=None):
+        if max_entries is None:
+            max_entries = int(os.getenv('TP_CACHE_MAX_ENTRIES', '1024'))
+        if max_bytes is None:
+            max_bytes = int(os.getenv('TP_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> serialized result, least recently used first
+        self.size = 0 # total size of the cached results (bytes)
+        self.entry_tags = {} # key -> tags of the cached result
+        self.tagged = {} # tag -> keys of the cached results having it
+        self.lock = Lock()
+        # counters used for sizing the cache
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "coalesced": 0,
+                      "invalidations": 0}
+
+    def get(self, key):
+        """Method returning the cached result for key (None if it is not cached)"""
+        with self.lock:
+            payload = self.entries.get(key)
+            if payload is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return payload
+
+    def put(self, key, payload: bytes, tags=()):
+        """Method adding a serialized result to the cache, tags being what it depends on"""
+        size = len(payload)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = payload
+            self.size += size
+            if tags:
+                self.entry_tags[key] = tags
+                for tag in tags:
+                    self.tagged.setdefault(tag, set()).add(key)
+            # evicting the least recently used results
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def invalidate(self, tags):
+        """Method removing the cached results having any of the tags"""
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tagged.get(tag, ())):
+                    self._remove(key)
+                    self.stats["invalidations"] += 1
+
+    def _remove(self, key):
+        self.size -= len(self.entries.pop(key))
+        for tag in self.entry_tags.pop(key, ()):
+            keys = self.tagged[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tagged[tag]
+
+    def clear(self):
+        """Method removing every cached result (the counters are kept)"""
+        with self.lock:
+            self.entries.clear()
+            self.entry_tags.clear()
+            self.tagged.clear()
+            self.size = 0
+
+    def record_coalesced(self):
+        """Method counting a request attached to an identical job still running"""
+        with self.lock:
+            self.stats["coalesced"] += 1
+
+    def get_stats(self):
+        """Method returning the counters and the current size of the cache"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update({"entries": len(self.entries), "size_bytes": self.size,
+                          "max_entries": self.max_entries, "max_bytes": self.max_bytes})
+        return stats
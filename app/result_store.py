@@ -0,0 +1,104 @@
+"""This module contains the result stores used by ThreadPool
+to keep the serialized results of the jobs."""
+
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread
+import os
+
+class MemoryResultStore:
+    """Class used for keeping the serialized (JSON bytes) results in memory"""
+    def __init__(self):
+        self.results = {} # job id -> serialized result
+
+    def save(self, job_id: str, payload: bytes):
+        """Method to store the result of a job"""
+        self.results[job_id] = payload
+
+    def load(self, job_id: str):
+        """Method returning the result of a job (None if there is no result)"""
+        return self.results.get(job_id)
+
+    def delete(self, job_id: str):
+        """Method to remove the result of a job"""
+        self.results.pop(job_id, None)
+
+    def close(self):
+        """Method called when the thread pool shuts down"""
+
+class FileResultStore(MemoryResultStore):
+    """Class used for persisting the results in a directory. Files are written by a
+    background thread (write-behind), off the jobs' critical path; the results are served
+    from memory until then, and only the max_in_memory last written ones are kept there."""
+    def __init__(self, directory='results', max_in_memory=1000):
+        super().__init__()
+        self.directory = directory
+        self.max_in_memory = max_in_memory
+        self.written = OrderedDict() # ids of the written results still in memory, oldest first
+        self.pending = Queue() # (job id, payload) to be written, None to stop the writer
+        self.writer = Thread(target=self._write_files, daemon=True)
+        self.writer.start()
+
+    def save(self, job_id: str, payload: bytes):
+        super().save(job_id, payload)
+        self.pending.put((job_id, payload))
+
+    def load(self, job_id: str):
+        payload = super().load(job_id)
+        if payload is None:
+            # the result is not in memory anymore, reading it back from its file
+            try:
+                with open(os.path.join(self.directory, job_id), 'rb') as file:
+                    payload = file.read()
+            except OSError:
+                return None
+        return payload
+
+    def delete(self, job_id: str):
+        super().delete(job_id)
+        self.pending.put((job_id, None))
+
+    def flush(self):
+        """Method blocking until every saved result is written"""
+        self.pending.join()
+
+    def close(self):
+        # waiting for the writer to persist every result
+        self.pending.put(None)
+        self.writer.join()
+
+    def _write_files(self):
+        while True:
+            item = self.pending.get()
+            try:
+                if item is None:
+                    break
+                self._write_file(*item)
+            finally:
+                self.pending.task_done()
+
+    def _write_file(self, job_id, payload):
+        path = os.path.join(self.directory, job_id)
+        try:
+            if payload is None:
+                self.written.pop(job_id, None)
+                os.remove(path)
+            else:
+                with open(path, 'wb') as file:
+                    file.write(payload)
+        except OSError:
+            # the result is still served from memory
+            return
+        if payload is not None:
+            self.written[job_id] = True
+            # dropping the oldest written results from memory, they are read from their files
+            while len(self.written) > self.max_in_memory:
+                oldest_id, _ = self.written.popitem(last=False)
+                self.results.pop(oldest_id, None)
+
+def create_result_store():
+    """Function creating the result store selected by TP_RESULT_STORE (memory or file),
+    the file store keeping the TP_RESULTS_IN_MEMORY last results in memory"""
+    if os.getenv('TP_RESULT_STORE', 'memory') == 'file':
+        return FileResultStore(max_in_memory=int(os.getenv('TP_RESULTS_IN_MEMORY', '1000')))
+    return MemoryResultStore()
@@ -1,16 +1,41 @@
 """This module contains the routes for the webserver."""
 
-from flask import request, jsonify
-from app import webserver, logger
+from flask import request, jsonify, Response, g
+from app import webserver, logger, metrics
 from app.utilities.utils import calculate_states_mean, calculate_state_mean,\
     calculate_best5, calculate_worst5, calculate_global_mean,\
     calculate_diff_from_mean, calculate_state_diff_from_mean,\
     calculate_mean_by_category, get_jobs_helper,\
-    calculate_state_mean_by_category
+    calculate_state_mean_by_category, calculate_batch, calculate_rank
+from app.api_common import RequestError, job_tags, job_parts, encode_json
+from app.query_engine import run_query
+from app.result_cache import make_cache_key, ALL_QUESTIONS
+from app.scheduler import cost_class
+from app.task_runner import QueueFullError, JobError
+import io
 import json
+import os
+import time
+import pandas as pd
 
+# maximum number of seconds a request can wait for a job (/api/get_results/<job_id>?wait=)
+MAX_WAIT = float(os.getenv('TP_MAX_WAIT', '30'))
 
 
+@webserver.before_request
+def start_timer():
+    """Records the time the request started at, for its latency metric"""
+    g.start_time = time.monotonic()
+
+@webserver.after_request
+def record_request(response):
+    """Records the latency and the status code of the request in the metrics"""
+    # labelled by route (not by path) so that job ids do not create new series
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    metrics.HTTP_LATENCY.observe(time.monotonic() - g.start_time, endpoint)
+    metrics.HTTP_REQUESTS.inc(endpoint, str(response.status_code))
+    return response
+
 # Example endpoint definition
 @webserver.route('/api/post_endpoint', methods=['POST'])
 def post_endpoint():
@@ -29,27 +54,103 @@ def post_endpoint():
 
 @webserver.route('/api/get_results/<job_id>', methods=['GET'])
 def get_response(job_id):
-    """Get the results of a job with the given job_id."""
+    """Get the results of a job with the given job_id.
+    With ?wait=<seconds> the request blocks until the job is done (or the time passes).
+    With ?timings=1 the response also has the seconds the job spent queued and computing."""
 
     logger.info("Getting results for job_id: %s", job_id)
 
-    if job_id not in webserver.tasks_runner.jobs:
+    # the job is read once, it can be forgotten (expired) at any time
+    job = webserver.tasks_runner.get_job(job_id)
+    if job is None:
         logger.info("Invalid job_id: %s", job_id)
         return jsonify({"status": "error", "reason": "Invalid job_id"}), 404
 
-    if webserver.tasks_runner.jobs[job_id]["status"] == "running":
+    wait = request.args.get('wait', default=0, type=float)
+    if wait > 0 and job["status"] == "running":
+        webserver.tasks_runner.wait_for_job(job_id, min(wait, MAX_WAIT))
+        job = webserver.tasks_runner.get_job(job_id)
+        if job is None:
+            logger.info("Job %s expired", job_id)
+            return jsonify({"status": "error", "reason": "Invalid job_id"}), 404
+
+    if job["status"] == "running":
         logger.info("Job %s is still running", job_id)
         return jsonify({"status": "running"}), 200
 
+    payload = webserver.tasks_runner.results.load(job_id)
+    if payload is None:
+        if webserver.tasks_runner.get_job(job_id) is None:
+            # forgotten since it was read, with its result
+            logger.info("Job %s expired", job_id)
+            return jsonify({"status": "error", "reason": "Invalid job_id"}), 404
+        logger.error("No result stored for job_id: %s", job_id)
+        return jsonify({"status": "error", "reason": "Error while reading result"}), 500
+
+    if job["status"] == "error":
+        logger.error("Job %s failed: %s", job_id, payload.decode('utf-8'))
+        return json_response([b'{"status": "error", "reason": ', payload, b'}'], status=500)
+
+    logger.info("Job %s is done", job_id)
+    timings = b''
+    if request.args.get('timings') == '1':
+        # jobs answered from the cache or by an identical job have no timings (null)
+        timings = b', "timings": ' + json.dumps(job.get('timings')).encode('utf-8')
+    # the result is already serialized, it is sent without being parsed again
+    return json_response([b'{"status": "done", "data": ', payload, timings + b'}'])
+
+def json_response(parts, status=200):
+    """Helper building a response from JSON parts that are already encoded (the stored
+    result and the envelope around it), compressed and streamed as needed (see encode_json)"""
+    headers, body = encode_json(parts, request.headers.get('Accept-Encoding', ''))
+    # a body given as chunks has no Content-Length, it is sent with chunked transfer encoding
+    return Response(body, status=status, mimetype='application/json', headers=headers)
+
+def overloaded(error):
+    """Helper building the response of a job refused by admission control:
+    429 when the client has too many queued jobs, 503 when the server is overloaded"""
+    logger.warning("Job refused: %s", error)
+    response = jsonify({"status": "error", "reason": str(error)})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429 if error.per_client else 503
+
+def submit_job(task, data):
+    """Helper adding a job computing task on the ingested data for the request's payload,
+    once the payload is checked (see job_tags).
+    With ?sync=1 (or the X-Sync: 1 header) the job is computed in the request thread
+    and the response carries its result along with its job_id."""
+    # reading the ingested data once, a reload can swap it at any time
+    data_ingestor = webserver.data_ingestor
+    try:
+        # the questions the result depends on
+        tags = job_tags(request.path, data, data_ingestor)
+    except RequestError as error:
+        logger.info("Invalid request for %s: %s", request.path, error)
+        return jsonify({"status": "error", "reason": error.reason}), error.status
+    cache_key = make_cache_key(request.path, data, data_ingestor.version)
+
+    # the jobs are queued by cost class and by client (API key or address)
+    client = request.headers.get('X-API-Key') or request.remote_addr
+    if request.args.get('sync') == '1' or request.headers.get('X-Sync') == '1':
+        try:
+            job_id, payload = webserver.tasks_runner.run_task(task,\
+                data_ingestor, data, cache_key=cache_key, cache_tags=tags, client=client)
+        except QueueFullError as error:
+            return overloaded(error)
+        except JobError as error:
+            logger.error("Job %s failed: %s", error.job_id, error)
+            return json_response(job_parts(error.job_id, "error", error.payload), status=500)
+        logger.info("Job %s computed synchronously", job_id)
+        return json_response(job_parts(job_id, "done", payload))
+
     try:
-        result_file_path = f'results/{job_id}'
-        with open(result_file_path, 'r', encoding="utf-8") as file:
-            result = json.load(file)
-            logger.info("Job %s is done", job_id)
-            return jsonify({"status": "done", "data": result}), 200
-    except Exception as e:
-        logger.error("Error while reading result file: %s", e)
-        return jsonify({"status": "error", "reason": "Error while reading result file"}), 500
+        job_id = webserver.tasks_runner.add_task(task, data_ingestor, data,\
+            cache_key=cache_key, cache_tags=tags, lane=cost_class(request.path), client=client)
+    except QueueFullError as error:
+        return overloaded(error)
+
+    logger.info("Job %s added to the queue", job_id)
+    return jsonify({"status": "done", "job_id": job_id}), 200
 
 @webserver.route('/api/states_mean', methods=['POST'])
 def states_mean_request():
@@ -59,11 +160,7 @@ def states_mean_request():
 
     data = request.json
 
-    job_id = webserver.tasks_runner.add_task(calculate_states_mean,\
-        webserver.data_ingestor.data, data)
-
-    logger.info("Job %s added to the queue", job_id)
-    return jsonify({"status": "done", "job_id": job_id}), 200
+    return submit_job(calculate_states_mean, data)
 
 @webserver.route('/api/state_mean', methods=['POST'])
 def state_mean_request():
@@ -73,11 +170,7 @@ def state_mean_request():
 
     data = request.json
 
-    job_id = webserver.tasks_runner.add_task(calculate_state_mean,\
-        webserver.data_ingestor.data, data)
-
-    logger.info("Job %s added to the queue", job_id)
-    return jsonify({"status": "done", "job_id": job_id}), 200
+    return submit_job(calculate_state_mean, data)
 
 
 @webserver.route('/api/best5', methods=['POST'])
@@ -88,11 +181,7 @@ def best5_request():
 
     data = request.json
 
-    job_id = webserver.tasks_runner.add_task(calculate_best5,\
-        webserver.data_ingestor.data, data)
-
-    logger.info("Job %s added to the queue", job_id)
-    return jsonify({"status": "done", "job_id": job_id}), 200
+    return submit_job(calculate_best5, data)
 
 @webserver.route('/api/worst5', methods=['POST'])
 def worst5_request():
@@ -102,11 +191,7 @@ def worst5_request():
 
     data = request.json
 
-    job_id = webserver.tasks_runner.add_task(calculate_worst5,\
-        webserver.data_ingestor.data, data)
-
-    logger.info("Job %s added to the queue", job_id)
-    return jsonify({"status": "done", "job_id": job_id}), 200
+    return submit_job(calculate_worst5, data)
 
 @webserver.route('/api/global_mean', methods=['POST'])
 def global_mean_request():
@@ -115,11 +200,7 @@ def global_mean_request():
     logger.info("Received request for global_mean")
 
     data = request.json
-    job_id = webserver.tasks_runner.add_task(calculate_global_mean,\
-        webserver.data_ingestor.data, data)
-
-    logger.info("Job %s added to the queue", job_id)
-    return jsonify({"status": "done", "job_id": job_id}), 200
+    return submit_job(calculate_global_mean, data)
 
 @webserver.route('/api/diff_from_mean', methods=['POST'])
 def diff_from_mean_request():
@@ -128,11 +209,7 @@ def diff_from_mean_request():
     logger.info("Received request for diff_from_mean")
 
     data = request.json
-    job_id = webserver.tasks_runner.add_task(calculate_diff_from_mean,\
-        webserver.data_ingestor.data, data)
-
-    logger.info("Job %s added to the queue", job_id)
-    return jsonify({"status": "done", "job_id": job_id}), 200
+    return submit_job(calculate_diff_from_mean, data)
 
 @webserver.route('/api/state_diff_from_mean', methods=['POST'])
 def state_diff_from_mean_request():
@@ -141,12 +218,7 @@ def state_diff_from_mean_request():
     logger.info("Received request for state_diff_from_mean")
 
     data = request.json
-    job_id = webserver.tasks_runner.add_task(\
-        calculate_state_diff_from_mean,\
-        webserver.data_ingestor.data, data)
-
-    logger.info("Job %s added to the queue", job_id)
-    return jsonify({"status": "done", "job_id": job_id}), 200
+    return submit_job(calculate_state_diff_from_mean, data)
 
 @webserver.route('/api/mean_by_category', methods=['POST'])
 def mean_by_category_request():
@@ -155,11 +227,7 @@ def mean_by_category_request():
     logger.info("Received request for mean_by_category")
 
     data = request.json
-    job_id = webserver.tasks_runner.add_task(calculate_mean_by_category,\
-        webserver.data_ingestor.data, data)
-
-    logger.info("Job %s added to the queue", job_id)
-    return jsonify({"status": "done", "job_id": job_id}), 200
+    return submit_job(calculate_mean_by_category, data)
 
 @webserver.route('/api/state_mean_by_category', methods=['POST'])
 def state_mean_by_category_request():
@@ -169,11 +237,39 @@ def state_mean_by_category_request():
 
     data = request.json
 
-    job_id = webserver.tasks_runner.add_task(calculate_state_mean_by_category,\
-        webserver.data_ingestor.data, data)
+    return submit_job(calculate_state_mean_by_category, data)
 
-    logger.info("Job %s added to the queue", job_id)
-    return jsonify({"status": "done", "job_id": job_id}), 200
+@webserver.route('/api/rank', methods=['POST'])
+def rank_request():
+    """Endpoint to get the top k states of a question (after an offset), in the best, worst,
+    ascending or descending order of their means, or the rank of a state."""
+
+    logger.info("Received request for rank")
+
+    data = request.get_json(silent=True)
+
+    return submit_job(calculate_rank, data)
+
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+    """Endpoint to run a list of requests (endpoint, question, state) as a single job."""
+
+    logger.info("Received request for batch")
+
+    data = request.json
+
+    return submit_job(calculate_batch, data)
+
+@webserver.route('/api/query', methods=['POST'])
+def query_request():
+    """Endpoint to run a query (filters, group by, aggregates, order and limit)
+    over the rows of the data, see app/query_engine.py for the spec."""
+
+    logger.info("Received request for query")
+
+    data = request.get_json(silent=True)
+
+    return submit_job(run_query, data)
 
 @webserver.route('/api/jobs', methods=['GET'])
 def get_jobs():
@@ -181,8 +277,11 @@ def get_jobs():
 
     logger.info("Received request for jobs")
 
-    job_id = webserver.tasks_runner.add_task(get_jobs_helper,\
-        webserver)
+    try:
+        job_id = webserver.tasks_runner.add_task(get_jobs_helper,\
+            webserver.tasks_runner)
+    except QueueFullError as error:
+        return overloaded(error)
 
     logger.info("Job %s added to the queue", job_id)
     return jsonify({"status": "done", "job_id": job_id}), 200
@@ -193,19 +292,129 @@ def get_num_jobs():
 
     logger.info("Received request for num_jobs")
 
-    # counting only running jobs
-    counter = sum(1 for job in webserver.tasks_runner.jobs.values()\
-        if job["status"] == "running")
+    # counting only running jobs (kept up to date by the thread pool)
+    counter = webserver.tasks_runner.count_jobs("running")
 
     logger.info("Number of running jobs: %s", counter)
     return jsonify({"num_jobs": counter}), 200
 
+@webserver.route('/api/cache_stats', methods=['GET'])
+def get_cache_stats():
+    """Endpoint to get the hit/miss/eviction counters of the result cache."""
+
+    logger.info("Received request for cache_stats")
+
+    stats = webserver.tasks_runner.cache.get_stats()
+
+    logger.info("Cache stats: %s", stats)
+    return jsonify(stats), 200
+
+@webserver.route('/api/admin/reload', methods=['POST'])
+def reload_data():
+    """Endpoint to load a new version of the dataset in the background.
+    The optional "csv_path" of the payload (a CSV file of the data directory, DATA_DIR)
+    replaces the current CSV file."""
+
+    logger.info("Received request for reload")
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    try:
+        started = webserver.data_reloader.reload(data.get('csv_path'))
+    except ValueError as error:
+        logger.info("Invalid reload: %s", error)
+        return jsonify({"status": "error", "reason": str(error)}), 400
+    if not started:
+        logger.info("A dataset is already being loaded")
+        return jsonify({"status": "error", "reason": "Reload already in progress"}), 409
+
+    logger.info("Reload started")
+    return jsonify(webserver.data_reloader.get_status()), 202
+
+@webserver.route('/api/admin/reload', methods=['GET'])
+def get_reload_status():
+    """Endpoint to get the status of the last reload and the version of the data in use."""
+
+    logger.info("Received request for reload status")
+
+    return jsonify(webserver.data_reloader.get_status()), 200
+
+@webserver.route('/api/admin/append_rows', methods=['POST'])
+def append_rows():
+    """Endpoint to add new rows to the data, as a JSON list of rows ({"rows": [...]})
+    or as a CSV body (text/csv) with a header line."""
+
+    logger.info("Received request for append_rows")
+
+    if webserver.tasks_runner.backend == 'process':
+        # the worker processes have their own copy of the data, made when they were forked
+        # (see ThreadPool.share): new rows would only reach them by forking them again,
+        # copying the whole dataset for every append
+        logger.info("Appending rows is not available with the process backend")
+        return jsonify({"status": "error", "reason":
+                        "Appending rows is not available with TP_BACKEND=process"}), 501
+
+    data_ingestor = webserver.data_ingestor
+    try:
+        if request.mimetype == 'text/csv':
+            questions = data_ingestor.append_csv(io.StringIO(request.get_data(as_text=True)))
+        else:
+            data = request.get_json(silent=True)
+            rows = data.get('rows') if isinstance(data, dict) else data
+            if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+                raise ValueError("Expected a list of rows")
+            questions = data_ingestor.append(pd.DataFrame(rows))
+    except ValueError as error:
+        logger.info("Invalid rows: %s", error)
+        return jsonify({"status": "error", "reason": str(error)}), 400
+
+    # only the results depending on the questions of the new rows are dropped
+    webserver.tasks_runner.invalidate(questions | {ALL_QUESTIONS})
+
+    logger.info("Rows appended, %s questions changed", len(questions))
+    return jsonify({"status": "done", "num_rows": len(data_ingestor),
+                    "questions": sorted(questions)}), 200
+
+@webserver.route('/api/scheduler_stats', methods=['GET'])
+def get_scheduler_stats():
+    """Endpoint to get the queue depth and waiting times of each lane of the scheduler."""
+
+    logger.info("Received request for scheduler_stats")
+
+    stats = webserver.tasks_runner.task_queue.get_stats()
+
+    logger.info("Scheduler stats: %s", stats)
+    return jsonify(stats), 200
+
+@webserver.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Endpoint exposing the metrics in the Prometheus text format."""
+
+    tasks_runner = webserver.tasks_runner
+    for lane, stats in tasks_runner.task_queue.get_stats().items():
+        metrics.QUEUE_DEPTH.set(stats["depth"], lane)
+    metrics.WORKERS.set(len(tasks_runner.workers))
+    for status in ("running", "done", "error"):
+        metrics.JOBS.set(tasks_runner.count_jobs(status), status)
+    for name, value in tasks_runner.cache.get_stats().items():
+        if name in ("entries", "size_bytes", "max_entries", "max_bytes"):
+            metrics.CACHE_SIZE.set(value, name)
+        else:
+            metrics.CACHE_EVENTS.set(value, name)
+    metrics.INGEST_DURATION.set(webserver.data_ingestor.ingest_seconds)
+    metrics.DATA_ROWS.set(len(webserver.data_ingestor))
+
+    return Response(metrics.render_metrics(), status=200,
+                    mimetype='text/plain; version=0.0.4')
+
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown():
     """Endpoint to initiate a graceful shutdown of the webserver."""
 
     logger.info("Received request for graceful_shutdown")
 
+    webserver.data_reloader.close()
     webserver.tasks_runner.graceful_shutdown()
 
     logger.info("Graceful shutdown initiated")
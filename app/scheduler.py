@@ -0,0 +1,136 @@
+"""This module contains the FairScheduler class which is used by ThreadPool
+to order the tasks by priority lane and by client, instead of a single FIFO queue."""
+
+from collections import OrderedDict, deque
+from queue import Empty
+from threading import Condition
+import time
+
+# lanes and their weights: out of every 7 tasks taken while all the lanes are busy,
+# 4 are cheap, 2 are default and 1 is expensive, so no lane is starved
+LANE_WEIGHTS = {"cheap": 4, "default": 2, "expensive": 1}
+
+# cost class of each endpoint (the others are in the default lane)
+COST_CLASSES = {
+    '/api/state_mean': 'cheap',
+    '/api/global_mean': 'cheap',
+    '/api/state_diff_from_mean': 'cheap',
+    '/api/state_mean_by_category': 'cheap',
+    '/api/rank': 'cheap',
+    '/api/mean_by_category': 'expensive',
+    '/api/batch': 'expensive',
+    '/api/query': 'expensive',
+}
+
+def cost_class(endpoint: str) -> str:
+    """Function returning the lane of the requests of an endpoint"""
+    return COST_CLASSES.get(endpoint, 'default')
+
+class Lane:
+    """Class used for keeping the tasks of a lane, one FIFO queue per client"""
+    def __init__(self, weight: int):
+        self.weight = weight
+        self.credit = 0 # used for the weighted round robin between the lanes
+        self.clients = OrderedDict() # client -> deque of (enqueue time, item), in turn order
+        self.depth = 0 # number of queued tasks
+        # counters used for tuning the lanes
+        self.dequeued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def put(self, item, client):
+        """Method adding a task to the end of the client's queue"""
+        self.clients.setdefault(client, deque()).append((time.monotonic(), item))
+        self.depth += 1
+
+    def get(self):
+        """Method removing the next task of the client whose turn it is"""
+        # the client at the front gives one task, then goes to the back of the line
+        client, items = next(iter(self.clients.items()))
+        enqueued, item = items.popleft()
+        del self.clients[client]
+        if items:
+            self.clients[client] = items
+        self.depth -= 1
+        wait = time.monotonic() - enqueued
+        self.dequeued += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return item
+
+    def get_stats(self):
+        """Method returning the depth, the weight and the waiting times of the lane"""
+        return {"depth": self.depth, "clients": len(self.clients), "weight": self.weight,
+                "dequeued": self.dequeued, "max_wait": self.max_wait,
+                "mean_wait": self.total_wait / self.dequeued if self.dequeued else 0.0}
+
+class FairScheduler:
+    """Class used as the task queue of ThreadPool (same interface as queue.Queue).
+    Tasks are put in a priority lane (weighted round robin between the lanes) and,
+    inside a lane, the clients take turns so a burst from one client does not
+    stall the requests of the others."""
+    def __init__(self, lane_weights=None):
+        self.lanes = {name: Lane(weight)
+                      for name, weight in (lane_weights or LANE_WEIGHTS).items()}
+        self.condition = Condition()
+        self.unfinished_tasks = 0
+        self.closed = False # when closed, get returns None once the lanes are empty
+
+    def put(self, item, lane='default', client=None):
+        """Method adding a task to the end of the client's queue in the lane"""
+        with self.condition:
+            self.lanes.get(lane, self.lanes['default']).put(item, client)
+            self.unfinished_tasks += 1
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """Method removing the next task, waiting at most timeout seconds (raises Empty).
+        Returns None (the stop sentinel) when the scheduler is closed and empty"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.qsize() or self.closed, timeout):
+                raise Empty
+            if not self.qsize():
+                return None
+            # smooth weighted round robin between the lanes having tasks
+            busy = [lane for lane in self.lanes.values() if lane.depth]
+            for lane in busy:
+                lane.credit += lane.weight
+            chosen = max(busy, key=lambda lane: lane.credit)
+            chosen.credit -= sum(lane.weight for lane in busy)
+            return chosen.get()
+
+    def close(self):
+        """Method waking up the consumers, which stop after taking the remaining tasks"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def task_done(self):
+        """Method marking a task taken with get as finished"""
+        with self.condition:
+            self.unfinished_tasks -= 1
+            if self.unfinished_tasks == 0:
+                self.condition.notify_all()
+
+    def join(self):
+        """Method blocking until every task put was marked as finished"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.unfinished_tasks == 0)
+
+    def qsize(self):
+        """Method returning the number of queued tasks"""
+        return sum(lane.depth for lane in self.lanes.values())
+
+    def client_depth(self, client):
+        """Method returning the number of queued tasks of a client"""
+        with self.condition:
+            return sum(len(lane.clients.get(client, ())) for lane in self.lanes.values())
+
+    def empty(self):
+        """Method returning whether no task is queued"""
+        return self.qsize() == 0
+
+    def get_stats(self):
+        """Method returning the depth and the waiting times of each lane"""
+        with self.condition:
+            return {name: lane.get_stats() for name, lane in self.lanes.items()}
@@ -1,77 +1,462 @@
 """This module contains the ThreadPool class which
 is used to create a thread pool to handle tasks concurrently."""
 
-from queue import Queue, Empty
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
 from threading import Thread, Event, Lock
+import multiprocessing
 import os
-import shutil
 import json
+import math
+import time
+from app import metrics
+from app.result_cache import ResultCache
+from app.result_store import create_result_store
+from app.scheduler import FairScheduler
+
+# objects shared with the worker processes (id -> object); the processes are forked
+# after the objects are registered, so they inherit them instead of receiving copies
+_SHARED_OBJECTS = {}
+
+class SharedRef:
+    """Class used to send a reference to a shared object to a worker process"""
+    def __init__(self, key: int):
+        self.key = key
+
+    def resolve(self):
+        """Method returning the shared object inherited by the worker process"""
+        return _SHARED_OBJECTS[self.key]
+
+def _run_shared(task, args, kwargs):
+    """Function running a task in a worker process, replacing references with shared objects"""
+    args = [arg.resolve() if isinstance(arg, SharedRef) else arg for arg in args]
+    return task(*args, **kwargs)
+
+class QueueFullError(Exception):
+    """Exception raised by add_task when a job is not accepted because of overload"""
+    def __init__(self, reason: str, retry_after: int, per_client=False):
+        super().__init__(reason)
+        self.retry_after = retry_after # seconds after which the job could be accepted
+        self.per_client = per_client # the client's share of the queue is full
+
+class JobError(Exception):
+    """Exception raised by run_task when the task raised, the job is kept in the "error" status"""
+    def __init__(self, job_id: str, payload: bytes):
+        super().__init__(json.loads(payload))
+        self.job_id = job_id
+        self.payload = payload # serialized error message, as stored for the job
+
+def _error_payload(error):
+    """Serialized message of an exception raised by a task"""
+    return json.dumps(f"{type(error).__name__}: {error}").encode('utf-8')
+
+def _task_name(task):
+    """Name of a task, used as the label of its metrics"""
+    return getattr(task, '__name__', type(task).__name__)
+
+def _warm_up():
+    """Function used to fork the worker processes"""
+    return os.getpid()
+
+def _init_process():
+    """Function run by every worker process once it is forked. The other threads of the
+    server keep running during the fork, so a lock of a shared object may have been copied
+    while held by one of them: the shared objects recreate their locks (after_fork)"""
+    for obj in _SHARED_OBJECTS.values():
+        after_fork = getattr(obj, 'after_fork', None)
+        if after_fork is not None:
+            after_fork()
 
 class ThreadPool:
     """Class used for creating a thread pool to handle tasks concurrently"""
     def __init__(self):
         # initializing needed attributes
-        self.task_queue = Queue() # storing the tasks
-        self.shutdown_event = Event() # used to signal the threads to shutdown
+        self.task_queue = FairScheduler() # storing the tasks, by lane and client
+        self.shutdown_event = Event() # set when the pool shuts down, new jobs are refused
         self.jobs = {}  # job id's and their status
         self.job_counter = 1 # used to generate job id's
         self.lock = Lock() # used for controlling access to job_counter
         self.workers = [] # actual worker threads
+        self.results = create_result_store() # serialized results, by job id
+        self.cache = ResultCache() # results of finished jobs, by request
+        self.in_flight = {} # cache key -> id of the job computing it
+        self.invalidations = 0 # number of invalidations of cached results
+        self.done_events = {} # id of a running job -> event set when the job is done
+        self.done_callbacks = {} # id of a running job -> functions called when it is done
+        self.finished = OrderedDict() # id of a finished job -> finish time, oldest first
+        # number of jobs in each status, "error" being the jobs whose task raised
+        self.job_counts = {"running": 0, "done": 0, "error": 0}
+        # finished jobs are forgotten (with their results) after TP_JOB_TTL seconds
+        # or when there are more than TP_MAX_FINISHED_JOBS of them
+        self.job_ttl = float(os.getenv('TP_JOB_TTL', '3600'))
+        self.max_finished_jobs = int(os.getenv('TP_MAX_FINISHED_JOBS', '10000'))
+        # admission control (0 disables a limit): new jobs are refused when there are
+        # TP_MAX_QUEUE_DEPTH queued jobs, TP_MAX_CLIENT_QUEUE queued jobs of the same client
+        # or when a new job would wait more than TP_MAX_QUEUE_DELAY seconds in the queue
+        self.max_queue_depth = int(os.getenv('TP_MAX_QUEUE_DEPTH', '1000'))
+        self.max_client_queue = int(os.getenv('TP_MAX_CLIENT_QUEUE', '0'))
+        self.max_queue_delay = float(os.getenv('TP_MAX_QUEUE_DELAY', '10'))
+        self.service_time = 0.0 # moving average of the time a job takes (seconds)
+
+        # 'thread' runs the tasks in the worker threads, 'process' runs the tasks using
+        # shared objects (the ingested data) in forked worker processes, escaping the GIL
+        self.backend = os.getenv('TP_BACKEND', 'thread')
+        self.num_processes = int(os.getenv('TP_NUM_OF_PROCESSES', os.cpu_count()))
+        self.executor = None # process pool, created when objects are shared
 
         # number of threads
-        num_threads = int(os.getenv('TP_NUM_OF_THREADS', os.cpu_count()))
+        self.num_threads = int(os.getenv('TP_NUM_OF_THREADS', os.cpu_count()))
         # worker threads
-        for _ in range(num_threads):
-            worker = TaskRunner(self.task_queue, self.shutdown_event, self.update_job_status)
-            worker.start()
-            self.workers.append(worker)
+        for _ in range(self.num_threads):
+            self.workers.append(self._start_worker())
 
-    def add_task(self, task, *args, **kwargs):
-        """Method to add a task to the task queue and return the job id for tracking"""
+    def _start_worker(self):
+        worker = TaskRunner(self.task_queue, self.update_job_status, self.execute,
+                            self._respawn)
+        worker.start()
+        return worker
+
+    def _respawn(self, worker):
+        """Method replacing a worker thread that died (called by the dying thread)"""
+        with self.lock:
+            self.workers[self.workers.index(worker)] = self._start_worker()
+    def share(self, obj, replaces=None):
+        """Method to share an object (the ingested data) with the worker processes.
+        The process pool is (re)created so that the new processes inherit the object.
+        The replaced object is not shared anymore, tasks still using it run in threads."""
+        if self.backend != 'process':
+            return
+        with self.lock:
+            _SHARED_OBJECTS[id(obj)] = obj
+            if replaces is not None and replaces is not obj:
+                _SHARED_OBJECTS.pop(id(replaces), None)
+            old_executor = self.executor
+            self.executor = ProcessPoolExecutor(max_workers=self.num_processes,
+                                                mp_context=multiprocessing.get_context('fork'),
+                                                initializer=_init_process)
+            # the first submit forks all the processes. The request, worker, logging and
+            # result writer threads are not stopped meanwhile and none of them exist in
+            # the processes, so the tasks run there must only use the shared objects
+            # (whose locks are recreated by _init_process), not logging nor metrics
+            self.executor.submit(_warm_up)
+        if old_executor is not None:
+            # tasks already sent to the old processes finish on the data they inherited
+            old_executor.shutdown(wait=False)
+
+    def execute(self, task, args, kwargs):
+        """Method running a task, in a worker process if it uses a shared object.
+        The time it takes is used for estimating the queueing delay"""
+        start = time.monotonic()
+        try:
+            return self._execute(task, args, kwargs)
+        finally:
+            elapsed = time.monotonic() - start
+            metrics.COMPUTE_TIME.observe(elapsed, _task_name(task))
+            with self.lock:
+                self.service_time += 0.2 * (elapsed - self.service_time)
+
+    def _execute(self, task, args, kwargs):
+        executor = self.executor
+        if executor is not None and any(id(arg) in _SHARED_OBJECTS for arg in args):
+            shared_args = [SharedRef(id(arg)) if id(arg) in _SHARED_OBJECTS else arg
+                           for arg in args]
+            try:
+                future = executor.submit(_run_shared, task, shared_args, kwargs)
+            except BrokenExecutor:
+                raise
+            except RuntimeError:
+                # the process pool was replaced (shut down) after being read
+                future = None
+            if future is not None:
+                # outside the try, an error of the task (or of the pool) fails the job
+                return future.result()
+        return task(*args, **kwargs)
+
+    def add_task(self, task, *args, cache_key=None, cache_tags=frozenset(), lane='default',
+                 client=None, **kwargs):
+        """Method to add a task to the task queue and return the job id for tracking.
+        Tasks having a cache_key are answered from the cache when possible and
+        attached to an identical job that is still running instead of being queued again.
+        cache_tags are what the result depends on (see invalidate); lane is the cost class
+        of the task and client the one sending it (see FairScheduler).
+        Raises QueueFullError when the job cannot be queued (see _admit)."""
         # using lock to prevent race conditions when updating job_counter
         with self.lock:
-            job_id = "job_id_" + str(self.job_counter)
+            if cache_key is not None:
+                # an identical request is still being computed
+                job_id = self.in_flight.get(cache_key)
+                if job_id is not None:
+                    self.cache.record_coalesced()
+                    return job_id
+                payload = self.cache.get(cache_key)
+                if payload is not None:
+                    return self._add_done_job(payload)
+            # only jobs that have to be computed are subject to admission control
+            self._admit(client)
+            job_id = self._new_job_id()
             self.jobs[job_id] = {"status": "running"}
-            self.job_counter += 1
-        # add the task to the task queue
-        self.task_queue.put((job_id, task, args, kwargs))
+            self.job_counts["running"] += 1
+            self.done_events[job_id] = Event()
+            if cache_key is not None:
+                self.jobs[job_id]['cache_key'] = cache_key
+                self.jobs[job_id]['cache_tags'] = cache_tags
+                self.in_flight[cache_key] = job_id
+        # add the task to the task queue, with the time it was queued at
+        self.task_queue.put((job_id, task, args, kwargs, time.monotonic()), lane, client)
+        metrics.JOBS_SUBMITTED.inc(_task_name(task))
         return job_id  # Return job_id for tracking
 
-    def update_job_status(self, job_id, status, result=None):
-        """Method to update the status of a job"""
+    def run_task(self, task, *args, cache_key=None, cache_tags=frozenset(), client=None,
+                 **kwargs):
+        """Method running a task in the calling thread (synchronous fast path).
+        A done job is still allocated for it; returns its id and the serialized result.
+        Raises QueueFullError when the job would not be queued by add_task (see _admit)
+        and JobError, after recording the job in the "error" status, when the task raises"""
+        with self.lock:
+            invalidations = self.invalidations
+            if cache_key is not None:
+                payload = self.cache.get(cache_key)
+                if payload is not None:
+                    return self._add_done_job(payload), payload
+            # the request thread computing the job is shed like a queued job
+            self._admit(client)
+        start = time.monotonic()
+        try:
+            result = task(*args, **kwargs)
+        except Exception as error:
+            payload = _error_payload(error)
+            with self.lock:
+                job_id = self._add_done_job(payload, status="error")
+            raise JobError(job_id, payload) from error
+        computed = time.monotonic()
+        payload = json.dumps(result).encode('utf-8')
+        metrics.COMPUTE_TIME.observe(computed - start, _task_name(task))
+        metrics.SERIALIZATION_TIME.observe(time.monotonic() - computed, _task_name(task))
+        with self.lock:
+            # a result computed while the data changed is not cached
+            if cache_key is not None and invalidations == self.invalidations:
+                self.cache.put(cache_key, payload, cache_tags)
+            return self._add_done_job(payload), payload
+
+    def estimate_queue_delay(self):
+        """Method estimating how long (seconds) a new job would wait in the queue"""
+        return self.task_queue.qsize() * self.service_time / max(self.num_threads, 1)
+
+    def _admit(self, client):
+        """Raises QueueFullError if a new job of client would overload the queue
+        (called holding the lock)"""
+        if self.shutdown_event.is_set():
+            raise QueueFullError("Shutting down", 1)
+        depth = self.task_queue.qsize()
+        delay = self.estimate_queue_delay()
+        # time for the queue to drain below the limits, at least a second
+        retry_after = max(1, math.ceil(delay))
+        if self.max_queue_depth and depth >= self.max_queue_depth:
+            raise QueueFullError("Too many queued jobs", retry_after)
+        if self.max_queue_delay and delay > self.max_queue_delay:
+            raise QueueFullError("Queueing delay too high", retry_after)
+        if self.max_client_queue and\
+                self.task_queue.client_depth(client) >= self.max_client_queue:
+            raise QueueFullError("Too many queued jobs for this client", retry_after,
+                                 per_client=True)
+
+    def _new_job_id(self):
+        job_id = "job_id_" + str(self.job_counter)
+        self.job_counter += 1
+        return job_id
+
+    def _add_done_job(self, payload, status="done"):
+        """Creates a job that is already done with the given serialized result
+        (or failed, with its serialized error message)"""
+        job_id = self._new_job_id()
+        self.results.save(job_id, payload)
+        self.jobs[job_id] = {"status": status}
+        self.job_counts[status] += 1
+        self._finish(job_id)
+        return job_id
+
+    def _finish(self, job_id):
+        """Records a finished job and forgets the expired ones (called holding the lock)"""
+        self.finished[job_id] = time.monotonic()
+        self._expire()
+
+    def _expire(self):
+        """Forgets the finished jobs past their TTL or beyond the maximum number of finished
+        jobs, oldest first (called holding the lock). Run when a job finishes and when jobs
+        are read, so that an idle server does not keep expired jobs"""
+        now = time.monotonic()
+        while self.finished:
+            oldest_id, finish_time = next(iter(self.finished.items()))
+            if len(self.finished) <= self.max_finished_jobs and now - finish_time < self.job_ttl:
+                break
+            del self.finished[oldest_id]
+            self.job_counts[self.jobs.pop(oldest_id)["status"]] -= 1
+            self.results.delete(oldest_id)
+
+    def update_job_status(self, job_id, status, payload=None, timings=None):
+        """Method to update the status of a job, payload being its serialized result
+        (or its serialized error message when the status is "error") and timings the
+        seconds it spent in the queue and being computed"""
+        callbacks = ()
         with self.lock:
             if job_id in self.jobs:
+                if timings is not None:
+                    self.jobs[job_id]['timings'] = timings
+                if payload is not None:
+                    # storing the result before the job is seen as done
+                    self.results.save(job_id, payload)
+                self.job_counts[self.jobs[job_id]['status']] -= 1
+                self.job_counts[status] = self.job_counts.get(status, 0) + 1
                 self.jobs[job_id]['status'] = status
-                if result is not None:
-                    self.jobs[job_id]['result'] = result
+                # waking up the requests waiting for the job
+                done_event = self.done_events.pop(job_id, None)
+                if done_event is not None:
+                    done_event.set()
+                callbacks = self.done_callbacks.pop(job_id, ())
+                cache_key = self.jobs[job_id].pop('cache_key', None)
+                cache_tags = self.jobs[job_id].pop('cache_tags', frozenset())
+                if cache_key is not None:
+                    # caching the result before letting new requests miss the in-flight job
+                    if payload is not None and status == "done":
+                        self.cache.put(cache_key, payload, cache_tags)
+                    self.in_flight.pop(cache_key, None)
+                if status != "running":
+                    self._finish(job_id)
+        # called without the lock, a callback may read the job
+        for callback in callbacks:
+            callback()
+
+    def invalidate(self, tags):
+        """Method dropping the cached results having any of the tags (the questions whose
+        data changed). Running jobs with these tags are not cached nor coalesced anymore."""
+        tags = set(tags)
+        with self.lock:
+            self.invalidations += 1
+            self.cache.invalidate(tags)
+            for cache_key, job_id in list(self.in_flight.items()):
+                job = self.jobs[job_id]
+                if job['cache_tags'] & tags:
+                    del self.in_flight[cache_key]
+                    del job['cache_key']
+                    del job['cache_tags']
+
+    def count_jobs(self, status):
+        """Method returning the number of jobs having the given status
+        (O(1), besides forgetting the expired jobs)"""
+        with self.lock:
+            self._expire()
+            return self.job_counts.get(status, 0)
+
+    def get_job(self, job_id):
+        """Method returning a copy of a job ({"status": ..., "timings": ...}),
+        None if it is unknown or was forgotten"""
+        with self.lock:
+            self._expire()
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
 
-    def graceful_shutdown(self):
-        """Method to shutdown the thread pool"""
+    def get_job_statuses(self):
+        """Method returning the status of every job that was not forgotten yet"""
+        with self.lock:
+            self._expire()
+            return {job_id: job["status"] for job_id, job in self.jobs.items()}
+
+    def wait_for_job(self, job_id, timeout):
+        """Method blocking until the job is done or the timeout (seconds) expires"""
+        with self.lock:
+            done_event = self.done_events.get(job_id)
+        if done_event is not None:
+            done_event.wait(timeout)
+
+    def add_done_callback(self, job_id, callback):
+        """Method registering a function (without arguments) called by the worker that
+        finishes the job, used for awaiting jobs without a blocked thread (see app/asgi.py).
+        Returns False, without registering it, when the job is not running."""
+        with self.lock:
+            if job_id not in self.done_events:
+                return False
+            self.done_callbacks.setdefault(job_id, []).append(callback)
+            return True
+
+    def remove_done_callback(self, job_id, callback):
+        """Method unregistering a callback of a job that is no longer awaited"""
+        with self.lock:
+            callbacks = self.done_callbacks.get(job_id)
+            if callbacks and callback in callbacks:
+                callbacks.remove(callback)
+
+    def graceful_shutdown(self, timeout=None):
+        """Method to shutdown the thread pool. The queued jobs are run first, the workers
+        stop when the queue is empty (waiting at most timeout seconds, TP_SHUTDOWN_TIMEOUT)"""
+        if timeout is None:
+            timeout = float(os.getenv('TP_SHUTDOWN_TIMEOUT', '30'))
+        deadline = time.monotonic() + timeout
         self.shutdown_event.set()
-        for worker in self.workers:
-            worker.join()
-        self.task_queue.join()
+        # the workers get a stop sentinel once every queued job was taken
+        self.task_queue.close()
+        while True:
+            with self.lock:
+                workers = [worker for worker in self.workers if worker.is_alive()]
+            if not workers or time.monotonic() >= deadline:
+                break
+            workers[0].join(max(deadline - time.monotonic(), 0))
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.results.close()
 
 class TaskRunner(Thread):
     """Class used for running tasks in a separate thread"""
-    def __init__(self, task_queue: Queue, shutdown_event: Event, update_status_callback):
+    def __init__(self, task_queue: FairScheduler, update_status_callback,
+                 execute_callback=None, exit_callback=None):
         super().__init__()
         self.task_queue = task_queue
-        self.shutdown_event = shutdown_event
         self.update_status = update_status_callback
+        # runs a task, in this thread or in a worker process
+        self.execute = execute_callback or (lambda task, args, kwargs: task(*args, **kwargs))
+        # called with the thread when it dies before getting the stop sentinel
+        self.exit_callback = exit_callback
 
     def run(self):
-        """Method to run the tasks in the task queue"""
-        while not self.shutdown_event.is_set():
-            try:
-                # setting a timeout to avoid blocking indefinitely and wait for shutdown event
-                # another alternative is to use a 'poison pill' to signal the threads to shutdown
-                job_id, task, args, kwargs = self.task_queue.get(timeout=1)
-                result = task(*args, **kwargs)
-                with open('results/' + job_id, 'w', encoding="utf-8") as file:
-                    file.write(json.dumps(result))
-                # updating the status of the job
-                self.update_status(job_id, "done", result)
-                self.task_queue.task_done()
-            except Empty: # raised when the queue is empty
-                continue
+        """Method to run the tasks in the task queue, until the stop sentinel (None)"""
+        stopped = False
+        try:
+            while True:
+                # blocking until there is a task, the thread is woken up only when needed
+                item = self.task_queue.get()
+                if item is None:
+                    stopped = True
+                    break
+                self.run_job(*item)
+        finally:
+            if not stopped and self.exit_callback is not None:
+                self.exit_callback(self)
+
+    def run_job(self, job_id, task, args, kwargs, queued_at=None):
+        """Method running a job; a task that raises puts the job in the "error" status"""
+        name = _task_name(task)
+        start = time.monotonic()
+        if queued_at is not None:
+            metrics.QUEUE_WAIT.observe(start - queued_at, name)
+        metrics.BUSY_WORKERS.inc()
+        status, payload = "error", None
+        try:
+            result = self.execute(task, args, kwargs)
+            # serializing the result only once, it is served as it is
+            computed = time.monotonic()
+            payload = json.dumps(result).encode('utf-8')
+            metrics.SERIALIZATION_TIME.observe(time.monotonic() - computed, name)
+            status = "done"
+        except Exception as error:
+            payload = _error_payload(error)
+        finally:
+            # also when the thread is dying, so that the job and the queue are not stuck
+            if payload is None:
+                payload = json.dumps("The worker running the job died").encode('utf-8')
+            finished = time.monotonic()
+            timings = {"queue": start - queued_at if queued_at is not None else None,
+                       "compute": finished - start}
+            self.update_status(job_id, status, payload, timings)
+            self.task_queue.task_done()
+            metrics.JOBS_FINISHED.inc(name, status)
+            metrics.BUSY_WORKERS.dec()
+            metrics.BUSY_TIME.inc(amount=finished - start)
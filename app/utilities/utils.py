@@ -1,216 +1,249 @@
-import pandas as pd
-from app import webserver
-
-def calculate_states_mean(csv_data: list, data: dict):
+"""Helper functions computing the statistics served by the API
+from the aggregate tables built by DataIngestor."""
+
+from app.data_ingestor import DataIngestor
+from app.ranking import rank_options, select, rank_in
+
+def year_range(data: dict) -> tuple:
+    """Function returning the (year_start, year_end) of a request as integers (None when
+    missing), raises ValueError when they are not integers"""
+    years = []
+    for name in ('year_start', 'year_end'):
+        year = data.get(name)
+        if year is not None:
+            if isinstance(year, str) and year.strip().lstrip('-').isdigit():
+                year = int(year)
+            if not isinstance(year, int) or isinstance(year, bool):
+                raise ValueError(f"{name} must be an integer")
+        years.append(year)
+    return tuple(years)
+
+def check_years(data):
+    """Function raising ValueError when the year bounds of a request
+    (or of any request of a batch) are not integers"""
+    sub_requests = data.get('requests', [data]) if isinstance(data, dict) else data
+    for sub_request in sub_requests if isinstance(sub_requests, list) else ():
+        if isinstance(sub_request, dict):
+            year_range(sub_request)
+
+def _aggregates(ingestor: DataIngestor, data: dict):
+    """Aggregate tables answering a request: the tables of all the years, or the ones merged
+    from the year partitions when the request has "year_start" and/or "year_end"."""
+    year_start, year_end = year_range(data)
+    if year_start is None and year_end is None:
+        return ingestor.aggregates
+    return ingestor.aggregates.for_years(data['question'], year_start, year_end)
+
+def calculate_states_mean(ingestor: DataIngestor, data: dict):
     """Helper function to calculate the mean of each state (/api/states_mean)"""
-    states_values = {} # location: [sum, count]
-    for row in csv_data:
-        if row['Question'] == data['question']:
-            if row['LocationDesc'] not in states_values:
-                states_values[row['LocationDesc']] = []
-                # position 0 will store sum of values
-                states_values[row['LocationDesc']].append(float(row['Data_Value']))
-                states_values[row['LocationDesc']].append(1) # position 1 will store count of values
-            else:
-                states_values[row['LocationDesc']][0] += float(row['Data_Value'])
-                states_values[row['LocationDesc']][1] += 1
-
-    # creating a dictionary with the mean of each state
-    states_mean = {}
-    for state, values in states_values.items():
-        states_mean[state] = values[0] / values[1]
+    # the states are already sorted in ascending order based on the mean
+    return dict(_aggregates(ingestor, data).ranking(data['question']).items())
 
-    # sorting in ascending order based on the mean
-    states_mean = dict(sorted(states_mean.items(), key=lambda item: item[1]))
-
-    return states_mean
-
-def calculate_state_mean(csv_data: list, data: dict):
+def calculate_state_mean(ingestor: DataIngestor, data: dict):
     """Helper function to calculate the mean of a specific state (/api/state_mean)"""
+    values = _aggregates(ingestor, data).states.get(data['question'], {}).get(data['state'])
 
-    state_mean = 0
-    count = 0
-    for row in csv_data:
-        if row['LocationDesc'] == data['state'] and row['Question'] == data['question']:
-            state_mean += float(row['Data_Value'])
-            count += 1
-
-    if count == 0:
+    if values is None:
         return {data['state']: 0}
-    result = {data['state']: state_mean / count}
+    result = {data['state']: values[0] / values[1]}
     return result
 
-def calculate_best5(csv_data: list, data: dict):
-    """Helper function to calculate the best 5 or worst 5 states (/api/best5)"""
-    states_values = {} # location: [sum, count]
-    # checking which type of question it is
-    if data['question'] in webserver.data_ingestor.questions_best_is_min:
-        last5 = True
-    else:
-        last5 = False
-    for row in csv_data:
-        if row['Question'] == data['question']:
-            if row['LocationDesc'] not in states_values:
-                states_values[row['LocationDesc']] = []
-                # position 0 will store sum of values
-                states_values[row['LocationDesc']].append(float(row['Data_Value']))
-                states_values[row['LocationDesc']].append(1) # position 1 will store count of values
-            else:
-                states_values[row['LocationDesc']][0] += float(row['Data_Value'])
-                states_values[row['LocationDesc']][1] += 1
-
-    states_mean = {}
-    for state, values in states_values.items():
-        states_mean[state] = values[0] / values[1]
-
-    # creating a dictionary with the mean of each state
-    states_mean = dict(sorted(states_mean.items(), key=lambda item: item[1]))
-    if last5:
-        # getting best 5 from the beginning
-        result = {k: v for k, v in list(states_mean.items())[:5]}
-    else:
-        # getting best 5 from the end
-        result = {k: v for k, v in list(states_mean.items())[-5:]}
-
-    return result
-
-def calculate_worst5(csv_data: list, data: dict):
+def _top5(ranking, question: str, first5_questions: frozenset):
+    """Helper returning the first or last 5 states of the ranking of a question,
+    in ascending order based on the mean"""
+    if question in first5_questions:
+        # getting 5 from the beginning
+        return dict(ranking.top(5))
+    # getting 5 from the end
+    return dict(ranking.top(5, descending=True)[::-1])
+
+def calculate_best5(ingestor: DataIngestor, data: dict):
+    """Helper function to calculate the best 5 states (/api/best5)"""
+    return _top5(_aggregates(ingestor, data).ranking(data['question']), data['question'],\
+        ingestor.questions_best_is_min)
+
+def calculate_worst5(ingestor: DataIngestor, data: dict):
     """Helper function to calculate the worst 5 states (/api/worst5)"""
-    states_values = {} # location: [sum, count]
-    # checking which type of question it is
-    if data['question'] in webserver.data_ingestor.questions_best_is_max:
-        last5 = True
-    else:
-        last5 = False
-    for row in csv_data:
-        if row['Question'] == data['question']:
-            if row['LocationDesc'] not in states_values:
-                states_values[row['LocationDesc']] = []
-                # position 0 will store sum of values
-                states_values[row['LocationDesc']].append(float(row['Data_Value']))
-                states_values[row['LocationDesc']].append(1) # position 1 will store count of values
-            else:
-                states_values[row['LocationDesc']][0] += float(row['Data_Value'])
-                states_values[row['LocationDesc']][1] += 1
-
-    states_mean = {}
-    for state, values in states_values.items():
-        states_mean[state] = values[0] / values[1]
-
-    # creating a dictionary with the mean of each state
-    states_mean = dict(sorted(states_mean.items(), key=lambda item: item[1]))
-    if last5:
-        # getting best 5 from the beginning
-        result = {k: v for k, v in list(states_mean.items())[:5]}
-    else:
-        # getting best 5 from the end
-        result = {k: v for k, v in list(states_mean.items())[-5:]}
-
-    return result
-
-def calculate_global_mean(csv_data: list, data: dict):
+    return _top5(_aggregates(ingestor, data).ranking(data['question']), data['question'],\
+        ingestor.questions_best_is_max)
+
+def _descending(ingestor: DataIngestor, question: str, order: str):
+    """Helper returning whether a ranking is in descending order of the means,
+    best and worst being the same states as /api/best5 and /api/worst5"""
+    if order in ('asc', 'desc'):
+        return order == 'desc'
+    if order == 'best':
+        return question not in ingestor.questions_best_is_min
+    return question not in ingestor.questions_best_is_max
+
+def _stratification_means(aggregates, question: str, category, stratification):
+    """Helper returning the mean of each state over the rows of a stratification category
+    and/or stratification, states in the order they first appear in the data"""
+    tables = aggregates.categories.get(question, {})
+    means = {}
+    for state in aggregates.states.get(question, {}):
+        total, count = 0.0, 0
+        for (row_category, row_stratification), values in tables.get(state, {}).items():
+            if (category is None or row_category == category) and\
+                    (stratification is None or row_stratification == stratification):
+                total += values[0]
+                count += values[1]
+        if count:
+            means[state] = total / count
+    return means
+
+def calculate_rank(ingestor: DataIngestor, data: dict):
+    """Helper function to rank the states of a question by their mean (/api/rank).
+    data may have k (default 5), offset, order (best, worst, asc or desc),
+    stratification_category and/or stratification, and a state whose rank is returned
+    instead of the top k states"""
+    k, offset, order = rank_options(data)
+    question = data['question']
+    aggregates = _aggregates(ingestor, data)
+    descending = _descending(ingestor, question, order)
+    category = data.get('stratification_category')
+    stratification = data.get('stratification')
+
+    if category is None and stratification is None:
+        # read from the ranking sorted at ingest
+        ranking = aggregates.ranking(question)
+        if 'state' in data:
+            rank = ranking.rank_of(data['state'], descending)
+            mean = None if rank is None else ranking.means[ranking.positions[data['state']]]
+            return _state_rank(data['state'], rank, mean, len(ranking))
+        return _ranking_page(ranking.top(k, offset, descending), offset, len(ranking))
+
+    # means computed for the request, partially sorted
+    means = _stratification_means(aggregates, question, category, stratification)
+    if 'state' in data:
+        return _state_rank(data['state'], rank_in(means, data['state'], descending),
+                           means.get(data['state']), len(means))
+    return _ranking_page(select(means, k, offset, descending), offset, len(means))
+
+def _state_rank(state: str, rank, mean, total: int):
+    """Helper building the result of /api/rank for a state"""
+    return {"state": state, "rank": rank, "mean": mean, "total": total}
+
+def _ranking_page(states: list, offset: int, total: int):
+    """Helper building the result of /api/rank for the (state, mean) pairs after offset"""
+    return {"total": total, "ranking": [{"rank": offset + index + 1, "state": state, "mean": mean}
+                                        for index, (state, mean) in enumerate(states)]}
+
+def calculate_global_mean(ingestor: DataIngestor, data: dict):
     """Helper function to calculate the global mean (/api/global_mean)"""
-    global_mean = 0
-    count = 0
-    for row in csv_data:
-        if row['Question'] == data['question']:
-            global_mean += float(row['Data_Value'])
-            count += 1
-
-    if count == 0:
+    values = _aggregates(ingestor, data).questions.get(data['question'])
+
+    if values is None:
         return {"global_mean": 0}
-    result = {"global_mean": global_mean / count}
+    result = {"global_mean": values[0] / values[1]}
     return result
 
-def calculate_diff_from_mean(csv_data: list, data: dict):
-    """Helper function to calculate the difference of each state from the global mean (/api/diff_from_mean)"""
-    states_mean = calculate_states_mean(csv_data, data)
-    global_mean = calculate_global_mean(csv_data, data)
+def calculate_diff_from_mean(ingestor: DataIngestor, data: dict):
+    """Helper function to calculate the difference of each state
+    from the global mean (/api/diff_from_mean)"""
+    return _diff_from_mean(calculate_states_mean(ingestor, data),\
+        calculate_global_mean(ingestor, data))
 
+def _diff_from_mean(states_mean: dict, global_mean: dict):
+    """Helper returning the difference of each state from the global mean"""
     diff_from_mean = {}
     for state, mean in states_mean.items():
         diff_from_mean[state] = global_mean['global_mean'] - mean
 
     return diff_from_mean
 
-def calculate_state_diff_from_mean(csv_data: list, data: dict):
-    """Helper function to calculate the difference of a specific state from the global mean (/api/state_diff_from_mean)"""
+def calculate_state_diff_from_mean(ingestor: DataIngestor, data: dict):
+    """Helper function to calculate the difference of a specific state
+    from the global mean (/api/state_diff_from_mean)"""
 
-    global_mean = calculate_global_mean(csv_data, data)
-    state_mean = calculate_state_mean(csv_data, data)
+    global_mean = calculate_global_mean(ingestor, data)
+    state_mean = calculate_state_mean(ingestor, data)
 
     diff_from_from_mean = {data['state']: global_mean['global_mean'] - state_mean[data['state']]}
 
     return diff_from_from_mean
 
-def calculate_mean_by_category(csv_data: list, data: dict):
+def calculate_mean_by_category(ingestor: DataIngestor, data: dict):
     """Helper function to calculate the mean of each category (/api/mean_by_category)"""
+    # keys and means are precomputed at ingest, sorted like a pandas groupby
+    keys, means = _aggregates(ingestor, data).category_results.get(data['question'], ([], []))
 
-    # converting data to a pandas dataframe for easier manipulation
-    dataframe = pd.DataFrame(csv_data)
-    # keeping only data that is relevant to the question (copying it to avoid modifying the original dataframe)
-    filtered_dataframe = dataframe[dataframe['Question'] == data['question']].copy()
-
-    # converting the data value to float
-    filtered_dataframe['Data_Value'] = pd.to_numeric(filtered_dataframe['Data_Value'], errors='coerce')
-
-    # calculating the mean of each category
-    mean_values = filtered_dataframe.groupby(['LocationDesc', 'StratificationCategory1',\
-        'Stratification1'])['Data_Value'].mean().reset_index(name='MeanDataValue')
-
-    result = {}
-    for _, row in mean_values.iterrows():
-        if row['LocationDesc'] != '' and \
-            row['StratificationCategory1'] != '' and \
-                row['Stratification1'] != '':
-            key = str((row['LocationDesc'], row['StratificationCategory1'], row['Stratification1']))
-            value = row['MeanDataValue']
-            result[key] = value
+    return dict(zip(keys, means))
 
-    return result
-
-def get_jobs_helper():
+def get_jobs_helper(thread_pool):
     """Helper function to get running jobs and done jobs (/api/jobs)"""
-    result = {}
-    for job_id, status in webserver.tasks_runner.jobs.items():
-        result[job_id] = status['status']
+    result = thread_pool.get_job_statuses()
 
     result['status'] = 'done'
 
     return result
 
-def calculate_state_mean_by_category(csv_data: list, data: dict):
-    """Helper function to calculate the mean of each category for a specific state (/api/state_mean_by_category)"""
-
-    # converting data to a pandas dataframe for easier manipulation
-    dataframe = pd.DataFrame(csv_data)
-    # keeping only data that is relevant to the question (copying it to avoid modifying the original dataframe)
-    filtered_dataframe = dataframe[(dataframe['Question'] == data['question'])\
-                                & (dataframe['LocationDesc'] == data['state'])].copy()
+def calculate_state_mean_by_category(ingestor: DataIngestor, data: dict):
+    """Helper function to calculate the mean of each category
+    for a specific state (/api/state_mean_by_category)"""
+    results = _aggregates(ingestor, data).state_category_results.get(data['question'], {})\
+        .get(data['state'])
 
     # case when the state is not found
-    if filtered_dataframe.empty:
+    if results is None:
         return {data['state']: 0}
 
-    # converting the data value to float
-    filtered_dataframe['Data_Value'] = pd.to_numeric(\
-        filtered_dataframe['Data_Value'], errors='coerce')
-
-    # calculating the mean of each category
-    mean_values = filtered_dataframe.groupby(['LocationDesc',\
-        'StratificationCategory1',\
-            'Stratification1'])['Data_Value'].mean().\
-                reset_index(name='MeanDataValue')
-
-    result = {}
-    dict_to_add = {}
-    # creating a dictionary with the mean of each category
-    for _, row in mean_values.iterrows():
-        if row['LocationDesc'] != '' and \
-            row['StratificationCategory1'] != '' and \
-                row['Stratification1'] != '':
-            key = str((row['StratificationCategory1'], row['Stratification1']))
-            value = row['MeanDataValue']
-            dict_to_add[key] = value
-    result[row['LocationDesc']] = dict_to_add
-    return result
+    keys, means = results
+    return {data['state']: dict(zip(keys, means))}
+
+# endpoints that can be part of a batch (/api/batch)
+CALCULATIONS = {
+    'states_mean': calculate_states_mean,
+    'state_mean': calculate_state_mean,
+    'best5': calculate_best5,
+    'worst5': calculate_worst5,
+    'global_mean': calculate_global_mean,
+    'diff_from_mean': calculate_diff_from_mean,
+    'state_diff_from_mean': calculate_state_diff_from_mean,
+    'mean_by_category': calculate_mean_by_category,
+    'state_mean_by_category': calculate_state_mean_by_category
+}
+
+# endpoints derived from the ranking of the states of a question: (ingestor, data, ranking)
+_FROM_RANKING = {
+    'states_mean': lambda ingestor, data, ranking: dict(ranking.items()),
+    'best5': lambda ingestor, data, ranking: _top5(ranking, data['question'],\
+        ingestor.questions_best_is_min),
+    'worst5': lambda ingestor, data, ranking: _top5(ranking, data['question'],\
+        ingestor.questions_best_is_max),
+    'diff_from_mean': lambda ingestor, data, ranking: _diff_from_mean(dict(ranking.items()),\
+        calculate_global_mean(ingestor, data))
+}
+
+def calculate_batch(ingestor: DataIngestor, data):
+    """Helper function running many requests as a single job (/api/batch).
+    data is a list of requests ({"endpoint": ..., "question": ..., "state": ..., "id": ...})
+    or {"requests": [...]}; the results are keyed by each request's id (default: its index)"""
+    sub_requests = data['requests'] if isinstance(data, dict) else data
+    results = [None] * len(sub_requests)
+
+    # grouping the requests by question (and years), the ranking of a question
+    # is read (or merged from the year partitions) once
+    groups = {}
+    for index, sub_request in enumerate(sub_requests):
+        groups.setdefault((sub_request.get('question'), sub_request.get('year_start'),
+                           sub_request.get('year_end')), []).append(index)
+
+    for (question, _, _), indexes in groups.items():
+        ranking = None
+        for index in indexes:
+            sub_request = sub_requests[index]
+            endpoint = sub_request.get('endpoint')
+            if endpoint not in CALCULATIONS:
+                results[index] = {"error": f"Invalid endpoint: {endpoint}"}
+            elif question is None or (endpoint.startswith('state_') and 'state' not in sub_request):
+                results[index] = {"error": "Missing question or state"}
+            elif endpoint in _FROM_RANKING:
+                if ranking is None:
+                    ranking = _aggregates(ingestor, sub_request).ranking(question)
+                results[index] = _FROM_RANKING[endpoint](ingestor, sub_request, ranking)
+            else:
+                results[index] = CALCULATIONS[endpoint](ingestor, sub_request)
+
+    return {str(sub_request.get('id', index)): results[index]
+            for index, sub_request in enumerate(sub_requests)}
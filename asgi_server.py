@@ -0,0 +1,14 @@
+"""ASGI entry point of the webserver (see app/asgi.py), served by uvicorn:
+    python asgi_server.py            (ASGI_HOST, ASGI_PORT, ASGI_BACKLOG)
+    uvicorn asgi_server:app --port 5000"""
+
+import os
+
+from app.asgi import app
+
+if __name__ == '__main__':
+    import uvicorn
+    # a large backlog, for thousands of clients connecting at once
+    uvicorn.run(app, host=os.getenv('ASGI_HOST', '127.0.0.1'),
+                port=int(os.getenv('ASGI_PORT', '5000')),
+                backlog=int(os.getenv('ASGI_BACKLOG', '4096')), log_level='warning')
@@ -0,0 +1,161 @@
+"""Load test holding thousands of concurrent requests open against the ASGI server
+(asgi_server.py), from a single asyncio process. Every connection replays the checker
+inputs (and the recorded requests) in a closed loop: it submits a job with ?wait=<seconds>,
+so the request stays open until the job is done and the response carries its result.
+Reports the peak number of open requests, the throughput and the latency percentiles.
+
+Usage:
+    python benchmarks/async_load_test.py [--url URL] [--connections N]
+        [--duration SECONDS] [--wait SECONDS] [--requests FILE.jsonl] [--json OUTPUT.json]"""
+
+import argparse
+import asyncio
+import json
+import resource
+import timeit
+from urllib.parse import urlsplit
+
+from load_test import Recorder, load_requests
+
+class Client:
+    """Class used for an HTTP/1.1 keep-alive connection, written with asyncio streams
+    so that thousands of them fit in one process"""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=b''):
+        """Sends a request and returns its status and body"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                          f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                          "\r\n".encode('latin-1') + body)
+        await self.writer.drain()
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionResetError("The server closed the connection")
+        status = int(line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                chunks.append(await self.reader.readexactly(size + 2))
+                if size == 0:
+                    break
+            response = b''.join(chunk[:-2] for chunk in chunks)
+        else:
+            response = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection') == 'close':
+            self.close()
+        return status, response
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class Gauge:
+    """Number of requests currently open, and its peak"""
+    def __init__(self):
+        self.value = 0
+        self.peak = 0
+
+    def inc(self):
+        self.value += 1
+        self.peak = max(self.peak, self.value)
+
+    def dec(self):
+        self.value -= 1
+
+async def connection(client, requests_list, offset, recorder, open_requests, deadline, wait):
+    """Closed loop of one connection: a new request is sent when the previous one is done"""
+    index = offset
+    while timeit.default_timer() < deadline:
+        endpoint, data = requests_list[index % len(requests_list)]
+        index += 1
+        start = timeit.default_timer()
+        open_requests.inc()
+        try:
+            status, body = await client.request('POST', f'/api/{endpoint}?wait={wait}',
+                                                json.dumps(data).encode('utf-8'))
+            result = json.loads(body)
+            job_id = result.get('job_id')
+            while status == 200 and 'data' not in result:
+                # not done within the wait, long polling the job
+                status, body = await client.request(
+                    'GET', f"/api/get_results/{job_id}?wait={wait}")
+                result = json.loads(body)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            client.close()
+            status = None
+        finally:
+            open_requests.dec()
+        if status == 200:
+            recorder.add(endpoint, {"total": timeit.default_timer() - start})
+        else:
+            recorder.add_error(endpoint)
+    client.close()
+
+async def run(args, requests_list, recorder):
+    """Opens the connections and runs them for the duration, returns the elapsed time
+    and the peak number of open requests"""
+    url = urlsplit(args.url)
+    open_requests = Gauge()
+    start = timeit.default_timer()
+    deadline = start + args.duration
+    await asyncio.gather(*(
+        connection(Client(url.hostname, url.port or 80), requests_list, index, recorder,
+                   open_requests, deadline, args.wait)
+        for index in range(args.connections)))
+    return timeit.default_timer() - start, open_requests.peak
+
+def main():
+    """Runs the load test and prints (or saves) the report"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--wait', type=float, default=10)
+    parser.add_argument('--requests', action='append', default=[])
+    parser.add_argument('--json', default=None, help='file receiving the report as JSON')
+    args = parser.parse_args()
+
+    # one file descriptor per connection
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < args.connections + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, args.connections + 64), hard))
+
+    requests_list = load_requests(args.requests)
+    recorder = Recorder()
+    elapsed, peak = asyncio.run(run(args, requests_list, recorder))
+
+    report = recorder.report(elapsed)
+    report["peak_open_requests"] = peak
+    report["config"] = {"url": args.url, "connections": args.connections,
+                        "duration": args.duration, "wait": args.wait,
+                        "requests": len(requests_list)}
+    errors = sum(recorder.errors.values())
+    print(f"connections: {args.connections}, peak open requests: {peak}, errors: {errors}")
+    print(f"throughput: {report['throughput']:.1f} req/s in {elapsed:.1f} s")
+    print(f"{'endpoint':<24}{'count':>7}{'err':>5}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}")
+    for endpoint, entry in report["endpoints"].items():
+        total = entry.get('total') or {}
+        print(f"{endpoint:<24}{entry['count']:>7}{entry['errors']:>5}" +
+              ''.join(f"{total.get(name, 0):>10.1f}" for name in ('p50', 'p95', 'p99')))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == '__main__':
+    main()
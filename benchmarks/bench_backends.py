@@ -0,0 +1,73 @@
+"""Benchmark showing the throughput (jobs/s) of the thread and process backends of
+ThreadPool for CPU-bound pure-Python jobs, for an increasing number of workers.
+
+Usage: python benchmarks/bench_backends.py [csv_path] [jobs]"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from app import webserver
+from app.data_ingestor import DataIngestor
+from app.task_runner import ThreadPool
+
+def python_states_mean(ingestor, data):
+    """Pure-Python row loop (the GIL is held for the whole job)"""
+    question = ingestor.code_of('Question', data['question'])
+    states_values = {}
+    for row_question, state, value in zip(ingestor.columns['Question'].tolist(),
+                                          ingestor.columns['LocationDesc'].tolist(),
+                                          ingestor.columns['Data_Value'].tolist()):
+        if row_question == question:
+            values = states_values.setdefault(state, [0.0, 0])
+            values[0] += value
+            values[1] += 1
+    return {ingestor.dictionaries['LocationDesc'][state]: values[0] / values[1]
+            for state, values in states_values.items()}
+
+def run(backend, workers, ingestor, num_jobs):
+    """Returns the throughput of a pool with the given backend and number of workers"""
+    os.environ['TP_BACKEND'] = backend
+    os.environ['TP_NUM_OF_THREADS'] = str(workers)
+    os.environ['TP_NUM_OF_PROCESSES'] = str(workers)
+    pool = ThreadPool()
+    pool.share(ingestor)
+    questions = ingestor.dictionaries['Question']
+    try:
+        start = timeit.default_timer()
+        for i in range(num_jobs):
+            pool.add_task(python_states_mean, ingestor, {'question': questions[i % len(questions)]})
+        pool.task_queue.join()
+        return num_jobs / (timeit.default_timer() - start)
+    finally:
+        pool.graceful_shutdown()
+
+def main():
+    """Prints the throughput of both backends for 1, 2, 4, ... workers"""
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else './nutrition_activity_obesity_usa_subset.csv'
+    num_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    ingestor = DataIngestor(csv_path)
+    print(f"rows: {len(ingestor)}, jobs: {num_jobs}, cpus: {os.cpu_count()}")
+
+    workers = [1]
+    while workers[-1] * 2 <= os.cpu_count():
+        workers.append(workers[-1] * 2)
+
+    # the jobs write their results in results/, keeping them out of the repository
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        os.makedirs('results')
+        print(f"{'workers':>8}{'thread (jobs/s)':>18}{'process (jobs/s)':>18}")
+        for count in workers:
+            print(f"{count:>8}{run('thread', count, ingestor, num_jobs):>18.1f}"
+                  f"{run('process', count, ingestor, num_jobs):>18.1f}")
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,133 @@
+"""Microbenchmark comparing the per-request cost of every endpoint when it scans
+the rows (before) and when it is answered from the aggregate tables (after).
+
+Usage: python benchmarks/bench_endpoints.py [csv_path] [repeats]"""
+
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from app import webserver
+from app.data_ingestor import DataIngestor
+from app.utilities import utils
+
+def _mask(ingestor, data, with_state=False):
+    mask = ingestor.columns['Question'] == ingestor.code_of('Question', data['question'])
+    if with_state:
+        mask &= ingestor.columns['LocationDesc'] == ingestor.code_of('LocationDesc',
+                                                                      data['state'])
+    return mask
+
+def scan_states_mean(ingestor, data):
+    """Row scan version of calculate_states_mean"""
+    mask = _mask(ingestor, data)
+    locations = ingestor.columns['LocationDesc'][mask]
+    sums = np.bincount(locations, weights=ingestor.columns['Data_Value'][mask])
+    counts = np.bincount(locations)
+    codes, first_rows = np.unique(locations, return_index=True)
+    codes = codes[np.argsort(first_rows, kind='stable')]
+    states_mean = dict(zip(ingestor.decode('LocationDesc', codes),
+                           (sums[codes] / counts[codes]).tolist()))
+    return dict(sorted(states_mean.items(), key=lambda item: item[1]))
+
+def scan_state_mean(ingestor, data):
+    """Row scan version of calculate_state_mean"""
+    values = ingestor.columns['Data_Value'][_mask(ingestor, data, True)]
+    if len(values) == 0:
+        return {data['state']: 0}
+    return {data['state']: float(np.cumsum(values)[-1]) / len(values)}
+
+def scan_best5(ingestor, data):
+    """Row scan version of calculate_best5"""
+    states_mean = list(scan_states_mean(ingestor, data).items())
+    if data['question'] in ingestor.questions_best_is_min:
+        return dict(states_mean[:5])
+    return dict(states_mean[-5:])
+
+def scan_worst5(ingestor, data):
+    """Row scan version of calculate_worst5"""
+    states_mean = list(scan_states_mean(ingestor, data).items())
+    if data['question'] in ingestor.questions_best_is_max:
+        return dict(states_mean[:5])
+    return dict(states_mean[-5:])
+
+def scan_global_mean(ingestor, data):
+    """Row scan version of calculate_global_mean"""
+    values = ingestor.columns['Data_Value'][_mask(ingestor, data)]
+    if len(values) == 0:
+        return {"global_mean": 0}
+    return {"global_mean": float(np.cumsum(values)[-1]) / len(values)}
+
+def scan_diff_from_mean(ingestor, data):
+    """Row scan version of calculate_diff_from_mean"""
+    global_mean = scan_global_mean(ingestor, data)['global_mean']
+    return {state: global_mean - mean
+            for state, mean in scan_states_mean(ingestor, data).items()}
+
+def scan_state_diff_from_mean(ingestor, data):
+    """Row scan version of calculate_state_diff_from_mean"""
+    global_mean = scan_global_mean(ingestor, data)['global_mean']
+    return {data['state']: global_mean - scan_state_mean(ingestor, data)[data['state']]}
+
+def _scan_categories(ingestor, mask):
+    frame = {}
+    for name in ('LocationDesc', 'StratificationCategory1', 'Stratification1'):
+        dictionary = np.array(ingestor.dictionaries[name], dtype=object)
+        frame[name] = dictionary[ingestor.columns[name][mask]]
+    frame['Data_Value'] = ingestor.columns['Data_Value'][mask]
+    frame = pd.DataFrame(frame)
+    frame = frame[(frame['LocationDesc'] != '') & (frame['StratificationCategory1'] != '')
+                  & (frame['Stratification1'] != '')]
+    return frame.groupby(['LocationDesc', 'StratificationCategory1',
+                          'Stratification1'])['Data_Value'].mean()
+
+def scan_mean_by_category(ingestor, data):
+    """Row scan version of calculate_mean_by_category"""
+    means = _scan_categories(ingestor, _mask(ingestor, data))
+    return {str(key): value for key, value in means.items()}
+
+def scan_state_mean_by_category(ingestor, data):
+    """Row scan version of calculate_state_mean_by_category"""
+    mask = _mask(ingestor, data, True)
+    if not mask.any():
+        return {data['state']: 0}
+    means = _scan_categories(ingestor, mask)
+    return {data['state']: {str(key[1:]): value for key, value in means.items()}}
+
+ENDPOINTS = ['states_mean', 'state_mean', 'best5', 'worst5', 'global_mean', 'diff_from_mean',
+             'state_diff_from_mean', 'mean_by_category', 'state_mean_by_category']
+
+def main():
+    """Times every endpoint before and after and prints the results as a table"""
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else './nutrition_activity_obesity_usa_subset.csv'
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    ingest_start = timeit.default_timer()
+    ingestor = DataIngestor(csv_path)
+    print(f"rows: {len(ingestor)}, ingest: {timeit.default_timer() - ingest_start:.3f} s")
+
+    question = ingestor.dictionaries['Question'][0]
+    state = ingestor.dictionaries['LocationDesc'][0]
+    data = {'question': question, 'state': state}
+
+    print(f"{'endpoint':<24}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for endpoint in ENDPOINTS:
+        before = globals()['scan_' + endpoint]
+        after = getattr(utils, 'calculate_' + endpoint)
+        before_us = min(timeit.repeat(lambda: before(ingestor, data),
+                                      number=repeats, repeat=3)) / repeats * 1e6
+        after_us = min(timeit.repeat(lambda: after(ingestor, data),
+                                     number=repeats, repeat=3)) / repeats * 1e6
+        print(f"{endpoint:<24}{before_us:>14.1f}{after_us:>14.1f}{before_us / after_us:>9.1f}x")
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,68 @@
+"""Benchmark showing the cost of the logger calls made on the request path, for the
+previous setup (synchronous writes, rotation every 1000 bytes) and the new ones
+(queue-backed writes, larger rotation size, sampling of the high-volume messages).
+
+Usage: python benchmarks/bench_logging.py [calls] [threads]"""
+
+import os
+import sys
+import tempfile
+import timeit
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from app import webserver
+from app.config import logger_config
+
+# (name, mode, max_bytes, sample_every)
+SETUPS = [
+    ('sync, 1000 B rotation', 'sync', 1000, 1),
+    ('sync, 10 MiB rotation', 'sync', 10 * 1024 * 1024, 1),
+    ('queue, 10 MiB rotation', 'queue', 10 * 1024 * 1024, 1),
+    ('queue, sampling 1/10', 'queue', 10 * 1024 * 1024, 10),
+]
+
+def log_requests(logger, calls):
+    """The logger calls made for a job request and one result poll"""
+    for i in range(calls):
+        logger.info("Received request for state_mean")
+        logger.info("Job %s added to the queue", f"job_id_{i}")
+        logger.info("Getting results for job_id: %s", f"job_id_{i}")
+        logger.info("Job %s is done", f"job_id_{i}")
+
+def run(setup, calls, threads):
+    """Returns the time (microseconds) a request thread spends in one logger call"""
+    _, mode, max_bytes, sample_every = setup
+    with tempfile.TemporaryDirectory() as directory:
+        logger = logger_config.setup_logger(os.path.join(directory, 'bench.log'), mode,
+                                            max_bytes, sample_every)
+        workers = [Thread(target=log_requests, args=(logger, calls)) for _ in range(threads)]
+        start = timeit.default_timer()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = timeit.default_timer() - start
+        # the queued records are written before the directory is removed
+        logger_config.setup_logger(os.path.join(directory, 'bench.log'), 'sync')
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+    return elapsed / (calls * 4) * threads * 1e6
+
+def main():
+    """Prints the cost of a logger call for each setup"""
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print(f"calls per thread: {calls * 4}, threads: {threads}")
+    print(f"{'setup':<28}{'us per call':>14}")
+    for setup in SETUPS:
+        print(f"{setup[0]:<28}{run(setup, calls, threads):>14.2f}")
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,63 @@
+"""Benchmark of the cost of serializing the result of every endpoint: the previous path
+(json.dumps in the worker, json.loads when the result is read, jsonify again in the
+response) against the current one (encoded once, the stored bytes are sent as they are),
+and the cost and gain of compressing the body with gzip.
+
+Usage: python benchmarks/bench_serialization.py [csv_path] [repeats]"""
+
+import json
+import os
+import sys
+import timeit
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from app import webserver
+from app.data_ingestor import DataIngestor
+from app.utilities.utils import CALCULATIONS
+
+def three_passes(result):
+    """Previous path: encoded by the worker, decoded and encoded again for the response"""
+    payload = json.dumps(result).encode('utf-8')
+    return json.dumps({"status": "done", "data": json.loads(payload)}).encode('utf-8')
+
+def one_pass(result):
+    """Current path: encoded by the worker, the envelope is added around the bytes"""
+    return b''.join([b'{"status": "done", "data": ', json.dumps(result).encode('utf-8'), b'}'])
+
+def _time_us(function, repeats):
+    return min(timeit.repeat(function, number=repeats, repeat=3)) / repeats * 1e6
+
+def main():
+    """Prints the size and serialization times of the largest result of every endpoint"""
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else './nutrition_activity_obesity_usa_subset.csv'
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    ingestor = DataIngestor(csv_path)
+    print(f"rows: {len(ingestor)}")
+    state = ingestor.dictionaries['LocationDesc'][0]
+
+    print(f"{'endpoint':<24}{'bytes':>10}{'3 passes (us)':>15}{'1 pass (us)':>13}"
+          f"{'gzip-1 (us)':>13}{'ratio':>7}{'gzip-6 (us)':>13}{'ratio':>7}")
+    for endpoint, calculate in CALCULATIONS.items():
+        # the largest result of the endpoint over the questions
+        results = [calculate(ingestor, {'question': question, 'state': state})
+                   for question in ingestor.dictionaries['Question']]
+        result = max(results, key=lambda result: len(json.dumps(result)))
+        body = one_pass(result)
+        line = f"{endpoint:<24}{len(body):>10}"
+        line += f"{_time_us(lambda: three_passes(result), repeats):>15.1f}"
+        line += f"{_time_us(lambda: one_pass(result), repeats):>13.1f}"
+        for level in (1, 6):
+            compressed = zlib.compress(body, level, wbits=31)
+            line += f"{_time_us(lambda: zlib.compress(body, level, wbits=31), repeats):>13.1f}"
+            line += f"{len(body) / len(compressed):>7.1f}"
+        print(line)
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,228 @@
+"""Load test replaying the checker inputs (tests/<endpoint>/input/*.json) and recorded
+requests against the webserver, reporting the throughput and the p50/p95/p99 latency
+of each endpoint, split into submit (POST), queue and compute time (server timings).
+
+Usage:
+    python benchmarks/load_test.py [--url URL] [--concurrency N | --rate R]
+        [--duration SECONDS] [--requests FILE.jsonl] [--inprocess [--csv CSV]]
+        [--json OUTPUT.json]
+
+Recorded requests are JSON lines {"endpoint": "state_mean", "data": {...}}.
+--concurrency N keeps N requests in flight (closed loop); --rate R starts R requests
+per second whatever the latency (open loop, latencies are measured from the time a
+request was scheduled). --inprocess calls the functions of app/utilities/utils.py
+directly, without the webserver."""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def load_requests(paths):
+    """Returns the (endpoint, data) of the checker inputs and of the recorded requests"""
+    requests_list = []
+    for path in sorted(glob.glob(os.path.join(ROOT, 'tests', '*', 'input', '*.json'))):
+        endpoint = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        with open(path, encoding='utf-8') as file:
+            requests_list.append((endpoint, json.load(file)))
+    for path in paths:
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    requests_list.append((record['endpoint'], record.get('data', {})))
+    return requests_list
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of values"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(fraction * len(ordered) + 0.5) - 1))]
+
+class Recorder:
+    """Class used for collecting the timings of the requests, by endpoint"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {} # endpoint -> {phase: [seconds]}
+        self.errors = {} # endpoint -> number of failed requests
+
+    def add(self, endpoint, timings):
+        with self.lock:
+            phases = self.samples.setdefault(endpoint, {})
+            for phase, seconds in timings.items():
+                if seconds is not None:
+                    phases.setdefault(phase, []).append(seconds)
+
+    def add_error(self, endpoint):
+        with self.lock:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed):
+        """Returns the throughput and latency percentiles (milliseconds) of each endpoint"""
+        report = {"elapsed": elapsed, "endpoints": {}}
+        total = 0
+        for endpoint in sorted(set(self.samples) | set(self.errors)):
+            phases = self.samples.get(endpoint, {})
+            count = len(phases.get('total', []))
+            total += count
+            entry = {"count": count, "errors": self.errors.get(endpoint, 0),
+                     "throughput": count / elapsed if elapsed else None}
+            for phase, values in phases.items():
+                entry[phase] = {name: percentile(values, fraction) * 1000
+                                for name, fraction in (('p50', 0.5), ('p95', 0.95),
+                                                       ('p99', 0.99))}
+            report["endpoints"][endpoint] = entry
+        report["throughput"] = total / elapsed if elapsed else None
+        return report
+
+def http_request(session, url, endpoint, data):
+    """Submits a request and waits for its result, returning its timings (seconds)"""
+    start = timeit.default_timer()
+    response = session.post(f"{url}/api/{endpoint}", json=data, timeout=60)
+    submitted = timeit.default_timer()
+    response.raise_for_status()
+    job_id = response.json()['job_id']
+    while True:
+        # long polling, the server answers as soon as the job is done
+        result = session.get(f"{url}/api/get_results/{job_id}",
+                             params={'wait': 10, 'timings': 1}, timeout=60).json()
+        if result['status'] != 'running':
+            break
+    if result['status'] != 'done':
+        raise RuntimeError(result.get('reason'))
+    server = result.get('timings') or {}
+    return {"submit": submitted - start, "queue": server.get('queue'),
+            "compute": server.get('compute'), "total": timeit.default_timer() - start}
+
+def inprocess_request(ingestor, functions, endpoint, data):
+    """Computes and serializes a request with the functions of utils.py"""
+    start = timeit.default_timer()
+    result = functions[endpoint](ingestor, data)
+    computed = timeit.default_timer()
+    json.dumps(result)
+    end = timeit.default_timer()
+    return {"compute": computed - start, "serialize": end - computed, "total": end - start}
+
+def run(send, requests_list, recorder, concurrency, rate, duration):
+    """Sends the requests (in a loop) for duration seconds, returns the elapsed time"""
+    start = timeit.default_timer()
+    deadline = start + duration
+
+    def send_one(index, scheduled):
+        endpoint, data = requests_list[index % len(requests_list)]
+        try:
+            timings = send(endpoint, data)
+        except Exception: # pylint: disable=broad-except
+            recorder.add_error(endpoint)
+            return
+        if scheduled is not None:
+            # open loop: the time waited for a free sender counts as latency
+            timings["total"] = timeit.default_timer() - scheduled
+        recorder.add(endpoint, timings)
+
+    if rate:
+        # open loop, a request is started every 1 / rate seconds
+        with ThreadPoolExecutor(max_workers=max(concurrency, 64)) as executor:
+            index = 0
+            while True:
+                scheduled = start + index / rate
+                if scheduled >= deadline:
+                    break
+                delay = scheduled - timeit.default_timer()
+                if delay > 0:
+                    threading.Event().wait(delay)
+                executor.submit(send_one, index, scheduled)
+                index += 1
+    else:
+        # closed loop, each sender starts a new request when the previous one is done
+        counter = iter(range(sys.maxsize))
+        lock = threading.Lock()
+
+        def sender():
+            while timeit.default_timer() < deadline:
+                with lock:
+                    index = next(counter)
+                send_one(index, None)
+
+        senders = [threading.Thread(target=sender) for _ in range(concurrency)]
+        for thread in senders:
+            thread.start()
+        for thread in senders:
+            thread.join()
+    return timeit.default_timer() - start
+
+def print_report(report):
+    """Prints the report as a table"""
+    phases = ['total', 'submit', 'queue', 'compute', 'serialize']
+    print(f"throughput: {report['throughput']:.1f} req/s in {report['elapsed']:.1f} s")
+    header = f"{'endpoint':<24}{'count':>7}{'err':>5}{'req/s':>9}"
+    print(header + ''.join(f"{phase + ' p50/p95/p99 (ms)':>32}" for phase in phases))
+    for endpoint, entry in report["endpoints"].items():
+        line = f"{endpoint:<24}{entry['count']:>7}{entry['errors']:>5}{entry['throughput']:>9.1f}"
+        for phase in phases:
+            values = entry.get(phase)
+            cell = '/'.join(f"{values[name]:.2f}" for name in ('p50', 'p95', 'p99'))\
+                if values else '-'
+            line += f"{cell:>32}"
+        print(line)
+
+def main():
+    """Runs the load test and prints (or saves) the report"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=None)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--requests', action='append', default=[])
+    parser.add_argument('--inprocess', action='store_true')
+    parser.add_argument('--csv', default=os.path.join(ROOT,
+                                                      'nutrition_activity_obesity_usa_subset.csv'))
+    parser.add_argument('--json', default=None, help='file receiving the report as JSON')
+    args = parser.parse_args()
+
+    requests_list = load_requests(args.requests)
+    recorder = Recorder()
+    if args.inprocess:
+        sys.path.insert(0, ROOT)
+        # pylint: disable=import-outside-toplevel
+        from app import webserver
+        from app.data_ingestor import DataIngestor
+        from app.utilities.utils import CALCULATIONS
+        try:
+            ingestor = DataIngestor(args.csv)
+            elapsed = run(lambda endpoint, data: inprocess_request(ingestor, CALCULATIONS,
+                                                                   endpoint, data),
+                          requests_list, recorder, args.concurrency, args.rate, args.duration)
+        finally:
+            webserver.tasks_runner.graceful_shutdown()
+    else:
+        import requests # pylint: disable=import-outside-toplevel
+        sessions = threading.local()
+
+        def send(endpoint, data):
+            if not hasattr(sessions, 'session'):
+                sessions.session = requests.Session()
+            return http_request(sessions.session, args.url.rstrip('/'), endpoint, data)
+
+        elapsed = run(send, requests_list, recorder, args.concurrency, args.rate,
+                      args.duration)
+
+    report = recorder.report(elapsed)
+    report["config"] = {"mode": "inprocess" if args.inprocess else "http", "url": args.url,
+                        "concurrency": args.concurrency, "rate": args.rate,
+                        "duration": args.duration, "requests": len(requests_list)}
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == '__main__':
+    main()
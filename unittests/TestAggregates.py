@@ -0,0 +1,43 @@
+import unittest
+
+import pandas as pd
+
+from app.data_ingestor import DataIngestor
+
+
+class TestAggregates(unittest.TestCase):
+    def setUp(self):
+        self.frame = pd.read_csv('unittests_data.csv')
+        self.aggregates = DataIngestor('unittests_data.csv').aggregates
+
+    def test_tables(self):
+        # the same sums and counts as a pandas groupby of the rows
+        for question, rows in self.frame.groupby('Question', sort=False):
+            total, count = self.aggregates.questions[question]
+            self.assertAlmostEqual(total, rows['Data_Value'].sum())
+            self.assertEqual(count, rows['Data_Value'].count())
+            states = rows.groupby('LocationDesc', sort=False)['Data_Value'].agg(['sum', 'count'])
+            self.assertEqual(list(self.aggregates.states[question]), list(states.index))
+            for state, (total, count) in self.aggregates.states[question].items():
+                self.assertAlmostEqual(total, states['sum'][state])
+                self.assertEqual(count, states['count'][state])
+        self.assertNotIn('Atlantis', self.aggregates.questions)
+
+    def test_category_results(self):
+        # the precomputed *_by_category results are the means of a pandas groupby
+        keys = ['LocationDesc', 'StratificationCategory1', 'Stratification1']
+        for question, rows in self.frame.groupby('Question', sort=False):
+            means = rows.dropna(subset=keys).groupby(keys)['Data_Value'].mean()
+            result_keys, result_means = self.aggregates.category_results[question]
+            self.assertEqual(result_keys, [str(key) for key in means.index])
+            for result_mean, mean in zip(result_means, means):
+                self.assertAlmostEqual(result_mean, mean)
+            for state, (state_keys, state_means) in \
+                    self.aggregates.state_category_results[question].items():
+                self.assertEqual(state_keys, [str(key) for key in means[state].index])
+                self.assertEqual(state_means, means[state].tolist())
+
+
+from app import webserver
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import unittest
+
+from app import webserver
+from app.asgi import app
+from app.data_ingestor import DataIngestor
+from app.task_runner import ThreadPool
+
+
+async def call(method, path, body=None):
+    """Runs a request through the ASGI application, returns its status and JSON body"""
+    path, _, query_string = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': [],
+             'query_string': query_string.encode(), 'client': ('127.0.0.1', 1234)}
+    messages = [{'type': 'http.request', 'body': json.dumps(body).encode() if body else b''}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]['status'], json.loads(b''.join(message.get('body', b'')
+                                                  for message in sent[1:]))
+
+
+class TestAsgi(unittest.TestCase):
+    def setUp(self):
+        # the webserver's pool is shut down when the tests are loaded
+        self.tasks_runner = webserver.tasks_runner
+        self.data_ingestor = webserver.data_ingestor
+        webserver.tasks_runner = ThreadPool()
+        webserver.data_ingestor = DataIngestor('unittests_data.csv')
+        self.question = 'Percent of adults aged 18 years and older who have obesity'
+
+    def tearDown(self):
+        webserver.tasks_runner.graceful_shutdown()
+        webserver.tasks_runner = self.tasks_runner
+        webserver.data_ingestor = self.data_ingestor
+
+    def test_awaited_job(self):
+        status, result = asyncio.run(call('POST', '/api/state_mean?wait=5',
+                                          {"question": self.question, "state": "Ohio"}))
+        self.assertEqual(status, 200)
+        self.assertEqual(result['data'], {"Ohio": 29.4})
+        # the result is kept for /api/get_results
+        status, stored = asyncio.run(call('GET', f"/api/get_results/{result['job_id']}"))
+        self.assertEqual((status, stored), (200, {"status": "done", "data": {"Ohio": 29.4}}))
+
+    def test_errors(self):
+        status, _ = asyncio.run(call('GET', '/api/get_results/job_id_0'))
+        self.assertEqual(status, 404)
+        status, result = asyncio.run(call('POST', '/api/rank', {"question": self.question,
+                                                                "k": -1}))
+        self.assertEqual((status, result['status']), (400, "error"))
+        status, result = asyncio.run(call('POST', '/api/state_mean?sync=1', {
+            "question": self.question, "state": "Ohio", "year_start": "abc"}))
+        self.assertEqual((status, result['status']), (400, "error"))
+        # a task that raises on the synchronous path gives the JSON error envelope
+        status, result = asyncio.run(call('POST', '/api/state_mean?sync=1',
+                                          {"question": self.question}))
+        self.assertEqual((status, result['status']), (500, "error"))
+        self.assertIn("KeyError", result['reason'])
+        status, stored = asyncio.run(call('GET', f"/api/get_results/{result['job_id']}"))
+        self.assertEqual((status, stored['reason']), (500, result['reason']))
+        # the synchronous path is refused once the pool is shutting down
+        webserver.tasks_runner.graceful_shutdown()
+        status, result = asyncio.run(call('POST', '/api/global_mean?sync=1',
+                                          {"question": self.question}))
+        self.assertEqual((status, result['reason']), (503, "Shutting down"))
+        # the other routes are served by the Flask application
+        status, result = asyncio.run(call('GET', '/api/num_jobs'))
+        self.assertEqual((status, result), (200, {"num_jobs": 0}))
+
+
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
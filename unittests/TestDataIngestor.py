@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from app.data_ingestor import DataIngestor
+
+
+class TestDataIngestor(unittest.TestCase):
+    def setUp(self):
+        self.ingestor = DataIngestor('unittests_data.csv')
+
+    def test_columns(self):
+        self.assertEqual(len(self.ingestor), 16)
+        question = self.ingestor.columns['Question'][0]
+        self.assertEqual(self.ingestor.dictionaries['Question'][question],
+                         'Percent of adults aged 18 years and older who have obesity')
+        self.assertEqual(self.ingestor.code_of('LocationDesc', 'Atlantis'), -1)
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            saved = DataIngestor('unittests_data.csv', snapshot_dir=snapshot_dir)
+            self.assertEqual(len(os.listdir(snapshot_dir)), 1)
+            loaded = DataIngestor('unittests_data.csv', snapshot_dir=snapshot_dir)
+            # the second ingestor maps the saved columns instead of parsing the CSV
+            self.assertIsInstance(loaded.columns['Data_Value'], np.memmap)
+            for name, column in saved.columns.items():
+                np.testing.assert_array_equal(loaded.columns[name], column)
+            self.assertEqual(loaded.dictionaries, saved.dictionaries)
+            self.assertEqual(loaded.aggregates.categories, self.ingestor.aggregates.categories)
+            self.assertEqual(loaded.aggregates.states, self.ingestor.aggregates.states)
+
+    def test_old_snapshots_are_removed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'data.csv')
+            shutil.copy('unittests_data.csv', csv_path)
+            snapshot_dir = os.path.join(directory, 'snapshots')
+            DataIngestor(csv_path, snapshot_dir=snapshot_dir)
+            DataIngestor('unittests_data.csv', snapshot_dir=snapshot_dir)
+            old_snapshots = set(os.listdir(snapshot_dir))
+            # a new version of the CSV replaces its snapshot, the other CSV's one is kept
+            os.utime(csv_path, ns=(0, 0))
+            DataIngestor(csv_path, snapshot_dir=snapshot_dir)
+            snapshots = set(os.listdir(snapshot_dir))
+            self.assertEqual(len(snapshots), 2)
+            self.assertEqual(len(snapshots & old_snapshots), 1)
+            self.assertTrue(all(name.startswith('unittests_data-')
+                                for name in snapshots & old_snapshots))
+
+    def test_streaming(self):
+        streamed = DataIngestor('unittests_data.csv', chunk_rows=5)
+        self.assertEqual(len(streamed), 16)
+        # the rows are folded chunk by chunk and not kept
+        self.assertEqual(streamed.columns, {})
+        self.assertEqual(list(streamed.aggregates.states),
+                         list(self.ingestor.aggregates.states))
+        for question, states in self.ingestor.aggregates.states.items():
+            self.assertEqual(list(streamed.aggregates.states[question]), list(states))
+            for state, (total, count) in states.items():
+                streamed_total, streamed_count = streamed.aggregates.states[question][state]
+                self.assertAlmostEqual(streamed_total, total)
+                self.assertEqual(streamed_count, count)
+        for question, (keys, means) in self.ingestor.aggregates.category_results.items():
+            streamed_keys, streamed_means = streamed.aggregates.category_results[question]
+            self.assertEqual(streamed_keys, keys)
+            for streamed_mean, mean in zip(streamed_means, means):
+                self.assertAlmostEqual(streamed_mean, mean)
+
+    def test_append(self):
+        frame = pd.read_csv('unittests_data.csv', keep_default_na=False)
+        ingestor = DataIngestor('unittests_data.csv')
+        questions = ingestor.append(frame.iloc[:3])
+        self.assertEqual(questions, set(frame['Question'][:3]))
+        self.assertEqual(len(ingestor), 19)
+        self.assertEqual(len(ingestor.get_columns()['Data_Value']), 19)
+        # the appended rows are counted twice
+        for question in questions:
+            total, count = self.ingestor.aggregates.questions[question]
+            rows = frame.iloc[:3][frame['Question'][:3] == question]
+            self.assertAlmostEqual(ingestor.aggregates.questions[question][0],
+                                   total + rows['Data_Value'].sum())
+            self.assertEqual(ingestor.aggregates.questions[question][1], count + len(rows))
+        with self.assertRaises(ValueError):
+            ingestor.append(frame[['Question']])
+
+    def test_year_range(self):
+        frame = pd.read_csv('unittests_data.csv')
+        question = frame['Question'][0]
+        rows = frame[(frame['Question'] == question) & (frame['YearStart'] >= 2017)
+                     & (frame['YearEnd'] <= 2019)]
+        aggregates = self.ingestor.aggregates.for_years(question, 2017, 2019)
+        total, count = aggregates.questions[question]
+        self.assertAlmostEqual(total, rows['Data_Value'].sum())
+        self.assertEqual(count, len(rows))
+        self.assertEqual(set(aggregates.states[question]), set(rows['LocationDesc']))
+        # without bounds, every partition is merged
+        aggregates = self.ingestor.aggregates.for_years(question)
+        total, count = self.ingestor.aggregates.questions[question]
+        self.assertAlmostEqual(aggregates.questions[question][0], total)
+        self.assertEqual(aggregates.questions[question][1], count)
+        self.assertEqual(self.ingestor.aggregates.for_years(question, 2030).questions, {})
+
+
+from app import webserver
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+from threading import Event
+
+from app.data_ingestor import DataIngestor
+from app.data_reloader import DataReloader
+
+
+class TestDataReloader(unittest.TestCase):
+    def setUp(self):
+        self.served = []
+        self.reloader = DataReloader('unittests_data.csv', DataIngestor, self.served.append,
+                                     interval=0)
+
+    def test_reload_swaps_new_version(self):
+        self.assertTrue(self.reloader.reload())
+        self.reloader.wait(10)
+        status = self.reloader.get_status()
+        self.assertEqual(status["status"], "idle")
+        self.assertEqual(status["version"], 1)
+        self.assertEqual(len(self.served), 1)
+        self.assertEqual(self.served[0].version, 1)
+        self.assertEqual(len(self.served[0]), 16)
+
+    def test_one_reload_at_a_time(self):
+        release = Event()
+        reloader = DataReloader('unittests_data.csv',
+                                lambda path: release.wait(10) and DataIngestor(path),
+                                self.served.append, interval=0)
+        self.assertTrue(reloader.reload())
+        self.assertFalse(reloader.reload())
+        self.assertEqual(reloader.get_status()["status"], "loading")
+        release.set()
+        reloader.wait(10)
+        self.assertTrue(reloader.reload())
+        reloader.wait(10)
+        self.assertEqual([ingestor.version for ingestor in self.served], [1, 2])
+
+    def test_failed_reload_keeps_data(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            with open(os.path.join(data_dir, 'invalid.csv'), 'w', encoding='utf-8') as file:
+                file.write('a,b\n1,2\n')
+            reloader = DataReloader('unittests_data.csv', DataIngestor, self.served.append,
+                                    interval=0, data_dir=data_dir)
+            reloader.reload('invalid.csv')
+            reloader.wait(10)
+        status = reloader.get_status()
+        self.assertEqual(status["status"], "failed")
+        self.assertEqual(status["version"], 0)
+        self.assertEqual(status["csv_path"], 'unittests_data.csv')
+        self.assertEqual(self.served, [])
+
+    def test_only_csv_files_of_the_data_directory(self):
+        for csv_path in ('missing.csv', '/dev/zero', '../unittests_data.csv', 'unittests',
+                         'app/routes.py', 1):
+            with self.assertRaises(ValueError):
+                self.reloader.reload(csv_path)
+        self.assertEqual(self.reloader.get_status()["status"], "idle")
+
+
+from app import webserver
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+
+from app.config import logger_config
+from app.config.logger_config import setup_logger
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'test.log')
+
+    def tearDown(self):
+        # the webserver's logger writes to webserver.log again
+        setup_logger()
+        self.directory.cleanup()
+
+    def read_lines(self):
+        # stopping the listener writes the records still queued
+        logger_config._stop_listener()
+        with open(self.filename, encoding='utf-8') as file:
+            return file.read().splitlines()
+
+    def test_queued_records_are_written(self):
+        logger = setup_logger(self.filename, mode='queue')
+        self.assertIsNotNone(logger_config._listener)
+        for index in range(100):
+            logger.info("Job %s is done", f"job_id_{index}")
+        lines = self.read_lines()
+        self.assertEqual(len(lines), 100)
+        self.assertTrue(lines[0].endswith(" - INFO - Job job_id_0 is done"))
+        self.assertTrue(lines[-1].endswith(" - INFO - Job job_id_99 is done"))
+
+    def test_stopping_closes_the_file(self):
+        setup_logger(self.filename, mode='queue')
+        handler = logger_config._listener.handlers[0]
+        logger_config._stop_listener()
+        self.assertIsNone(handler.stream)
+
+    def test_sampling(self):
+        logger = setup_logger(self.filename, mode='sync', sample_every=3)
+        for _ in range(6):
+            logger.info("Received request for state_mean")
+        logger.warning("Job refused: %s", "Too many queued jobs")
+        lines = self.read_lines()
+        # only the high-volume messages are sampled
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[-1].endswith(" - WARNING - Job refused: Too many queued jobs"))
+
+
+from app import webserver
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
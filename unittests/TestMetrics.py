@@ -0,0 +1,75 @@
+import unittest
+
+from app import webserver
+from app.data_ingestor import DataIngestor
+from app.metrics import Counter, Histogram, REGISTRY
+from app.task_runner import ThreadPool
+
+
+class TestMetrics(unittest.TestCase):
+    def tearDown(self):
+        # the test metrics are not exposed with the ones of the webserver
+        del REGISTRY[-1]
+
+    def test_counter(self):
+        counter = Counter('test_total', 'Test counter', ('endpoint',))
+        counter.inc('/api/a')
+        counter.inc('/api/a', amount=2)
+        counter.inc('/api/"b"')
+        self.assertEqual(counter.render(), [
+            '# HELP test_total Test counter',
+            '# TYPE test_total counter',
+            'test_total{endpoint="/api/a"} 3',
+            'test_total{endpoint="/api/\\"b\\""} 1',
+        ])
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test histogram', ('task',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, 'x')
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{task="x",le="0.1"} 2',
+            'test_seconds_bucket{task="x",le="1"} 3',
+            'test_seconds_bucket{task="x",le="+Inf"} 4',
+            'test_seconds_sum{task="x"} 3.65',
+            'test_seconds_count{task="x"} 4',
+        ])
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def setUp(self):
+        # the webserver's pool is shut down when the tests are loaded
+        self.tasks_runner = webserver.tasks_runner
+        self.data_ingestor = webserver.data_ingestor
+        webserver.tasks_runner = ThreadPool()
+        webserver.data_ingestor = DataIngestor('unittests_data.csv')
+        self.client = webserver.test_client()
+
+    def tearDown(self):
+        webserver.tasks_runner.graceful_shutdown()
+        webserver.tasks_runner = self.tasks_runner
+        webserver.data_ingestor = self.data_ingestor
+
+    def test_exposition(self):
+        question = 'Percent of adults aged 18 years and older who have obesity'
+        self.client.post('/api/global_mean?sync=1', json={"question": question})
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        lines = response.get_data(as_text=True).splitlines()
+        # every sample belongs to a metric declared with HELP and TYPE
+        declared = {line.split()[2] for line in lines if line.startswith('# TYPE')}
+        for line in lines:
+            if not line.startswith('#'):
+                name = line.split('{')[0].split()[0]
+                self.assertTrue(name in declared or
+                                name.rsplit('_', 1)[0] in declared, line)
+        self.assertTrue(any(line.startswith(
+            'http_requests_total{endpoint="/api/global_mean",code="200"} ') for line in lines))
+        self.assertIn('tp_jobs{status="done"} 1', lines)
+        self.assertIn('data_rows 16', lines)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', lines)
+
+
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,74 @@
+import unittest
+
+import pandas as pd
+
+from app.data_ingestor import DataIngestor
+from app.query_engine import Query, QueryError, run_query
+from app.result_cache import ALL_QUESTIONS
+from app.utilities.utils import calculate_states_mean, calculate_mean_by_category
+
+
+class TestQueryEngine(unittest.TestCase):
+    def setUp(self):
+        self.data = DataIngestor('unittests_data.csv')
+        self.frame = pd.read_csv('unittests_data.csv', keep_default_na=False,
+                                 na_values={'Data_Value': ['']})
+        self.question = 'Percent of adults aged 18 years and older who have obesity'
+
+    def test_group_by_and_aggregates(self):
+        spec = {
+            "filters": [{"column": "YearStart", "op": ">=", "value": 2017}],
+            "group_by": ["LocationAbbr"],
+            "aggregates": ["mean", "min", "max", "count"],
+            "order_by": [{"column": "max", "desc": True}],
+            "limit": 3,
+        }
+        result = run_query(self.data, spec)
+        expected = self.frame[self.frame['YearStart'] >= 2017].groupby('LocationAbbr')\
+            ['Data_Value'].agg(['mean', 'min', 'max', 'count'])\
+            .sort_values('max', ascending=False).head(3)
+        self.assertEqual(result['columns'], ['LocationAbbr', 'mean', 'min', 'max', 'count'])
+        self.assertEqual([row[0] for row in result['rows']], list(expected.index))
+        for row, (_, values) in zip(result['rows'], expected.iterrows()):
+            self.assertAlmostEqual(row[1], values['mean'])
+            self.assertEqual(row[2:], [values['min'], values['max'], values['count']])
+
+    def test_presets(self):
+        # the fixed endpoints are special cases of a query
+        data = {"question": self.question}
+        filters = [{"column": "Question", "value": self.question}]
+        result = run_query(self.data, {"filters": filters, "group_by": ["LocationDesc"],
+                                       "order_by": ["mean"]})
+        self.assertEqual([row[0] for row in result['rows']],
+                         list(calculate_states_mean(self.data, data)))
+        result = run_query(self.data, {"filters": filters, "group_by": [
+            "LocationDesc", "StratificationCategory1", "Stratification1"]})
+        means = calculate_mean_by_category(self.data, data)
+        self.assertEqual([str(tuple(row[:3])) for row in result['rows']], list(means))
+        for row, mean in zip(result['rows'], means.values()):
+            self.assertAlmostEqual(row[3], mean)
+
+    def test_no_match(self):
+        result = run_query(self.data, {"filters": [
+            {"column": "Question", "op": "in", "value": ["Unknown question"]}],
+            "aggregates": ["count", "mean"]})
+        self.assertEqual(result['rows'], [[0, None]])
+
+    def test_invalid_specs(self):
+        for spec in ([], {"select": []}, {"group_by": ["Data_Value"]},
+                     {"filters": [{"column": "Question", "op": ">", "value": "a"}]},
+                     {"aggregates": ["median"]}, {"order_by": ["max"]}, {"limit": -1},
+                     {"aggregates": "mean"}, {"aggregates": [{"fn": "mean", "as": ["x"]}]},
+                     {"order_by": 1}):
+            with self.assertRaises(QueryError):
+                Query(spec)
+
+    def test_cache_tags(self):
+        query = Query({"filters": [{"column": "Question", "value": self.question}]})
+        self.assertEqual(query.cache_tags(), {self.question})
+        self.assertEqual(Query({}).cache_tags(), {ALL_QUESTIONS})
+
+
+from app import webserver
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,53 @@
+import unittest
+
+from app.data_ingestor import DataIngestor
+from app.ranking import Ranking, select, rank_in, rank_options
+from app.utilities.utils import calculate_rank, calculate_best5
+
+
+class TestRanking(unittest.TestCase):
+    def setUp(self):
+        self.means = {'a': 3.0, 'b': 1.0, 'c': 2.0, 'd': 1.0, 'e': 5.0}
+        self.ranking = Ranking({state: [mean, 1] for state, mean in self.means.items()})
+
+    def test_ranking(self):
+        self.assertEqual(self.ranking.top(3), [('b', 1.0), ('d', 1.0), ('c', 2.0)])
+        self.assertEqual(self.ranking.top(2, offset=1, descending=True),
+                         [('a', 3.0), ('c', 2.0)])
+        self.assertEqual(self.ranking.top(5, offset=4), [('e', 5.0)])
+        self.assertEqual(self.ranking.rank_of('d'), 2)
+        self.assertEqual(self.ranking.rank_of('d', descending=True), 4)
+        self.assertIsNone(self.ranking.rank_of('z'))
+
+    def test_partial_selection(self):
+        # same order as the presorted ranking, ties included
+        for descending in (False, True):
+            for offset in range(6):
+                self.assertEqual(select(self.means, 2, offset, descending),
+                                 self.ranking.top(2, offset, descending))
+            for state in self.means:
+                self.assertEqual(rank_in(self.means, state, descending),
+                                 self.ranking.rank_of(state, descending))
+
+    def test_rank_requests(self):
+        data = DataIngestor('unittests_data.csv')
+        question = "Percent of adults who achieve at least 300 minutes a week of moderate-intensity aerobic physical activity or 150 minutes a week of vigorous-intensity aerobic activity (or an equivalent combination)"
+        result = calculate_rank(data, {"question": question})
+        # the same states as /api/best5, best first
+        self.assertEqual([entry['state'] for entry in result['ranking']],
+                         list(calculate_best5(data, {"question": question}))[::-1])
+        self.assertEqual(calculate_rank(data, {"question": question, "state": "Tennessee"}),
+                         {"state": "Tennessee", "rank": 1, "mean": 39.0, "total": 2})
+        result = calculate_rank(data, {"question": question, "order": "asc",
+                                       "stratification_category": "Race/Ethnicity"})
+        self.assertEqual(result, {"total": 1, "ranking": [
+            {"rank": 1, "state": "West Virginia", "mean": 31.1}]})
+        for invalid in ({}, {"question": question, "k": -1},
+                        {"question": question, "order": "random"}):
+            with self.assertRaises(ValueError):
+                rank_options(invalid)
+
+
+from app import webserver
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,83 @@
+import unittest
+from threading import Event
+
+from app.result_cache import ResultCache, make_cache_key, cache_tags
+from app.task_runner import ThreadPool
+
+
+class TestResultCache(unittest.TestCase):
+    def test_cache_key_is_canonical(self):
+        key1 = make_cache_key('/api/state_mean', {"question": "q", "state": "Ohio"})
+        key2 = make_cache_key('/api/state_mean', {"state": "Ohio", "question": "q"})
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, make_cache_key('/api/global_mean', {"question": "q"}))
+
+    def test_lru_eviction(self):
+        cache = ResultCache(max_entries=2, max_bytes=1000)
+        cache.put('a', '1')
+        cache.put('b', '2')
+        # 'a' becomes the most recently used one
+        self.assertEqual(cache.get('a'), '1')
+        cache.put('c', '3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), '3')
+        stats = cache.get_stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_size_limit(self):
+        cache = ResultCache(max_entries=10, max_bytes=10)
+        cache.put('a', '12345')
+        cache.put('b', '12345')
+        cache.put('c', '12345')
+        self.assertEqual(cache.get_stats()['size_bytes'], 10)
+        self.assertIsNone(cache.get('a'))
+        # results bigger than the whole cache are not stored
+        cache.put('d', '0' * 11)
+        self.assertIsNone(cache.get('d'))
+
+    def test_invalidation_by_tags(self):
+        cache = ResultCache(max_entries=10, max_bytes=1000)
+        cache.put('a', '1', cache_tags({"question": "q1"}))
+        cache.put('b', '2', cache_tags([{"question": "q1"}, {"question": "q2"}]))
+        cache.put('c', '3', cache_tags({"requests": [{"question": "q3"}]}))
+        cache.invalidate({"q2"})
+        self.assertEqual(cache.get('a'), '1')
+        self.assertIsNone(cache.get('b'))
+        cache.invalidate({"q1"})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), '3')
+        stats = cache.get_stats()
+        self.assertEqual(stats['invalidations'], 2)
+        self.assertEqual(stats['size_bytes'], 1)
+
+    def test_coalescing_and_hits(self):
+        pool = ThreadPool()
+        release = Event()
+        calls = []
+
+        def task(value):
+            calls.append(value)
+            release.wait(5)
+            return {"value": value}
+
+        try:
+            job1 = pool.add_task(task, 1, cache_key='key')
+            job2 = pool.add_task(task, 1, cache_key='key')
+            # the identical request is attached to the running job
+            self.assertEqual(job1, job2)
+            release.set()
+            pool.task_queue.join()
+            job3 = pool.add_task(task, 1, cache_key='key')
+            self.assertNotEqual(job1, job3)
+            self.assertEqual(pool.jobs[job3]['status'], 'done')
+            self.assertEqual(calls, [1])
+            self.assertEqual(pool.cache.get_stats()['coalesced'], 1)
+        finally:
+            pool.graceful_shutdown()
+
+
+from app import webserver
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
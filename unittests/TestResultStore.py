@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+
+from app.result_store import MemoryResultStore, FileResultStore
+
+
+class TestResultStore(unittest.TestCase):
+    def test_memory_store(self):
+        store = MemoryResultStore()
+        store.save('job_id_1', b'{"Ohio": 29.4}')
+        self.assertEqual(store.load('job_id_1'), b'{"Ohio": 29.4}')
+        store.delete('job_id_1')
+        self.assertIsNone(store.load('job_id_1'))
+        self.assertIsNone(store.load('job_id_2'))
+
+    def test_file_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = FileResultStore(directory)
+            store.save('job_id_1', b'{"Ohio": 29.4}')
+            # served from memory before being written
+            self.assertEqual(store.load('job_id_1'), b'{"Ohio": 29.4}')
+            store.flush()
+            with open(os.path.join(directory, 'job_id_1'), 'rb') as file:
+                self.assertEqual(file.read(), b'{"Ohio": 29.4}')
+            store.delete('job_id_1')
+            store.close()
+            self.assertEqual(os.listdir(directory), [])
+            self.assertIsNone(store.load('job_id_1'))
+
+    def test_evicted_results_are_read_from_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = FileResultStore(directory, max_in_memory=1)
+            for index in range(3):
+                store.save(f'job_id_{index}', str(index).encode())
+            store.flush()
+            # only the last written result is kept in memory
+            self.assertEqual(list(store.results), ['job_id_2'])
+            for index in range(3):
+                self.assertEqual(store.load(f'job_id_{index}'), str(index).encode())
+            store.close()
+
+
+from app import webserver
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,214 @@
+import json
+import os
+import time
+import unittest
+import zlib
+from threading import Event, Timer
+from unittest import mock
+
+from app import webserver
+from app.api_common import GZIP_MIN_BYTES, STREAM_MIN_BYTES
+from app.data_ingestor import DataIngestor
+from app.routes import json_response
+from app.task_runner import ThreadPool
+
+
+class TestRoutes(unittest.TestCase):
+    def setUp(self):
+        # the webserver's pool is shut down when the tests are loaded
+        self.tasks_runner = webserver.tasks_runner
+        self.data_ingestor = webserver.data_ingestor
+        webserver.tasks_runner = ThreadPool()
+        webserver.data_ingestor = DataIngestor('unittests_data.csv')
+        self.client = webserver.test_client()
+        self.question = 'Percent of adults aged 18 years and older who have obesity'
+
+    def tearDown(self):
+        webserver.tasks_runner.graceful_shutdown()
+        webserver.tasks_runner = self.tasks_runner
+        webserver.data_ingestor = self.data_ingestor
+
+    def result(self, response):
+        """Waits for the job submitted by response, returns the status and body of its result"""
+        job_id = response.get_json()['job_id']
+        result = self.client.get(f'/api/get_results/{job_id}?wait=10')
+        return result.status_code, result.get_json()
+
+    def test_long_polling(self):
+        release = Event()
+        job_id = webserver.tasks_runner.add_task(lambda: {"released": release.wait(5)})
+        # without wait the status is returned at once
+        response = self.client.get(f'/api/get_results/{job_id}')
+        self.assertEqual(response.get_json(), {"status": "running"})
+        start = time.monotonic()
+        response = self.client.get(f'/api/get_results/{job_id}?wait=0.2')
+        self.assertEqual(response.get_json(), {"status": "running"})
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        # the request is answered as soon as the job is done, before the wait expires
+        Timer(0.1, release.set).start()
+        start = time.monotonic()
+        response = self.client.get(f'/api/get_results/{job_id}?wait=10')
+        self.assertEqual(response.get_json(), {"status": "done", "data": {"released": True}})
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_timings(self):
+        response = self.client.post('/api/states_mean', json={"question": self.question})
+        job_id = response.get_json()['job_id']
+        self.client.get(f'/api/get_results/{job_id}?wait=10')
+        result = self.client.get(f'/api/get_results/{job_id}?timings=1').get_json()
+        self.assertEqual(result['status'], "done")
+        self.assertEqual(set(result['timings']), {"queue", "compute"})
+        self.assertTrue(all(seconds >= 0 for seconds in result['timings'].values()))
+        # an identical request answered from the cache was not queued nor computed
+        response = self.client.post('/api/states_mean', json={"question": self.question})
+        job_id = response.get_json()['job_id']
+        result = self.client.get(f'/api/get_results/{job_id}?timings=1').get_json()
+        self.assertEqual(result['status'], "done")
+        self.assertIsNone(result['timings'])
+
+    def test_invalid_years(self):
+        data = {"question": self.question, "state": "Ohio"}
+        for years in ({"year_start": "abc"}, {"year_end": 2019.5}, {"year_start": True}):
+            for path in ('/api/state_mean', '/api/state_mean?sync=1'):
+                response = self.client.post(path, json=dict(data, **years))
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.get_json()['status'], "error")
+        response = self.client.post('/api/batch', json=[
+            dict(data, endpoint="state_mean"), dict(data, endpoint="state_mean", year_end="x")])
+        self.assertEqual(response.status_code, 400)
+        # years given as strings of digits are accepted
+        response = self.client.post('/api/state_mean?sync=1',
+                                    json=dict(data, year_start="2017", year_end=2017))
+        self.assertEqual(response.get_json()['data'], {"Ohio": 29.4})
+        self.assertEqual(webserver.tasks_runner.count_jobs("error"), 0)
+
+    def test_expired_job(self):
+        response = self.client.post('/api/state_mean',
+                                    json={"question": self.question, "state": "Ohio"})
+        status, _ = self.result(response)
+        self.assertEqual(status, 200)
+        webserver.tasks_runner.job_ttl = 0
+        response = self.client.get(f"/api/get_results/{response.get_json()['job_id']}")
+        self.assertEqual(response.status_code, 404)
+
+    def test_sync(self):
+        response = self.client.post('/api/state_mean?sync=1',
+                                    json={"question": self.question, "state": "Ohio"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['data'], {"Ohio": 29.4})
+        # a task that raises gives an error job, reported with the JSON envelope
+        response = self.client.post('/api/state_mean', json={}, headers={'X-Sync': '1'})
+        self.assertEqual(response.status_code, 500)
+        result = response.get_json()
+        self.assertEqual(result['status'], "error")
+        self.assertIn("KeyError", result['reason'])
+        self.assertEqual(webserver.tasks_runner.count_jobs("error"), 1)
+        response = self.client.get(f"/api/get_results/{result['job_id']}")
+        self.assertEqual((response.status_code, response.get_json()),
+                         (500, {"status": "error", "reason": result['reason']}))
+
+    def test_sync_admission_control(self):
+        data = {"question": self.question, "state": "Ohio"}
+        release = Event()
+        # keeping every worker busy so that the next job stays queued
+        for _ in webserver.tasks_runner.workers:
+            webserver.tasks_runner.add_task(release.wait, 5)
+        while webserver.tasks_runner.task_queue.qsize():
+            time.sleep(0.01)
+        webserver.tasks_runner.add_task(lambda: {})
+        webserver.tasks_runner.max_queue_depth = 1
+        # the synchronous path is refused like a queued job
+        response = self.client.post('/api/state_mean?sync=1', json=data)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.get_json()['reason'], "Too many queued jobs")
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+        release.set()
+        webserver.tasks_runner.task_queue.join()
+        response = self.client.post('/api/state_mean', json=data, headers={'X-Sync': '1'})
+        self.assertEqual(response.status_code, 200)
+        # and once the pool is shutting down
+        webserver.tasks_runner.graceful_shutdown()
+        response = self.client.post('/api/global_mean?sync=1', json={"question": self.question})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_reload_outside_data_directory(self):
+        for csv_path in ("/dev/zero", "app/routes.py"):
+            response = self.client.post('/api/admin/reload', json={"csv_path": csv_path})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(webserver.data_reloader.get_status()["status"], "idle")
+
+    def test_process_backend(self):
+        webserver.tasks_runner.graceful_shutdown()
+        with mock.patch.dict(os.environ, {'TP_BACKEND': 'process', 'TP_NUM_OF_PROCESSES': '2'}):
+            webserver.tasks_runner = ThreadPool()
+        # forking while another thread holds the lock of the data (reading the columns)
+        with webserver.data_ingestor.append_lock:
+            webserver.tasks_runner.share(webserver.data_ingestor)
+        self.assertIsNotNone(webserver.tasks_runner.executor)
+
+        response = self.client.post('/api/state_mean',
+                                    json={"question": self.question, "state": "Ohio"})
+        self.assertEqual(self.result(response), (200, {"status": "done",
+                                                       "data": {"Ohio": 29.4}}))
+        # a query reads the columns under the lock, in the worker process
+        response = self.client.post('/api/query', json={
+            "filters": [{"column": "Question", "value": self.question},
+                        {"column": "LocationDesc", "value": "Ohio"}],
+            "aggregates": ["count"]})
+        self.assertEqual(self.result(response), (200, {"status": "done", "data": {
+            "columns": ["count"], "rows": [[1]]}}))
+        # the processes would not see appended rows
+        response = self.client.post('/api/admin/append_rows', json={"rows": [
+            {"Question": self.question, "LocationDesc": "Ohio", "Data_Value": 1.0,
+             "StratificationCategory1": "Total", "Stratification1": "Total"}]})
+        self.assertEqual(response.status_code, 501)
+        self.assertEqual(len(webserver.data_ingestor), 16)
+
+
+class TestJsonResponse(unittest.TestCase):
+    def respond(self, size, accept_encoding=None):
+        """Response of json_response for a result of about size bytes, with its body"""
+        payload = json.dumps({f"state {index}": index / 7 for index in range(size // 30)})\
+            .encode('utf-8')
+        parts = [b'{"status": "done", "data": ', payload, b'}']
+        headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+        with webserver.test_request_context(headers=headers):
+            response = json_response(parts)
+            return response, b''.join(response.iter_encoded()), b''.join(parts)
+
+    def test_gzip_negotiation(self):
+        response, body, expected = self.respond(4 * GZIP_MIN_BYTES)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(body, expected)
+        response, body, expected = self.respond(4 * GZIP_MIN_BYTES, 'gzip, deflate')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(body, wbits=31), expected)
+        # gzip is only used when it (or *) has a q-value above 0
+        for accept_encoding, compressed in (('deflate, gzip;q=0', False), ('GZIP;q=0.5', True),
+                                            ('br, *', True), ('*;q=0', False),
+                                            ('gzip;q=0, *', False), ('identity', False)):
+            response, _, _ = self.respond(4 * GZIP_MIN_BYTES, accept_encoding)
+            self.assertEqual('Content-Encoding' in response.headers, compressed, accept_encoding)
+        # small bodies are not compressed
+        response, body, expected = self.respond(GZIP_MIN_BYTES // 4, 'gzip')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(body, expected)
+
+    def test_streaming(self):
+        response, body, expected = self.respond(2 * STREAM_MIN_BYTES)
+        self.assertTrue(response.is_streamed)
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(body, expected)
+        self.assertEqual(json.loads(body)['status'], "done")
+        response, body, expected = self.respond(2 * STREAM_MIN_BYTES, 'gzip')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(body, wbits=31), expected)
+        response, _, _ = self.respond(STREAM_MIN_BYTES // 4)
+        self.assertFalse(response.is_streamed)
+
+
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
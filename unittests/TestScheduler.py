@@ -0,0 +1,63 @@
+import unittest
+from queue import Empty
+
+from app.scheduler import FairScheduler, cost_class
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = FairScheduler()
+
+    def test_clients_take_turns(self):
+        for i in range(3):
+            self.scheduler.put(('a', i), client='a')
+        self.scheduler.put(('b', 0), client='b')
+        self.scheduler.put(('b', 1), client='b')
+        order = [self.scheduler.get(timeout=0) for _ in range(5)]
+        self.assertEqual(order, [('a', 0), ('b', 0), ('a', 1), ('b', 1), ('a', 2)])
+
+    def test_lane_weights(self):
+        for i in range(10):
+            self.scheduler.put(('expensive', i), 'expensive')
+        for i in range(10):
+            self.scheduler.put(('cheap', i), 'cheap')
+        lanes = [self.scheduler.get(timeout=0)[0] for _ in range(10)]
+        # 4 cheap tasks for every expensive one, the expensive lane is not starved
+        self.assertEqual(lanes.count('cheap'), 8)
+        self.assertEqual(lanes.count('expensive'), 2)
+        stats = self.scheduler.get_stats()
+        self.assertEqual(stats['cheap']['depth'], 2)
+        self.assertEqual(stats['expensive']['dequeued'], 2)
+
+    def test_lane_fairness(self):
+        # a burst of expensive tasks from one client, then default and cheap tasks
+        for i in range(50):
+            self.scheduler.put(('expensive', i), 'expensive', client='a')
+        for i in range(4):
+            self.scheduler.put(('default', i), 'default', client='b')
+        self.scheduler.put(('cheap', 0), 'cheap', client='c')
+        lanes = [self.scheduler.get(timeout=0)[0] for _ in range(7)]
+        # the cheap and default tasks do not wait behind the burst
+        self.assertEqual(lanes.index('cheap'), 0)
+        self.assertEqual(lanes.count('default'), 4)
+        self.assertEqual(lanes.count('expensive'), 2)
+        # alone in the queue, the expensive lane gets every turn
+        lanes = [self.scheduler.get(timeout=0)[0] for _ in range(5)]
+        self.assertEqual(lanes, ['expensive'] * 5)
+
+    def test_queue_interface(self):
+        with self.assertRaises(Empty):
+            self.scheduler.get(timeout=0.01)
+        self.scheduler.put('task', 'unknown lane')
+        self.assertEqual(self.scheduler.qsize(), 1)
+        self.assertEqual(self.scheduler.get(timeout=0), 'task')
+        self.assertTrue(self.scheduler.empty())
+        self.scheduler.task_done()
+        self.scheduler.join()
+        self.assertEqual(cost_class('/api/mean_by_category'), 'expensive')
+        self.assertEqual(cost_class('/api/best5'), 'default')
+
+
+from app import webserver
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
@@ -0,0 +1,156 @@
+import os
+import tempfile
+import time
+import unittest
+from threading import Event
+from unittest import mock
+
+from app.task_runner import ThreadPool, QueueFullError
+
+
+def record_run_and_raise(shared):
+    """Task run in a worker process, writing its pid to the shared file before raising"""
+    with open(shared['filename'], 'a', encoding='utf-8') as file:
+        file.write(f"{os.getpid()}\n")
+    raise RuntimeError("task failed")
+
+
+class TestThreadPool(unittest.TestCase):
+    def setUp(self):
+        os.environ['TP_MAX_FINISHED_JOBS'] = '3'
+        self.pool = ThreadPool()
+
+    def tearDown(self):
+        os.environ.pop('TP_MAX_FINISHED_JOBS', None)
+        self.pool.graceful_shutdown()
+
+    def test_job_counters(self):
+        job_ids = [self.pool.add_task(lambda value: {"value": value}, i) for i in range(2)]
+        self.pool.task_queue.join()
+        self.assertEqual(self.pool.count_jobs("running"), 0)
+        self.assertEqual(self.pool.count_jobs("done"), 2)
+        self.assertEqual(self.pool.get_job_statuses(), {job_id: "done" for job_id in job_ids})
+
+    def test_finished_jobs_expire(self):
+        job_ids = [self.pool.add_task(lambda value: {"value": value}, i) for i in range(5)]
+        self.pool.task_queue.join()
+        # only the last 3 finished jobs are kept, with their results
+        self.assertEqual(len(self.pool.jobs), 3)
+        self.assertEqual(self.pool.count_jobs("done"), 3)
+        for job_id in job_ids:
+            if job_id in self.pool.jobs:
+                self.assertIsNotNone(self.pool.results.load(job_id))
+            else:
+                self.assertIsNone(self.pool.results.load(job_id))
+
+    def test_ttl(self):
+        self.pool.job_ttl = 0
+        self.pool.add_task(lambda: {})
+        self.pool.task_queue.join()
+        self.assertEqual(self.pool.jobs, {})
+        self.assertEqual(self.pool.count_jobs("done"), 0)
+
+    def test_expiry_on_read(self):
+        job_id = self.pool.add_task(lambda: {})
+        self.pool.task_queue.join()
+        self.assertEqual(self.pool.get_job(job_id)["status"], "done")
+        # no other job finishes, the expired job is forgotten when the jobs are read
+        self.pool.job_ttl = 0
+        self.assertIsNone(self.pool.get_job(job_id))
+        self.assertEqual(self.pool.count_jobs("done"), 0)
+        self.assertIsNone(self.pool.results.load(job_id))
+
+    def test_admission_control(self):
+        self.pool.max_queue_depth = 2
+        self.pool.max_client_queue = 1
+        release = Event()
+        # keeping every worker busy so the next jobs stay queued
+        for _ in self.pool.workers:
+            self.pool.add_task(release.wait, 5)
+        while self.pool.task_queue.qsize():
+            time.sleep(0.01)
+        self.pool.add_task(lambda: {}, client='a')
+        with self.assertRaises(QueueFullError) as refused:
+            self.pool.add_task(lambda: {}, client='a')
+        self.assertTrue(refused.exception.per_client)
+        self.pool.add_task(lambda: {}, client='b')
+        with self.assertRaises(QueueFullError) as refused:
+            self.pool.add_task(lambda: {}, client='c')
+        self.assertFalse(refused.exception.per_client)
+        self.assertGreaterEqual(refused.exception.retry_after, 1)
+        release.set()
+        self.pool.task_queue.join()
+        self.pool.add_task(lambda: {}, client='c')
+
+    def test_failing_tasks(self):
+        self.pool.max_finished_jobs = 1000
+
+        def task(value):
+            if value % 3 == 0:
+                raise ValueError(value)
+            if value % 67 == 0:
+                # kills the worker thread, it is replaced by a new one
+                raise SystemExit
+            return {"value": value}
+
+        job_ids = [self.pool.add_task(task, i) for i in range(200)]
+        self.pool.task_queue.join()
+        statuses = self.pool.get_job_statuses()
+        for i, job_id in enumerate(job_ids):
+            self.assertEqual(statuses[job_id], "error" if i % 3 == 0 or i % 67 == 0 else "done")
+        self.assertEqual(self.pool.results.load(job_ids[3]), b'"ValueError: 3"')
+        self.assertEqual(self.pool.count_jobs("running"), 0)
+        self.assertEqual(len(self.pool.workers), self.pool.num_threads)
+        self.assertTrue(all(worker.is_alive() for worker in self.pool.workers))
+
+    def test_done_callbacks(self):
+        release = Event()
+        called = []
+        job_id = self.pool.add_task(release.wait)
+        self.assertTrue(self.pool.add_done_callback(job_id, lambda: called.append(1)))
+        self.pool.add_done_callback(job_id, lambda: called.append(2))
+        self.pool.remove_done_callback(job_id, None)
+        release.set()
+        self.pool.task_queue.join()
+        self.assertEqual(called, [1, 2])
+        # the job is already done, the callback is not registered
+        self.assertFalse(self.pool.add_done_callback(job_id, lambda: called.append(3)))
+        self.assertEqual(self.pool.done_callbacks, {})
+
+    def test_shutdown_drains_queue(self):
+        self.pool.max_finished_jobs = 1000
+        for _ in range(20):
+            self.pool.add_task(time.sleep, 0.01)
+        start = time.monotonic()
+        self.pool.graceful_shutdown()
+        self.assertLess(time.monotonic() - start, 5)
+        # the queued jobs were run before the workers stopped
+        self.assertEqual(self.pool.count_jobs("done"), 20)
+        self.assertFalse(any(worker.is_alive() for worker in self.pool.workers))
+        with self.assertRaises(QueueFullError):
+            self.pool.add_task(time.sleep, 0)
+
+    def test_process_task_errors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.dict(os.environ, {'TP_BACKEND': 'process',
+                                              'TP_NUM_OF_PROCESSES': '1'}):
+                pool = ThreadPool()
+            try:
+                shared = {'filename': os.path.join(directory, 'runs')}
+                pool.share(shared)
+                job_id = pool.add_task(record_run_and_raise, shared)
+                pool.task_queue.join()
+                self.assertEqual(pool.get_job(job_id)["status"], "error")
+                self.assertEqual(pool.results.load(job_id), b'"RuntimeError: task failed"')
+                # the task ran once, in the worker process, and not again in the thread
+                with open(shared['filename'], encoding='utf-8') as file:
+                    pids = file.read().split()
+                self.assertEqual(len(pids), 1)
+                self.assertNotEqual(pids[0], str(os.getpid()))
+            finally:
+                pool.graceful_shutdown()
+
+
+from app import webserver
+# shutting down the webserver because it is created in app.__init__.py
+webserver.tasks_runner.graceful_shutdown()
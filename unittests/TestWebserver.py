@@ -1,6 +1,6 @@
 import unittest
-import csv
 
+from app.data_ingestor import DataIngestor
 from app.utilities.utils import (calculate_states_mean,
                                 calculate_state_mean,
                                 calculate_best5,
@@ -9,17 +9,14 @@ from app.utilities.utils import (calculate_states_mean,
                                 calculate_diff_from_mean,
                                 calculate_state_diff_from_mean,
                                 calculate_mean_by_category,
-                                calculate_state_mean_by_category)
+                                calculate_state_mean_by_category,
+                                calculate_batch)
 
 
 class TestWebserver(unittest.TestCase):
     def setUp(self):
         # getting the data from the csv file
-        self.data = []
-        with open(file='unittests_data.csv', newline='') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                self.data.append(row)
+        self.data = DataIngestor('unittests_data.csv')
         
         # dictionary storing each function to be tested
         self.functions = {
@@ -100,7 +97,22 @@ class TestWebserver(unittest.TestCase):
         result = self.functions['state_mean_by_category'](self.data, data_received)
         self.assertEqual(result, {'Wisconsin': 0})
 
+    def test_batch(self):
+        question = "Percent of adults who engage in no leisure-time physical activity"
+        data_received = [
+            {"endpoint": "worst5", "question": question},
+            {"endpoint": "state_mean", "question": question, "state": "Ohio", "id": "ohio"},
+            {"endpoint": "states_mean", "question": question},
+            {"endpoint": "unknown", "question": question}
+        ]
+        result = calculate_batch(self.data, data_received)
+        self.assertEqual(list(result), ['0', 'ohio', '2', '3'])
+        self.assertEqual(result['0'], self.functions['worst5'](self.data, data_received[0]))
+        self.assertEqual(result['ohio'], {'Ohio': 31.6})
+        self.assertEqual(result['2'], self.functions['states_mean'](self.data, data_received[2]))
+        self.assertIn('error', result['3'])
+
 
 from app import webserver
 # shutting down the webserver because it is created in app.__init__.py
-webserver.tasks_runner.shutdown_event.set()
\ No newline at end of file
+webserver.tasks_runner.graceful_shutdown()
\ No newline at end of file